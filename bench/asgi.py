@@ -0,0 +1,117 @@
+import asyncio
+import time
+from urllib.parse import quote
+
+from urllib3.filepost import encode_multipart_formdata
+
+BODY_CHUNK_SIZE = 1024 * 1024
+
+
+def multipart(fields: dict):
+    '''
+    (body, headers) for a multipart/form-data request; encode bodies before timing starts.
+    '''
+    body, content_type = encode_multipart_formdata(fields)
+    return body, {"content-type": content_type}
+
+
+class Response:
+    def __init__(self):
+        self.status = None
+        self.headers = {}
+        self.size = 0
+        self.body = b""
+        self.seconds = None
+        # the last body message (more_body=False) was sent
+        self.complete = False
+        # with a 2xx status, a body shorter than this (or than content-length) is an error
+        self.expected_size = None
+
+    def json(self):
+        import json
+        return json.loads(self.body)
+
+    def truncated(self):
+        '''
+        Whether a successful response came back with less body than it announced (or than expected), e.g. a stream cut short.
+        '''
+        if not 200 <= self.status < 300:
+            return False
+        if not self.complete:
+            return True
+        if "content-length" in self.headers and self.size < int(self.headers["content-length"]):
+            return True
+        return self.expected_size is not None and self.size < self.expected_size
+
+
+class ASGIClient:
+    '''
+    Drives an ASGI app in-process, without sockets, so a benchmark measures the service rather than the
+    transport. Request bodies are fed to the app in chunks like a server would; response bodies are only
+    kept when asked for (keep_body), otherwise just counted.
+    '''
+
+    def __init__(self, app):
+        self.app = app
+
+    async def request(self, method: str, path: str, query: str = "", headers: dict = None, body: bytes = b"", keep_body: bool = True):
+        scope = {"type": "http",
+                 "asgi": {"version": "3.0"},
+                 "http_version": "1.1",
+                 "method": method,
+                 "scheme": "http",
+                 "path": path,
+                 "raw_path": quote(path).encode(),
+                 "query_string": query.encode(),
+                 "root_path": "",
+                 "headers": [(k.lower().encode(), str(v).encode()) for k, v in {"host": "bench", "content-length": len(body), **(headers or {})}.items()],
+                 "client": ("127.0.0.1", 50000),
+                 "server": ("bench", 80),
+                 "extensions": {}}
+        offset = 0
+        sent_all = False
+        response_done = asyncio.Event()
+
+        async def receive():
+            nonlocal offset, sent_all
+            if sent_all:
+                # like a real server, block until the response is done: Starlette takes an http.disconnect
+                # for the client hanging up, and cancels a StreamingResponse still being sent
+                await response_done.wait()
+                return {"type": "http.disconnect"}
+            chunk = body[offset:offset + BODY_CHUNK_SIZE]
+            offset += len(chunk)
+            sent_all = offset >= len(body)
+            return {"type": "http.request", "body": chunk, "more_body": not sent_all}
+
+        response = Response()
+        chunks = []
+
+        async def send(message):
+            if message["type"] == "http.response.start":
+                response.status = message["status"]
+                response.headers = {k.decode().lower(): v.decode() for k, v in message.get("headers", [])}
+            elif message["type"] == "http.response.body":
+                response.size += len(message.get("body", b""))
+                if keep_body:
+                    chunks.append(message.get("body", b""))
+                if not message.get("more_body", False):
+                    response.complete = True
+                    response_done.set()
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            response_done.set()
+        response.seconds = time.perf_counter() - start
+        response.body = b"".join(chunks)
+        return response
+
+    async def get(self, path: str, query: str = "", headers: dict = None, keep_body: bool = True, expected_size: int = None):
+        response = await self.request("GET", path, query, headers, keep_body=keep_body)
+        response.expected_size = expected_size
+        return response
+
+    async def post_json(self, path: str, body: bytes, query: str = ""):
+        return await self.request("POST", path, query, {"content-type": "application/json"}, body)
@@ -0,0 +1,311 @@
+'''
+Load and benchmark suite for the upload provider.
+
+Runs the FastAPI app in-process (no server, no sockets) against mongomock, or a real mongod with
+--mongo-uri, uploads synthetic expression datasets shaped like t/input/for-testing.zip in several
+sizes, and measures submit, processing, download, metadata, search and matrix-slice throughput,
+p50/p99 latency and peak RSS at each concurrency level. Results are written as JSON so runs
+can be compared across versions:
+
+    pip install -r bench/requirements.txt
+    python -m bench.run --sizes small,medium --concurrency 1,8 --out bench-results.json
+'''
+import argparse
+import asyncio
+import gc
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+import numpy as np
+
+from bench.asgi import ASGIClient, multipart
+from bench.synthetic import SIZES, dataset_zip, unique_variant
+
+SUBMITTER_ID = "bench@example.com"
+
+# requests per scenario, scaled down for the bigger datasets
+DEFAULT_REQUESTS = {"small": 200, "medium": 40, "large": 8}
+
+
+def _use_mongomock():
+    '''
+    Point pymongo at mongomock before the app creates its client.
+    '''
+    import mongomock
+    import mongomock.database
+    import pymongo
+
+    class MockClient(mongomock.MongoClient):
+        def __init__(self, *args, **kwargs):
+            super().__init__()
+
+    command = mongomock.database.Database.command
+
+    def build_info_command(self, cmd, *args, **kwargs):
+        # the app logs the server version at startup; mongomock doesn't implement buildInfo
+        if cmd == {"buildInfo": 1}:
+            return {"version": f"mongomock-{mongomock.__version__}"}
+        return command(self, cmd, *args, **kwargs)
+
+    mongomock.database.Database.command = build_info_command
+    pymongo.MongoClient = MockClient
+
+
+def _use_s3(args):
+    '''
+    Offload blobs to a bucket: on the server at --s3-endpoint-url (e.g. MinIO), or an in-process moto stand-in.
+    '''
+    import boto3
+    bucket = f"bench-{uuid.uuid4().hex[:8]}"
+    os.environ.update({"STORAGE_BACKEND": "s3", "S3_BUCKET": bucket, "STORAGE_KEEP_LOCAL": str(args.keep_local).lower()})
+    if args.s3_endpoint_url is not None:
+        os.environ["S3_ENDPOINT_URL"] = args.s3_endpoint_url
+    else:
+        from moto import mock_s3
+        for name in ("AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY"):
+            os.environ.setdefault(name, "bench")
+        mock_s3().start()
+    boto3.client("s3", endpoint_url=args.s3_endpoint_url, region_name=os.getenv("S3_REGION", "us-east-1"),
+                 aws_access_key_id=os.getenv("S3_ACCESS_KEY_ID"), aws_secret_access_key=os.getenv("S3_SECRET_ACCESS_KEY")).create_bucket(Bucket=bucket)
+
+
+def _load_app(args, work_dir: str):
+    os.environ.update({
+        "MONGO_CLIENT": args.mongo_uri or "mongodb://mongomock/bench",
+        "MONGO_DATABASE": f"bench_{uuid.uuid4().hex[:8]}",
+        "DATA_DIR": work_dir,
+        "UPLOAD_QUEUE": "local",
+        "LOG_LEVEL": args.log_level,
+    })
+    for name in ("HOST_NAME", "CONTAINER_NETWORK", "CONTAINER_NAME"):
+        os.environ.setdefault(name, "bench")
+    os.environ.setdefault("API_PORT", "8083")
+    if args.mongo_uri is None:
+        _use_mongomock()
+    if args.storage == "s3":
+        _use_s3(args)
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import main
+    return main
+
+
+class RssSampler:
+    '''
+    Peak resident set size while a scenario runs, sampled from /proc; falls back to the process-lifetime
+    peak from getrusage where /proc isn't available.
+    '''
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+        self._page_size = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+    def _rss(self):
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * self._page_size
+        except OSError:
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self._rss())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.peak = self._rss()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self._rss())
+
+
+async def _measure(scenario: str, size: str, concurrency: int, requests: list, bytes_in: int = 0):
+    '''
+    Run requests (coroutine factories) with at most `concurrency` in flight; summarise latency and throughput.
+    Error statuses count as errors, and so do successful responses with a truncated body.
+    '''
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+    bytes_out = 0
+
+    async def one(make_request):
+        nonlocal errors, bytes_out
+        async with semaphore:
+            response = await make_request()
+        latencies.append(response.seconds)
+        bytes_out += response.size
+        if response.status >= 400 or response.truncated():
+            errors += 1
+
+    gc.collect()
+    with RssSampler() as rss:
+        start = time.perf_counter()
+        await asyncio.gather(*[one(r) for r in requests])
+        elapsed = time.perf_counter() - start
+    result = {
+        "scenario": scenario,
+        "size": size,
+        "concurrency": concurrency,
+        "requests": len(requests),
+        "errors": errors,
+        "seconds": round(elapsed, 4),
+        "requests_per_second": round(len(requests) / elapsed, 2),
+        "upload_bytes_per_second": round(bytes_in / elapsed, 1),
+        "download_bytes_per_second": round(bytes_out / elapsed, 1),
+        "latency_ms": {name: round(float(value) * 1000, 3) for name, value in
+                       (("p50", np.percentile(latencies, 50)), ("p99", np.percentile(latencies, 99)),
+                        ("mean", np.mean(latencies)), ("max", np.max(latencies)))},
+        "peak_rss_mb": round(rss.peak / 2 ** 20, 1),
+    }
+    print(f"{scenario:>14} {size:>7} c={concurrency:<3} {result['requests_per_second']:>9} req/s  "
+          f"p50={result['latency_ms']['p50']}ms p99={result['latency_ms']['p99']}ms errors={errors} rss={result['peak_rss_mb']}MB", file=sys.stderr)
+    return result
+
+
+async def _wait_processed(client: ASGIClient, object_ids: list, timeout: float):
+    '''
+    Seconds until every object has left the 'started' state, polling the metadata endpoint.
+    '''
+    start = time.perf_counter()
+    pending = list(object_ids)
+    while len(pending) > 0:
+        if time.perf_counter() - start > timeout:
+            raise TimeoutError(f"{len(pending)} objects still processing after {timeout}s")
+        statuses = await asyncio.gather(*[client.get(f"/objects/{object_id}") for object_id in pending])
+        pending = [object_id for object_id, r in zip(pending, statuses) if r.status != 200 or r.json()["status"] == "started"]
+        if len(pending) > 0:
+            await asyncio.sleep(0.01)
+    return time.perf_counter() - start
+
+
+async def _bench_size(client: ASGIClient, size: str, concurrency: int, n: int, base_zip: bytes, seed: int):
+    results = []
+    form = {"service_id": "fuse-provider-upload", "submitter_id": SUBMITTER_ID, "data_type": "class_dataset_expression",
+            "file_type": "filetype_dataset_archive", "version": "1.0"}
+    # distinct bytes per upload, so the blob store can't dedupe them away; encoded before timing starts
+    bodies = [multipart({**form, "client_file": (f"bench-{size}.zip", unique_variant(base_zip, seed + i), "application/zip")}) for i in range(n)]
+    object_ids = []
+
+    def submit(body, headers):
+        async def make_request():
+            response = await client.request("POST", "/submit", "", headers, body)
+            if response.status == 202:
+                object_ids.append(response.json()["object_id"])
+            return response
+        return make_request
+
+    start = time.perf_counter()
+    results.append(await _measure("submit", size, concurrency, [submit(*b) for b in bodies], bytes_in=sum(len(b) for b, _ in bodies)))
+    del bodies
+    drain = await _wait_processed(client, object_ids, timeout=600)
+    results.append({"scenario": "process", "size": size, "concurrency": concurrency, "requests": len(object_ids),
+                    "seconds": round(time.perf_counter() - start, 4), "drain_seconds": round(drain, 4),
+                    "objects_per_second": round(len(object_ids) / (time.perf_counter() - start), 2)})
+
+    def get(path, query="", headers=None, expected_size=None):
+        return lambda: client.get(path, query, headers, keep_body=False, expected_size=expected_size)
+
+    ids = [object_ids[i % len(object_ids)] for i in range(n)]
+    # sizes to check the downloads against, so a stream cut short isn't counted as a fast success
+    objects = {object_id: (await client.get(f"/objects/{object_id}")).json() for object_id in object_ids}
+    member_sizes = {object_id: next(m["size"] for m in obj["contents"] if m["name"] == "phenoDataMatrix.csv") for object_id, obj in objects.items()}
+    results.append(await _measure("download", size, concurrency, [get(f"/files/{i}", expected_size=objects[i]["size"]) for i in ids]))
+    results.append(await _measure("download_range", size, concurrency, [get(f"/files/{i}", headers={"range": "bytes=0-65535"}, expected_size=min(65536, objects[i]["size"]))
+                                                                           for i in ids]))
+    results.append(await _measure("member", size, concurrency, [get(f"/files/{i}/phenoDataMatrix.csv", expected_size=member_sizes[i]) for i in ids]))
+    results.append(await _measure("objects", size, concurrency, [get(f"/objects/{i}") for i in ids]))
+    bulk = json.dumps({"bulk_object_ids": object_ids}).encode()
+    results.append(await _measure("objects_bulk", size, concurrency, [lambda: client.post_json("/objects", bulk) for _ in range(max(1, n // 10))]))
+    results.append(await _measure("search", size, concurrency, [get(f"/search/{SUBMITTER_ID}", "limit=100&fields=object_id,status") for _ in range(n)]))
+    results.append(await _measure("matrix_slice", size, concurrency,
+                                  [get(f"/objects/{i}/matrix", "member=geneBySampleMatrix.csv&rows=0:100&cols=0:10") for i in ids]))
+    return results
+
+
+def _git_version():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def _run(args, app_module):
+    client = ASGIClient(app_module.app)
+    await app_module.app.router.startup()
+    results = []
+    try:
+        seed = 0
+        for size in args.sizes:
+            base_zip = dataset_zip(**SIZES[size])
+            n = args.requests or DEFAULT_REQUESTS[size]
+            for concurrency in args.concurrency:
+                results.extend(await _bench_size(client, size, concurrency, n, base_zip, seed))
+                seed += n
+    finally:
+        if args.mongo_uri is not None:
+            app_module.mongo_uploads.client.drop_database(app_module.mongo_uploads.config.DATABASE)
+        await app_module.app.router.shutdown()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the upload provider in-process")
+    parser.add_argument("--sizes", default="small,medium", help=f"comma-separated dataset sizes, from {', '.join(SIZES)}")
+    parser.add_argument("--concurrency", default="1,8", help="comma-separated numbers of requests in flight")
+    parser.add_argument("--requests", type=int, default=None, help="requests per scenario (default depends on size)")
+    parser.add_argument("--mongo-uri", default=None, help="use this mongod (a throwaway database is created) instead of mongomock")
+    parser.add_argument("--storage", default="local", choices=["local", "s3"], help="storage backend; s3 uses an in-process moto bucket unless --s3-endpoint-url is given")
+    parser.add_argument("--s3-endpoint-url", default=None, help="with --storage s3: an S3-compatible server (e.g. MinIO) to create a throwaway bucket on")
+    parser.add_argument("--keep-local", default=True, action=argparse.BooleanOptionalAction, help="with --storage s3: keep local copies of offloaded blobs")
+    parser.add_argument("--log-level", default="WARNING", help="the app's LOG_LEVEL while benchmarking")
+    parser.add_argument("--out", default=None, help="write the JSON results here instead of stdout")
+    args = parser.parse_args(argv)
+    args.sizes = [s for s in args.sizes.split(",") if s]
+    args.concurrency = [int(c) for c in args.concurrency.split(",") if c]
+    unknown = set(args.sizes) - set(SIZES)
+    if unknown:
+        parser.error(f"unknown sizes: {sorted(unknown)}")
+
+    with tempfile.TemporaryDirectory(prefix="fuse-bench-") as work_dir:
+        app_module = _load_app(args, work_dir)
+        results = asyncio.run(_run(args, app_module))
+
+    report = {
+        "version": _git_version(),
+        "api_version": app_module.g_api_version,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "mongo": "mongod" if args.mongo_uri is not None else "mongomock",
+        "storage": args.storage if args.storage == "local" else args.s3_endpoint_url or "moto",
+        "created_time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "sizes": {size: SIZES[size] for size in args.sizes},
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.out is not None:
+        with open(args.out, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
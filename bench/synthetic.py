@@ -0,0 +1,52 @@
+import io
+import zipfile
+
+import numpy as np
+
+# shaped like t/input: geneBySampleMatrix.csv has no header, an Entrez gene id per row and one
+# column per sample; phenoDataMatrix.csv has a header and one row per sample
+SIZES = {
+    "small": {"genes": 2500, "samples": 32},
+    "medium": {"genes": 20000, "samples": 100},
+    "large": {"genes": 20000, "samples": 1000},
+}
+
+_PHENOTYPE_HEADER = "participant_id,study_time_collected,study_time_collected_unit,cohort,cohort_type,biosample_accession,exposure_material_reported,exposure_process_preferred\n"
+
+
+def expression_csv(genes: int, samples: int, seed: int = 0) -> bytes:
+    rng = np.random.default_rng(seed)
+    values = rng.gamma(shape=1.5, scale=4.0, size=(genes, samples)).round(7)
+    ids = np.sort(rng.choice(np.arange(1, 10 * genes), size=genes, replace=False))
+    out = io.StringIO()
+    np.savetxt(out, np.column_stack([ids, values]), delimiter=",", fmt=["%d"] + ["%.7g"] * samples)
+    return out.getvalue().encode()
+
+
+def phenotype_csv(samples: int, seed: int = 0) -> bytes:
+    rng = np.random.default_rng(seed)
+    lines = [_PHENOTYPE_HEADER]
+    for i in range(samples):
+        lines.append(f"SUB{200000 + i}.{seed},{int(rng.integers(0, 30))},Days,healthy adults,healthy adults_Whole blood,BS{1000000 + i},YF-Vax,vaccination\n")
+    return "".join(lines).encode()
+
+
+def dataset_zip(genes: int, samples: int, seed: int = 0) -> bytes:
+    '''
+    A zip laid out like t/input/for-testing.zip. Different seeds give different bytes, so uploads don't dedupe.
+    '''
+    out = io.BytesIO()
+    with zipfile.ZipFile(out, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr("for-testing/geneBySampleMatrix.csv", expression_csv(genes, samples, seed))
+        archive.writestr("for-testing/phenoDataMatrix.csv", phenotype_csv(samples, seed))
+    return out.getvalue()
+
+
+def unique_variant(zip_bytes: bytes, n: int) -> bytes:
+    '''
+    The same archive with a different zip comment, i.e. identical members but a distinct sha-256;
+    much cheaper than compressing a new archive per upload. Expects an archive without a comment.
+    '''
+    comment = f"bench-{n}".encode()
+    assert zip_bytes[-2:] == b"\x00\x00", "archive already has a comment"
+    return zip_bytes[:-2] + len(comment).to_bytes(2, "little") + comment
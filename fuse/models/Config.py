@@ -1,4 +1,5 @@
 import os
+from typing import List
 
 from pydantic import BaseModel
 
@@ -7,26 +8,252 @@ class LogConfig(BaseModel):
     """Logging configuration to be set for the server"""
 
     LOGGER_NAME: str = "fuse-provider-upload"
-    LOG_FORMAT: str = "%(levelprefix)s | %(asctime)s | %(funcName)s | %(message)s"
-    LOG_LEVEL: str = os.getenv("LOG_LEVEL", "DEBUG")
+    LOG_FORMAT: str = "%(levelprefix)s | %(asctime)s | %(request_id)s | %(funcName)s | %(message)s"
+    LOG_LEVEL: str = os.getenv("LOG_LEVEL", "INFO")
+    # one JSON object per line (time, level, func, message, request_id and extra fields); false for LOG_FORMAT text
+    LOG_JSON: bool = os.getenv("LOG_JSON", "true").lower() in ("1", "true", "yes")
+    # records waiting for the writer thread; when it is full, records are dropped (and counted) rather than blocking requests
+    LOG_QUEUE_SIZE: int = int(os.getenv("LOG_QUEUE_SIZE", 10000))
+    # INFO/DEBUG records per second let through from each logging call site, after a burst of LOG_RATE_BURST; 0 turns this off
+    LOG_RATE_LIMIT: float = float(os.getenv("LOG_RATE_LIMIT", 20))
+    LOG_RATE_BURST: int = int(os.getenv("LOG_RATE_BURST", 100))
+    # documents and lists longer than this are summarized in log messages
+    LOG_MAX_CHARS: int = int(os.getenv("LOG_MAX_CHARS", 1000))
 
     # Logging config
     version = 1
     disable_existing_loggers = False
-    formatters = {
-        "default": {
-            "()": "uvicorn.logging.DefaultFormatter",
-            "fmt": LOG_FORMAT,
-            "datefmt": "%Y-%m-%d %H:%M:%S",
-        },
-    }
     handlers = {
         "default": {
-            "formatter": "default",
-            "class": "logging.StreamHandler",
+            "()": "fuse.utils.logs.queue_handler",
             "stream": "ext://sys.stderr",
+            "json_format": LOG_JSON,
+            "fmt": LOG_FORMAT,
+            "datefmt": "%Y-%m-%d %H:%M:%S",
+            "queue_size": LOG_QUEUE_SIZE,
+            "rate": LOG_RATE_LIMIT,
+            "burst": LOG_RATE_BURST,
         },
     }
+    # uvicorn's own loggers go through the same queue, so access logs are structured and rate-limited too
     loggers = {
         "fuse-provider-upload": {"handlers": ["default"], "level": LOG_LEVEL},
+        "uvicorn": {"handlers": ["default"], "level": "INFO", "propagate": False},
+        "uvicorn.access": {"handlers": ["default"], "level": "INFO", "propagate": False},
     }
+
+
+class UploadConfig(BaseModel):
+    """Streaming ingest configuration for /submit"""
+
+    CHUNK_SIZE: int = int(os.getenv("UPLOAD_CHUNK_SIZE", 1024 * 1024))
+    # checksums always computed while the upload streams to disk, in addition to any the submitter supplies
+    CHECKSUM_TYPES: List[str] = ["sha-256", "md5"]
+    # /submit/batch: files written to the blob store at once, and files accepted per request
+    BATCH_CONCURRENCY: int = int(os.getenv("UPLOAD_BATCH_CONCURRENCY", 8))
+    BATCH_MAX_FILES: int = int(os.getenv("UPLOAD_BATCH_MAX_FILES", 1000))
+
+
+class MongoConfig(BaseModel):
+    """MongoDB connection pool and access-layer configuration"""
+
+    CLIENT: str = os.getenv("MONGO_CLIENT")
+    DATABASE: str = os.getenv("MONGO_DATABASE", "test")
+    MAX_POOL_SIZE: int = int(os.getenv("MONGO_MAX_POOL_SIZE", 50))
+    MIN_POOL_SIZE: int = int(os.getenv("MONGO_MIN_POOL_SIZE", 0))
+    # threads available for running pymongo calls off the event loop; keep <= MAX_POOL_SIZE
+    EXECUTOR_WORKERS: int = int(os.getenv("MONGO_EXECUTOR_WORKERS", 16))
+    SERVER_SELECTION_TIMEOUT_MS: int = int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", 5000))
+    CONNECT_TIMEOUT_MS: int = int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", 5000))
+    SOCKET_TIMEOUT_MS: int = int(os.getenv("MONGO_SOCKET_TIMEOUT_MS", 30000))
+    # 'majority' or a number of nodes
+    WRITE_CONCERN: str = os.getenv("MONGO_WRITE_CONCERN", "1")
+    WRITE_TIMEOUT_MS: int = int(os.getenv("MONGO_WRITE_TIMEOUT_MS", 10000))
+
+
+class ProfileConfig(BaseModel):
+    """Configuration for the streaming CSV profiler run on text uploads"""
+
+    # cells (rows x columns) parsed per chunk; bounds memory regardless of matrix shape
+    CHUNK_CELLS: int = int(os.getenv("PROFILE_CHUNK_CELLS", 1000000))
+    # per-column summaries are kept for at most this many columns so documents stay well under mongo's size limit
+    MAX_COLUMNS: int = int(os.getenv("PROFILE_MAX_COLUMNS", 1000))
+    SNIFF_BYTES: int = int(os.getenv("PROFILE_SNIFF_BYTES", 65536))
+
+
+class QueueConfig(BaseModel):
+    """Post-processing job queue configuration; uses rq when a redis host is configured, otherwise an in-process pool"""
+
+    REDIS_HOST: str = os.getenv("REDIS_HOST")
+    REDIS_PORT: int = int(os.getenv("REDIS_PORT", 6379))
+    BACKEND: str = os.getenv("UPLOAD_QUEUE", "rq" if os.getenv("REDIS_HOST") else "local")
+    QUEUE_NAME: str = os.getenv("UPLOAD_QUEUE_NAME", "fuse-provider-upload")
+    JOB_TIMEOUT: int = int(os.getenv("UPLOAD_JOB_TIMEOUT", 3600))
+    # worker threads for the in-process stand-in
+    LOCAL_WORKERS: int = int(os.getenv("UPLOAD_LOCAL_WORKERS", 4))
+
+
+class DownloadConfig(BaseModel):
+    """Configuration for serving object bytes from /files"""
+
+    CHUNK_SIZE: int = int(os.getenv("DOWNLOAD_CHUNK_SIZE", 1024 * 1024))
+    # requests asking for more ranges than this are served the whole object instead
+    MAX_RANGES: int = int(os.getenv("DOWNLOAD_MAX_RANGES", 16))
+    # open archives whose central directory is kept parsed for /files/{object_id}/{member}
+    ZIP_INDEX_CACHE_SIZE: int = int(os.getenv("ZIP_INDEX_CACHE_SIZE", 64))
+
+
+class ResumableConfig(BaseModel):
+    """Configuration for resumable, multi-part upload sessions"""
+
+    # parts are staged here until the session completes; kept apart from the */-data object directories
+    SESSION_DIR: str = os.getenv("RESUMABLE_SESSION_DIR", os.path.join(os.getenv("DATA_DIR", "/app/data"), ".sessions"))
+    # sessions not touched for this long, open or left completing by a worker that died, are expired by the reaper
+    SESSION_TTL: int = int(os.getenv("RESUMABLE_SESSION_TTL", 24 * 60 * 60))
+    REAP_INTERVAL: int = int(os.getenv("RESUMABLE_REAP_INTERVAL", 10 * 60))
+    MAX_PART_SIZE: int = int(os.getenv("RESUMABLE_MAX_PART_SIZE", 5 * 1024 * 1024 * 1024))
+    MAX_PARTS: int = int(os.getenv("RESUMABLE_MAX_PARTS", 10000))
+
+
+class BlobConfig(BaseModel):
+    """Content-addressed blob store; object bytes are stored once per distinct sha-256"""
+
+    BLOB_DIR: str = os.getenv("BLOB_DIR", os.path.join(os.getenv("DATA_DIR", "/app/data"), "blobs"))
+
+
+class ObjectCacheConfig(BaseModel):
+    """In-process cache of DRS object documents served by /objects and /files"""
+
+    MAX_ENTRIES: int = int(os.getenv("OBJECT_CACHE_SIZE", 4096))
+    # bounds how long another process's update or delete can go unnoticed; 0 disables the cache
+    TTL: float = float(os.getenv("OBJECT_CACHE_TTL", 30))
+
+
+class SearchConfig(BaseModel):
+    """Paging for /search/{submitter_id} and /admin/objects"""
+
+    DEFAULT_LIMIT: int = int(os.getenv("SEARCH_DEFAULT_LIMIT", 1000))
+    MAX_LIMIT: int = int(os.getenv("SEARCH_MAX_LIMIT", 10000))
+    # documents fetched from the cursor per round trip when streaming NDJSON
+    STREAM_BATCH_SIZE: int = int(os.getenv("SEARCH_STREAM_BATCH_SIZE", 500))
+
+
+class MatrixConfig(BaseModel):
+    """Memory-mappable sidecars built from CSV matrices, served by /objects/{object_id}/matrix"""
+
+    # a slice request may ask for at most this many cells
+    SLICE_MAX_CELLS: int = int(os.getenv("MATRIX_SLICE_MAX_CELLS", 10000000))
+    # open sidecars whose label indexes are kept in memory
+    CACHE_SIZE: int = int(os.getenv("MATRIX_CACHE_SIZE", 32))
+
+
+class DrsConfig(BaseModel):
+    """GA4GH DRS endpoint limits"""
+
+    # ids accepted by one bulk request (POST /objects, POST /objects/access)
+    MAX_BULK_REQUEST_LENGTH: int = int(os.getenv("DRS_MAX_BULK_REQUEST_LENGTH", 1000))
+
+
+class MetricsConfig(BaseModel):
+    """Prometheus metrics served at /metrics, and the slow-request log"""
+
+    ENABLED: bool = os.getenv("METRICS_ENABLED", "true").lower() in ("1", "true", "yes")
+    # requests slower than this many seconds are logged with their stage breakdown; 0 disables the log
+    SLOW_REQUEST_SECONDS: float = float(os.getenv("SLOW_REQUEST_SECONDS", 0))
+
+
+class CompressionConfig(BaseModel):
+    """Compression of object bytes at rest"""
+
+    # identity, gzip or zstd; objects can ask for another with ?compression=. Archives and already-compressed content are always stored as is
+    DEFAULT_ENCODING: str = os.getenv("UPLOAD_COMPRESSION", "identity")
+    GZIP_LEVEL: int = int(os.getenv("UPLOAD_GZIP_LEVEL", 6))
+    ZSTD_LEVEL: int = int(os.getenv("UPLOAD_ZSTD_LEVEL", 3))
+
+
+class ServerConfig(BaseModel):
+    """Process model and lifecycle of the API server (python main.py)"""
+
+    HOST: str = os.getenv("SERVER_HOST", "0.0.0.0")
+    PORT: int = int(os.getenv("SERVER_PORT", os.getenv("API_PORT", 8083)))
+    # worker processes sharing the listening socket; each has its own event loop, caches and mongo pool
+    WORKERS: int = int(os.getenv("SERVER_WORKERS", 1))
+    # development only: restart on code changes (forces a single worker)
+    RELOAD: bool = os.getenv("SERVER_RELOAD", "false").lower() in ("1", "true", "yes")
+    # on SIGTERM, readiness fails for this long before the listener closes, so load balancers stop routing here first
+    DRAIN_SECONDS: float = float(os.getenv("SERVER_DRAIN_SECONDS", 5))
+    # then in-flight requests get this long to finish before they are cut off and the shutdown hooks run
+    GRACEFUL_TIMEOUT: float = float(os.getenv("SERVER_GRACEFUL_TIMEOUT", 30))
+    # while mongo can't be reached at startup, retry this often (the worker stays alive but not ready)
+    CONNECT_RETRY_SECONDS: float = float(os.getenv("SERVER_CONNECT_RETRY_SECONDS", 5))
+    # readiness fails if a mongo ping takes longer than this
+    READY_TIMEOUT: float = float(os.getenv("SERVER_READY_TIMEOUT", 2))
+
+
+class StorageConfig(BaseModel):
+    """Where object bytes are kept: the local blob store only, or also an S3-compatible bucket (AWS, MinIO, ...)"""
+
+    # local or s3
+    BACKEND: str = os.getenv("STORAGE_BACKEND", "local")
+    # objects stored before the blob store existed, one {object_id}-data directory each
+    DATA_DIR: str = os.getenv("DATA_DIR", "/app/data")
+    # base of the URLs handed out in access_methods for fetching bytes through this API
+    PUBLIC_URL: str = os.getenv("STORAGE_PUBLIC_URL", f"http://{os.getenv('HOST_NAME', 'localhost')}:{os.getenv('API_PORT', 8083)}")
+    S3_BUCKET: str = os.getenv("S3_BUCKET", "fuse-provider-upload")
+    # keys are {S3_PREFIX}{blob path relative to BLOB_DIR}
+    S3_PREFIX: str = os.getenv("S3_PREFIX", "blobs/")
+    # e.g. http://minio:9000; unset for AWS
+    S3_ENDPOINT_URL: str = os.getenv("S3_ENDPOINT_URL")
+    S3_REGION: str = os.getenv("S3_REGION", "us-east-1")
+    # unset to use boto3's usual credential chain (environment, profile, instance role)
+    S3_ACCESS_KEY_ID: str = os.getenv("S3_ACCESS_KEY_ID")
+    S3_SECRET_ACCESS_KEY: str = os.getenv("S3_SECRET_ACCESS_KEY")
+    # path-style addressing is what MinIO and most other S3-compatible servers expect
+    S3_ADDRESSING_STYLE: str = os.getenv("S3_ADDRESSING_STYLE", "path")
+    # multipart transfers above this size, with this many parts in flight
+    S3_MULTIPART_THRESHOLD: int = int(os.getenv("S3_MULTIPART_THRESHOLD", 64 * 1024 * 1024))
+    S3_MAX_CONCURRENCY: int = int(os.getenv("S3_MAX_CONCURRENCY", 8))
+    # lifetime, in seconds, of the presigned URLs returned by /objects/{object_id}/access/{access_id}
+    PRESIGN_EXPIRES: int = int(os.getenv("S3_PRESIGN_EXPIRES", 3600))
+    # keep the local copy of a blob once it is in the bucket; if false it is fetched back only when needed (zip members)
+    KEEP_LOCAL: bool = os.getenv("STORAGE_KEEP_LOCAL", "true").lower() in ("1", "true", "yes")
+
+
+class ZipIndexConfig(BaseModel):
+    """Per-member indexing (size, checksums, MIME type, dimension) of zip objects, fanned out to a process pool"""
+
+    # worker processes shared by every indexing job in this process
+    WORKERS: int = int(os.getenv("ZIP_INDEX_WORKERS", os.cpu_count() or 1))
+    # archives whose members add up to less than this are indexed in the job's own thread, without the pool
+    INLINE_BYTES: int = int(os.getenv("ZIP_INDEX_INLINE_BYTES", 16 * 1024 * 1024))
+    # members are handed out in about this many batches per worker, balanced by size, so one huge member doesn't hold up the rest
+    BATCHES_PER_WORKER: int = int(os.getenv("ZIP_INDEX_BATCHES_PER_WORKER", 4))
+    # class_dataset_expression archives whose gene and phenotype matrices disagree on the samples fail; false only logs it
+    STRICT_PAIRING: bool = os.getenv("ZIP_INDEX_STRICT_PAIRING", "true").lower() in ("1", "true", "yes")
+
+
+class ReconcileConfig(BaseModel):
+    """Background reconciliation of the data volume and the uploads collection, and reclamation of deleted objects' bytes"""
+
+    ENABLED: bool = os.getenv("RECONCILE_ENABLED", "true").lower() in ("1", "true", "yes")
+    # seconds between full passes; deletes wake the reconciler to reclaim their bytes sooner
+    INTERVAL: float = float(os.getenv("RECONCILE_INTERVAL", 300))
+    # items (documents, files, blobs) looked at per pass, per kind of check; a big volume is covered over several passes
+    BATCH_SIZE: int = int(os.getenv("RECONCILE_BATCH_SIZE", 500))
+    # pacing: at most this many items a second, and none while this worker has more requests in flight than
+    # RECONCILE_MAX_IN_FLIGHT, for up to RECONCILE_MAX_DEFER seconds an item
+    OPS_PER_SECOND: float = float(os.getenv("RECONCILE_OPS_PER_SECOND", 50))
+    MAX_IN_FLIGHT: int = int(os.getenv("RECONCILE_MAX_IN_FLIGHT", 4))
+    MAX_DEFER: float = float(os.getenv("RECONCILE_MAX_DEFER", 60))
+    # files, directories and blobs younger than this are never taken for orphans (they may belong to an upload in progress)
+    GRACE_SECONDS: int = int(os.getenv("RECONCILE_GRACE_SECONDS", 60 * 60))
+    # objects still 'started' this long after they were created lost their processing job and are removed
+    STARTED_TTL: int = int(os.getenv("RECONCILE_STARTED_TTL", 24 * 60 * 60))
+    # optional: 'failed' objects are removed this long after they were created; 0 keeps them
+    FAILED_RETENTION: int = int(os.getenv("RECONCILE_FAILED_RETENTION", 0))
+    # optional: finished objects are removed this long after they were created; 0 keeps them
+    RETENTION: int = int(os.getenv("RECONCILE_RETENTION", 0))
+    # optional: bytes of finished objects each submitter may keep; beyond it, their oldest objects are removed. 0 for no quota
+    SUBMITTER_QUOTA_BYTES: int = int(os.getenv("RECONCILE_SUBMITTER_QUOTA_BYTES", 0))
+    # with several workers (or replicas), only the holder of this lease reconciles
+    LEASE_SECONDS: int = int(os.getenv("RECONCILE_LEASE_SECONDS", 15 * 60))
@@ -1,4 +1,4 @@
-from typing import List
+from typing import List, Optional
 
 from fuse_cdm.main import Checksums, Contents, AccessMethods, as_form
 from pydantic import BaseModel
@@ -43,3 +43,18 @@ class ProviderExampleObject(BaseModel):  # xxx customize this code
     ]
     description: str = "string"
     aliases: List[str] = ["string"]
+
+
+class BulkObjectIds(BaseModel):
+    bulk_object_ids: List[str]
+    passports: Optional[List[str]] = None
+
+
+class BulkObjectAccessId(BaseModel):
+    bulk_object_id: str
+    bulk_access_ids: List[str]
+
+
+class BulkObjectAccessIds(BaseModel):
+    bulk_object_access_ids: List[BulkObjectAccessId]
+    passports: Optional[List[str]] = None
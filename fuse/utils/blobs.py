@@ -0,0 +1,230 @@
+import datetime
+import logging
+import os
+import shutil
+import uuid
+from collections import Counter
+
+from pymongo import UpdateOne
+from starlette.concurrency import run_in_threadpool
+
+from fuse.models.Config import BlobConfig, StorageConfig
+from fuse.utils.compression import IDENTITY, SUFFIXES
+from fuse.utils.db import UploadsCollection
+from fuse.utils.ingest import StreamingDigest
+from fuse.utils.storage import make_storage
+
+logger = logging.getLogger("fuse-provider-upload")
+
+
+def _sha256(digest: StreamingDigest):
+    return {c["type"]: c["checksum"] for c in digest.checksums}["sha-256"]
+
+
+def derived_path(blob_path: str):
+    '''
+    Directory for files derived from a blob's bytes (e.g., matrix sidecars); shared by every object
+    referencing the blob and removed along with it.
+    '''
+    return f"{blob_path}.d"
+
+
+class BlobStore:
+    '''
+    Content-addressed storage for object bytes, keyed by the sha-256 computed while the upload streams in.
+
+    Byte-identical uploads share one file under BLOB_DIR; the `blobs` collection counts how many objects
+    reference each one, and the bytes are only removed when the last reference is released. New uploads
+    are written to an `.incoming` directory on the same filesystem and renamed into place, so a blob
+    path never exposes a partially written file.
+
+    A blob is stored with one encoding (see fuse.utils.compression), fixed by whichever upload created it;
+    its path carries the encoding's suffix, and size and checksums are always those of the logical bytes.
+
+    With a remote storage backend (see fuse.utils.storage), processed blobs are also offloaded to the bucket
+    under the same relative path, and the local copy becomes a cache that may be dropped (KEEP_LOCAL) and
+    fetched back on demand.
+    '''
+
+    def __init__(self, blobs: UploadsCollection, config: BlobConfig = None, storage_config: StorageConfig = None):
+        self.blobs = blobs
+        self.config = config if config is not None else BlobConfig()
+        self.storage_config = storage_config if storage_config is not None else StorageConfig()
+        self.storage = make_storage(self.config.BLOB_DIR, self.storage_config)
+        self.incoming_dir = os.path.join(self.config.BLOB_DIR, ".incoming")
+        self.trash_dir = os.path.join(self.config.BLOB_DIR, ".trash")
+        os.makedirs(self.incoming_dir, exist_ok=True)
+        os.makedirs(self.trash_dir, exist_ok=True)
+
+    def blob_path(self, sha256: str):
+        return os.path.join(self.config.BLOB_DIR, sha256[:2], sha256)
+
+    def stored_path(self, sha256: str, encoding: str = IDENTITY):
+        return self.blob_path(sha256) + SUFFIXES[encoding]
+
+    def storage_key(self, sha256: str, encoding: str = IDENTITY):
+        return os.path.relpath(self.stored_path(sha256, encoding), self.config.BLOB_DIR)
+
+    def incoming_path(self):
+        return os.path.join(self.incoming_dir, uuid.uuid4().hex)
+
+    def legacy_dir(self, object_id: str):
+        '''
+        The directory of an object stored before the blob store existed.
+        '''
+        return os.path.join(self.storage_config.DATA_DIR, f"{object_id}-data")
+
+    async def commit(self, incoming_path: str, digest: StreamingDigest, encoding: str = IDENTITY):
+        '''
+        Take a reference on the blob for the bytes at incoming_path (written with encoding) and move them into place.
+        If the blob already exists with the same encoding its content is identical, so replacing it is harmless, and
+        doing so unconditionally means a concurrent release() can never leave a referenced blob without bytes.
+
+        Deduplication takes precedence over the requested encoding: if the blob exists with another encoding, the new
+        bytes are dropped and the object shares the stored ones. Returns the sha-256 and the blob's encoding, which is
+        the encoding the object is actually stored with (its blob_encoding) and may differ from the one asked for.
+        '''
+        sha256 = _sha256(digest)
+        blob = await self.blobs.find_one_and_update({"_id": sha256},
+                                                    {"$inc": {"refcount": 1},
+                                                     "$set": {"touched_time": datetime.datetime.utcnow()},
+                                                     "$setOnInsert": {"size": digest.size, "encoding": encoding,
+                                                                      "created_time": datetime.datetime.utcnow()}},
+                                                    upsert=True)
+        blob_encoding = blob.get("encoding", IDENTITY)
+        if blob_encoding != encoding:
+            logger.info(f"blob {sha256} is already stored as {blob_encoding}, sharing it rather than storing it again as {encoding}")
+        await run_in_threadpool(self._move_into_place, incoming_path, sha256, encoding, blob_encoding)
+        logger.info(f"blob {sha256} committed, encoding={blob_encoding}, refcount={blob['refcount']}")
+        return sha256, blob_encoding
+
+    async def commit_many(self, stored: list):
+        '''
+        commit() for a list of (incoming_path, digest, encoding), taking all the references in one bulk write.
+        Returns (sha-256, blob encoding) for each, in order; as with commit(), an existing blob keeps its encoding.
+        '''
+        sha256s = [_sha256(digest) for _, digest, _ in stored]
+        inserted = {sha256: {"size": digest.size, "encoding": encoding} for sha256, (_, digest, encoding) in reversed(list(zip(sha256s, stored)))}
+        now = datetime.datetime.utcnow()
+        encodings = {}
+        if len(stored) > 0:
+            await self.blobs.bulk_write([UpdateOne({"_id": sha256},
+                                                   {"$inc": {"refcount": references},
+                                                    "$set": {"touched_time": now},
+                                                    "$setOnInsert": {**inserted[sha256], "created_time": now}},
+                                                   upsert=True)
+                                         for sha256, references in Counter(sha256s).items()], ordered=False)
+            encodings = {blob["_id"]: blob.get("encoding", IDENTITY)
+                         for blob in await self.blobs.find({"_id": {"$in": list(inserted)}}, {"encoding": 1})}
+        for (incoming_path, _, encoding), sha256 in zip(stored, sha256s):
+            await run_in_threadpool(self._move_into_place, incoming_path, sha256, encoding, encodings[sha256])
+        logger.info(f"{len(stored)} blobs committed")
+        return [(sha256, encodings[sha256]) for sha256 in sha256s]
+
+    def _move_into_place(self, incoming_path: str, sha256: str, encoding: str, blob_encoding: str):
+        # blocking; run it in the threadpool
+        if encoding != blob_encoding:
+            os.remove(incoming_path)
+            return
+        path = self.stored_path(sha256, encoding)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(incoming_path, path)
+
+    async def release(self, sha256: str, token=None):
+        '''
+        Drop a reference; returns True if that was the last one and the bytes were freed. A release made with a token
+        is only counted once, however often it is retried (e.g., by the reconciler after a crash).
+        '''
+        query = {"_id": sha256}
+        update = {"$inc": {"refcount": -1}, "$set": {"touched_time": datetime.datetime.utcnow()}}
+        if token is not None:
+            query["released_by"] = {"$ne": token}
+            update["$push"] = {"released_by": token}
+        blob = await self.blobs.find_one_and_update(query, update)
+        if blob is None or blob["refcount"] > 0:
+            return False
+        return await self._free(sha256, blob)
+
+    async def forget_release(self, sha256: str, token):
+        '''
+        Once the caller has recorded that the release with token is done, the blob needn't remember it.
+        '''
+        await self.blobs.update_one({"_id": sha256}, {"$pull": {"released_by": token}})
+
+    async def recount(self, sha256: str, seen: dict, references: int):
+        '''
+        Correct a blob's reference count to the number of objects actually referencing it (the reconciler's count),
+        freeing it if that is none. Only if the blob is still as seen when counting: any commit or release since
+        touches it, and the count is left alone.
+        '''
+        blob = await self.blobs.find_one_and_update({"_id": sha256, "refcount": seen["refcount"], "touched_time": seen.get("touched_time")},
+                                                    {"$set": {"refcount": references, "touched_time": datetime.datetime.utcnow()}})
+        if blob is None:
+            return False
+        logger.warning(f"blob {sha256} reference count corrected to {references}")
+        if references > 0:
+            return False
+        return await self._free(sha256, blob)
+
+    async def _free(self, sha256: str, blob: dict):
+        if (await self.blobs.delete_one({"_id": sha256, "refcount": {"$lte": 0}})).deleted_count != 1:
+            return False
+        encoding = blob.get("encoding", IDENTITY)
+        path = self.stored_path(sha256, encoding)
+        if await run_in_threadpool(os.path.exists, path):
+            trash_path = os.path.join(self.trash_dir, f"{sha256}.{uuid.uuid4().hex}")
+            await run_in_threadpool(os.replace, path, trash_path)
+            # an identical upload may have taken a new reference while this one was being freed
+            if await self.blobs.find_one({"_id": sha256}) is not None and not await run_in_threadpool(os.path.exists, path):
+                await run_in_threadpool(os.replace, trash_path, path)
+                return False
+            await run_in_threadpool(os.remove, trash_path)
+        elif await self.blobs.find_one({"_id": sha256}) is not None:
+            return False
+        if self.storage.remote and blob.get("offloaded"):
+            await run_in_threadpool(self.storage.delete, self.storage_key(sha256, encoding))
+        await run_in_threadpool(shutil.rmtree, derived_path(path), True)
+        logger.info(f"blob {sha256} freed")
+        return True
+
+    def offload(self, sha256: str, encoding: str = IDENTITY):
+        '''
+        Copy a blob to the storage backend, if it is a remote one and the blob isn't there already, and drop the local
+        copy unless KEEP_LOCAL. Returns whether the blob is in the backend. Synchronous: runs on a queue worker.
+        '''
+        if not self.storage.remote:
+            return False
+        collection = self.blobs.collection
+        path = self.stored_path(sha256, encoding)
+        if collection.find_one({"_id": sha256, "offloaded": True}, {"_id": 1}) is None:
+            self.storage.put(path, self.storage_key(sha256, encoding))
+            collection.update_one({"_id": sha256}, {"$set": {"offloaded": True}})
+            logger.info(f"blob {sha256} offloaded")
+        if not self.storage_config.KEEP_LOCAL:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        return True
+
+    def ensure_local(self, sha256: str, encoding: str = IDENTITY):
+        '''
+        The local path of a blob, fetching it back from the storage backend first if the local copy was dropped.
+        Synchronous; call it off the event loop.
+        '''
+        path = self.stored_path(sha256, encoding)
+        if os.path.exists(path) or not self.storage.remote:
+            return path
+        incoming_path = self.incoming_path()
+        self.storage.fetch(self.storage_key(sha256, encoding), incoming_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(incoming_path, path)
+        logger.info(f"blob {sha256} fetched from storage")
+        return path
+
+    def access_url(self, sha256: str, encoding: str = IDENTITY, file_name: str = None, media_type: str = None):
+        '''
+        A presigned URL for the blob's stored bytes in the storage backend, or None if it has no such URLs.
+        '''
+        return self.storage.presigned_url(self.storage_key(sha256, encoding), file_name, media_type,
+                                          encoding if encoding != IDENTITY else None)
@@ -0,0 +1,59 @@
+import copy
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from fuse.models.Config import ObjectCacheConfig
+
+logger = logging.getLogger("fuse-provider-upload")
+
+# documents in these states are still being written by the upload path or a queue worker, possibly in
+# another process, so they are never cached
+UNCACHEABLE_STATUSES = {"started"}
+
+
+class ObjectCache:
+    '''
+    Bounded LRU of DRS object documents keyed by object_id, each entry expiring after TTL seconds.
+
+    Only objects that have settled ('finished' or 'failed') are cached: their metadata only changes
+    again through an update or delete in this process, which must call invalidate(). The TTL bounds
+    how stale an entry can get when another API process makes that change.
+    '''
+
+    def __init__(self, config: ObjectCacheConfig = None):
+        self.config = config if config is not None else ObjectCacheConfig()
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, object_id: str):
+        '''
+        Returns a copy of the cached document, or None on a miss.
+        '''
+        with self._lock:
+            cached = self._entries.get(object_id)
+            if cached is None:
+                return None
+            if cached[0] < time.monotonic():
+                del self._entries[object_id]
+                return None
+            self._entries.move_to_end(object_id)
+            return copy.deepcopy(cached[1])
+
+    def put(self, object_id: str, document: dict):
+        if self.config.TTL <= 0 or self.config.MAX_ENTRIES <= 0 or document.get("status") in UNCACHEABLE_STATUSES:
+            return
+        with self._lock:
+            self._entries[object_id] = (time.monotonic() + self.config.TTL, copy.deepcopy(document))
+            self._entries.move_to_end(object_id)
+            while len(self._entries) > self.config.MAX_ENTRIES:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, object_id: str):
+        with self._lock:
+            self._entries.pop(object_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
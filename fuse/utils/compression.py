@@ -0,0 +1,179 @@
+import gzip
+import io
+import zlib
+
+from fuse.models.Config import CompressionConfig
+
+g_compression_config = CompressionConfig()
+
+IDENTITY = "identity"
+GZIP = "gzip"
+ZSTD = "zstd"
+ENCODINGS = (IDENTITY, GZIP, ZSTD)
+
+# appended to the blob path of a blob stored with that encoding
+SUFFIXES = {IDENTITY: "", GZIP: ".gz", ZSTD: ".zst"}
+
+# content that is already compressed, or that is read by random access (zip members), is always stored as is
+_COMPRESSED_MAGIC = (
+    b"PK\x03\x04", b"PK\x05\x06",  # zip
+    b"\x1f\x8b",  # gzip
+    b"\x28\xb5\x2f\xfd",  # zstd
+    b"BZh",  # bzip2
+    b"\xfd7zXZ\x00",  # xz
+    b"7z\xbc\xaf\x27\x1c",  # 7z
+    b"\x89PNG", b"\xff\xd8\xff",  # png, jpeg
+)
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ValueError("zstd requires the zstandard package")
+    return zstandard
+
+
+def _check(encoding: str):
+    if encoding not in ENCODINGS:
+        raise ValueError(f"unsupported encoding ({encoding}), expected one of {ENCODINGS}")
+
+
+def is_compressed(head: bytes):
+    '''
+    Whether content starting with head is an archive or already compressed, so compressing it again gains nothing.
+    '''
+    return head.startswith(_COMPRESSED_MAGIC)
+
+
+def choose_encoding(requested: str, head: bytes):
+    '''
+    The encoding to store an object with, given the one asked for (or the configured default) and its first bytes.
+    '''
+    if requested is None:
+        requested = g_compression_config.DEFAULT_ENCODING
+    _check(requested)
+    if requested != IDENTITY and is_compressed(head):
+        return IDENTITY
+    return requested
+
+
+class Encoder:
+    '''
+    Incremental compressor; identity passes bytes through.
+    '''
+
+    def __init__(self, encoding: str):
+        _check(encoding)
+        self.encoding = encoding
+        if encoding == GZIP:
+            self._obj = zlib.compressobj(g_compression_config.GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        elif encoding == ZSTD:
+            self._obj = _zstandard().ZstdCompressor(level=g_compression_config.ZSTD_LEVEL).compressobj()
+        else:
+            self._obj = None
+
+    def compress(self, data: bytes):
+        return self._obj.compress(data) if self._obj is not None else data
+
+    def flush(self):
+        return self._obj.flush() if self._obj is not None else b""
+
+
+class Decoder:
+    '''
+    Incremental decompressor that also accepts concatenated gzip members / zstd frames (e.g., bgzip output);
+    identity passes bytes through.
+    '''
+
+    def __init__(self, encoding: str):
+        _check(encoding)
+        self.encoding = encoding
+        if encoding == GZIP:
+            self._new = lambda: zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == ZSTD:
+            zstandard = _zstandard()
+            self._new = lambda: zstandard.ZstdDecompressor().decompressobj()
+        else:
+            self._new = None
+        self._obj = self._new() if self._new is not None else None
+        self._started = False
+
+    def decompress(self, data: bytes):
+        if self._obj is None:
+            return data
+        out = []
+        while data:
+            self._started = True
+            if self._obj.eof:
+                self._obj = self._new()
+            out.append(self._obj.decompress(data))
+            data = self._obj.unused_data if self._obj.eof else b""
+        return b"".join(out)
+
+    def finish(self):
+        '''
+        Raises ValueError if the compressed stream was empty or cut short.
+        '''
+        if self._obj is not None and not (self._started and self._obj.eof):
+            raise ValueError(f"incomplete {self.encoding} stream")
+
+
+def open_decoded(path: str, encoding: str, text: bool = False):
+    '''
+    A file object over the logical bytes of a file stored with encoding (text mode keeps line endings as stored).
+    '''
+    _check(encoding)
+    if encoding == GZIP:
+        f = gzip.open(path, "rb")
+    elif encoding == ZSTD:
+        f = _zstandard().open(path, "rb")
+    else:
+        f = open(path, "rb")
+    return io.TextIOWrapper(f, newline='') if text else f
+
+
+def iter_decoded(path: str, encoding: str, start: int = 0, end: int = None, chunk_size: int = 1024 * 1024):
+    '''
+    Yield the logical bytes [start, end] of a file stored with encoding; everything before start is decompressed and dropped.
+    '''
+    remaining = None if end is None else end - start + 1
+    with open_decoded(path, encoding) as f:
+        while start > 0:
+            skipped = len(f.read(min(chunk_size, start)))
+            if skipped == 0:
+                return
+            start -= skipped
+        while remaining is None or remaining > 0:
+            chunk = f.read(chunk_size if remaining is None else min(chunk_size, remaining))
+            if not chunk:
+                break
+            if remaining is not None:
+                remaining -= len(chunk)
+            yield chunk
+
+
+def accepts(accept_encoding: str, encoding: str):
+    '''
+    Whether an Accept-Encoding header allows encoding (q=0 excludes it; '*' matches anything not listed).
+    '''
+    if accept_encoding is None:
+        return False
+    listed = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        listed[name.strip().lower()] = q
+    if encoding in listed:
+        return listed[encoding] > 0
+    # x-gzip is an alias for gzip
+    if encoding == GZIP and "x-gzip" in listed:
+        return listed["x-gzip"] > 0
+    return listed.get("*", 0) > 0
@@ -0,0 +1,142 @@
+import asyncio
+import copy
+import functools
+import itertools
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pymongo
+import pymongo.errors
+from pymongo.write_concern import WriteConcern
+
+from fuse.models.Config import MongoConfig
+from fuse.utils.metrics import record_mongo_call
+
+logger = logging.getLogger("fuse-provider-upload")
+
+
+class UploadsCollection:
+    '''
+    Data-access layer for the uploads collection.
+
+    pymongo is synchronous, so every call from an endpoint is pushed onto a bounded thread pool
+    (MONGO_EXECUTOR_WORKERS) and awaited; a slow query then only ties up one executor thread
+    instead of the whole event loop; each call's latency, including the wait for a thread, is recorded
+    in the fuse_upload_mongo_seconds histogram. The synchronous collection is still exposed as
+    `collection` for code that runs outside the event loop (e.g., queue workers).
+    '''
+
+    def __init__(self, config: MongoConfig = None):
+        self.config = config if config is not None else MongoConfig()
+        logger.info(f"connecting to {self.config.CLIENT}")
+        self.client = pymongo.MongoClient(self.config.CLIENT,
+                                          maxPoolSize=self.config.MAX_POOL_SIZE,
+                                          minPoolSize=self.config.MIN_POOL_SIZE,
+                                          serverSelectionTimeoutMS=self.config.SERVER_SELECTION_TIMEOUT_MS,
+                                          connectTimeoutMS=self.config.CONNECT_TIMEOUT_MS,
+                                          socketTimeoutMS=self.config.SOCKET_TIMEOUT_MS)
+        self.db = self.client[self.config.DATABASE]
+        w = int(self.config.WRITE_CONCERN) if self.config.WRITE_CONCERN.isdigit() else self.config.WRITE_CONCERN
+        self.collection = self.db.get_collection("uploads", write_concern=WriteConcern(w=w, wtimeout=self.config.WRITE_TIMEOUT_MS))
+        self._executor = ThreadPoolExecutor(max_workers=self.config.EXECUTOR_WORKERS, thread_name_prefix="mongo")
+
+    def sibling(self, name: str):
+        '''
+        Access to another collection in the same database, sharing this client, connection pool and executor.
+        '''
+        other = copy.copy(self)
+        other.collection = self.db.get_collection(name, write_concern=self.collection.write_concern)
+        return other
+
+    def server_version(self):
+        return self.db.command({'buildInfo': 1})['version']
+
+    async def ping(self):
+        '''
+        Raises if the server can't be reached within the server selection timeout.
+        '''
+        return await self._run("ping", self.db.command, "ping")
+
+    async def _run(self, operation: str, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        try:
+            return await loop.run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+        finally:
+            record_mongo_call(self.collection.name, operation, time.perf_counter() - start)
+
+    def ensure_indexes(self, indexes):
+        '''
+        Create the given pymongo IndexModels if they don't exist yet; creating an existing index is a no-op.
+        Each is created on its own so that one failing (e.g., a unique index over data that already has
+        duplicates) is logged without keeping the others from being built.
+        '''
+        for index in indexes:
+            try:
+                name = self.collection.create_indexes([index])[0]
+                logger.info(f"index {self.collection.name}.{name} is in place")
+            except pymongo.errors.PyMongoError as e:
+                logger.error(f"could not create index {index.document} on {self.collection.name}: {e}")
+
+    async def find(self, filter: dict, projection: dict = None, limit: int = 0, sort: list = None):
+        '''
+        Returns the matching documents as a list; the cursor is drained on the executor thread.
+        '''
+        return await self._run("find", lambda: list(self.collection.find(filter, projection, limit=limit, sort=sort)))
+
+    async def iter_find(self, filter: dict, projection: dict = None, limit: int = 0, sort: list = None, batch_size: int = 500):
+        '''
+        Yields the matching documents as the cursor produces them, fetching batch_size per trip to the
+        executor, so a large result is never held in memory at once.
+        '''
+        cursor = self.collection.find(filter, projection, limit=limit, sort=sort, batch_size=batch_size)
+        try:
+            while True:
+                batch = await self._run("find", lambda: list(itertools.islice(cursor, batch_size)))
+                for document in batch:
+                    yield document
+                if len(batch) < batch_size:
+                    return
+        finally:
+            cursor.close()
+
+    async def find_one(self, filter: dict, projection: dict = None):
+        return await self._run("find_one", self.collection.find_one, filter, projection)
+
+    async def count(self, filter: dict):
+        num_matches = await self._run("count_documents", self.collection.count_documents, filter)
+        logger.info(f"found ({num_matches}) matches")
+        return num_matches
+
+    async def aggregate(self, pipeline: list):
+        return await self._run("aggregate", lambda: list(self.collection.aggregate(pipeline)))
+
+    async def insert_one(self, document: dict):
+        return await self._run("insert_one", self.collection.insert_one, document)
+
+    async def insert_many(self, documents: list, ordered: bool = True):
+        return await self._run("insert_many", self.collection.insert_many, documents, ordered=ordered)
+
+    async def update_one(self, filter: dict, update: dict):
+        return await self._run("update_one", self.collection.update_one, filter, update)
+
+    async def bulk_write(self, requests: list, ordered: bool = True):
+        '''
+        Any mix of pymongo write operations (UpdateOne, InsertOne, ...) in a single round trip.
+        '''
+        return await self._run("bulk_write", self.collection.bulk_write, requests, ordered=ordered)
+
+    async def delete_one(self, filter: dict):
+        return await self._run("delete_one", self.collection.delete_one, filter)
+
+    async def find_one_and_update(self, filter: dict, update: dict, projection: dict = None, upsert: bool = False):
+        '''
+        Atomic update returning the updated document, or None if nothing matched.
+        '''
+        return await self._run("find_one_and_update", self.collection.find_one_and_update, filter, update, projection,
+                               upsert=upsert, return_document=pymongo.ReturnDocument.AFTER)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self.client.close()
@@ -0,0 +1,54 @@
+import logging
+
+logger = logging.getLogger("fuse-provider-upload")
+
+
+class Health:
+    '''
+    Lifecycle state of this worker process, behind /health/live and /health/ready.
+
+    A worker is live as long as its event loop answers. It is ready once its startup hooks have run
+    and mongo has been reached (version detected, indexes in place), and stops being ready as soon
+    as it starts draining for shutdown, while it still finishes the requests it has.
+
+    It also counts the requests it is serving, so background work (the reconciler) can stay out of their way.
+    '''
+
+    def __init__(self):
+        self.started = False
+        self.database = False
+        self.draining = False
+        self.in_flight = 0
+
+    def ready(self):
+        return self.started and self.database and not self.draining
+
+    def checks(self):
+        return {"started": self.started, "database": self.database, "draining": self.draining}
+
+    def begin_drain(self):
+        if not self.draining:
+            logger.info("draining: readiness now fails")
+        self.draining = True
+
+
+# one per process; the server and the app both use it
+g_health = Health()
+
+
+class InFlightMiddleware:
+    '''
+    Keeps g_health.in_flight up to date.
+    '''
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        g_health.in_flight += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            g_health.in_flight -= 1
@@ -0,0 +1,143 @@
+import hashlib
+import logging
+import time
+
+import aiofiles
+import magic
+
+from fuse.models.Config import UploadConfig
+from fuse.utils.compression import IDENTITY, Decoder, Encoder, choose_encoding, open_decoded
+from fuse.utils.metrics import record_stage
+
+logger = logging.getLogger("fuse-provider-upload")
+
+g_upload_config = UploadConfig()
+
+# DRS checksum type names -> hashlib constructor names
+_HASHLIB_NAMES = {
+    "sha-256": "sha256",
+    "sha-512": "sha512",
+    "sha-1": "sha1",
+    "md5": "md5",
+}
+
+
+class StreamingDigest:
+    '''
+    Accumulates size and checksums of a byte stream, so they are computed in the same pass that writes it.
+    '''
+
+    def __init__(self, checksum_types=None):
+        if checksum_types is None:
+            checksum_types = g_upload_config.CHECKSUM_TYPES
+        self._hashes = {}
+        for checksum_type in checksum_types:
+            hashlib_name = _HASHLIB_NAMES.get(checksum_type)
+            if hashlib_name is None:
+                logger.warning(f"unsupported checksum type ({checksum_type}), skipping")
+                continue
+            self._hashes[checksum_type] = hashlib.new(hashlib_name)
+        self.size = 0
+
+    def update(self, chunk: bytes):
+        for h in self._hashes.values():
+            h.update(chunk)
+        self.size += len(chunk)
+
+    @property
+    def checksums(self):
+        return [{"checksum": h.hexdigest(), "type": checksum_type} for checksum_type, h in self._hashes.items()]
+
+    def verify(self, supplied_checksums):
+        '''
+        Compare client-supplied checksums against the ones computed while streaming.
+        Raises ValueError on the first mismatch; types we can't compute are ignored.
+        '''
+        computed = {c["type"]: c["checksum"] for c in self.checksums}
+        for supplied in supplied_checksums or []:
+            checksum_type = supplied["type"]
+            if checksum_type not in computed:
+                logger.warning(f"no computed checksum of type ({checksum_type}) to verify against")
+                continue
+            if supplied["checksum"].lower() != computed[checksum_type]:
+                raise ValueError(f"{checksum_type} checksum mismatch: supplied={supplied['checksum']}, computed={computed[checksum_type]}")
+
+
+def checksum_types_for(supplied_checksums):
+    '''
+    Default checksum types plus any additional supported types the submitter sent, preserving order.
+    '''
+    # sha-256 is always computed: stored bytes are addressed by it
+    checksum_types = list(dict.fromkeys(["sha-256"] + g_upload_config.CHECKSUM_TYPES))
+    for supplied in supplied_checksums or []:
+        if supplied["type"] not in checksum_types and supplied["type"] in _HASHLIB_NAMES:
+            checksum_types.append(supplied["type"])
+    return checksum_types
+
+
+async def stream_to_file(client_file, file_path: str, digest: StreamingDigest, chunk_size: int = None,
+                         content_encoding: str = IDENTITY, storage_encoding: str = None):
+    '''
+    Copy an UploadFile to file_path in fixed-size chunks, feeding every chunk through digest.
+    Memory use is bounded by chunk_size regardless of the size of the upload. Time spent reading
+    the body, hashing, (de)compressing and writing is recorded as separate stages.
+
+    The upload may itself be compressed (content_encoding); size and checksums are always those of
+    the decompressed, logical bytes. They are stored with storage_encoding (or the configured default),
+    unless they turn out to be an archive or already compressed; if that is the encoding they arrived
+    in, they are written as received. Returns the digest and the encoding the file was stored with.
+    '''
+    if chunk_size is None:
+        chunk_size = g_upload_config.CHUNK_SIZE
+    timings = {"body_read": 0.0, "checksum": 0.0, "codec": 0.0, "disk_write": 0.0}
+    decoder = Decoder(content_encoding)
+    encoder = None
+    # chunks held back until the first logical bytes show how to store them
+    pending = []
+    async with aiofiles.open(file_path, 'wb') as out_file:
+        async def write(chunk, data):
+            t = time.perf_counter()
+            out = chunk if encoder.encoding == content_encoding else encoder.compress(data)
+            timings["codec"] += time.perf_counter() - t
+            t = time.perf_counter()
+            await out_file.write(out)
+            timings["disk_write"] += time.perf_counter() - t
+
+        while True:
+            t0 = time.perf_counter()
+            chunk = await client_file.read(chunk_size)
+            t1 = time.perf_counter()
+            timings["body_read"] += t1 - t0
+            if not chunk:
+                break
+            data = decoder.decompress(chunk)
+            t2 = time.perf_counter()
+            timings["codec"] += t2 - t1
+            digest.update(data)
+            timings["checksum"] += time.perf_counter() - t2
+            if encoder is None:
+                pending.append((chunk, data))
+                if len(data) == 0:
+                    continue
+                encoder = Encoder(choose_encoding(storage_encoding, data))
+                for held in pending:
+                    await write(*held)
+                pending = []
+            else:
+                await write(chunk, data)
+        decoder.finish()
+        if encoder is None:
+            # nothing but compression framing, or nothing at all
+            encoder = Encoder(IDENTITY)
+        await out_file.write(encoder.flush())
+    for name, seconds in timings.items():
+        record_stage(name, seconds)
+    return digest, encoder.encoding
+
+
+def sniff_mime_type(file_path: str, encoding: str = IDENTITY):
+    '''
+    MIME type from the first chunk of a stored file's logical bytes; libmagic never needs more than that.
+    '''
+    with open_decoded(file_path, encoding) as f:
+        return magic.Magic(mime=True).from_buffer(f.read(g_upload_config.CHUNK_SIZE))
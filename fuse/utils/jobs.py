@@ -0,0 +1,257 @@
+import contextvars
+import datetime
+import logging
+import os
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from fuse_cdm.main import DataType
+
+from fuse.models.Config import QueueConfig, ZipIndexConfig
+from fuse.utils.blobs import BlobStore, derived_path
+from fuse.utils.compression import IDENTITY
+from fuse.utils.db import UploadsCollection
+from fuse.utils.ingest import sniff_mime_type
+from fuse.utils.logs import summarize
+from fuse.utils.matrix import build_matrices
+from fuse.utils.members import close_pool, index_zip
+from fuse.utils.metrics import stage
+from fuse.utils.profile import has_header, profile_csv
+from fuse.utils.storage import access_methods
+
+logger = logging.getLogger("fuse-provider-upload")
+
+g_zip_index_config = ZipIndexConfig()
+
+# the two members of a class_dataset_expression archive: genes x samples, and samples x phenotypes
+GENE_MATRIX = "geneBySampleMatrix.csv"
+PHENO_MATRIX = "phenoDataMatrix.csv"
+
+# rq workers import this module on their own, so the collection and blob store are created on first use;
+# the API process hands over its own with use_uploads() to avoid a second connection pool
+_uploads = None
+_blob_store = None
+
+
+def use_uploads(uploads: UploadsCollection, blob_store: BlobStore = None):
+    global _uploads, _blob_store
+    _uploads = uploads
+    _blob_store = blob_store
+
+
+def _get_uploads():
+    global _uploads
+    if _uploads is None:
+        _uploads = UploadsCollection()
+    return _uploads
+
+
+def _get_blob_store():
+    global _blob_store
+    if _blob_store is None:
+        _blob_store = BlobStore(_get_uploads().sibling("blobs"))
+    return _blob_store
+
+
+def _offload(object_id: str, blob: str, encoding: str):
+    '''
+    Puts the blob in the storage backend, now that nothing left to do needs it on local disk, and returns
+    the object's access_methods. If the backend can't be reached the object is still served from the
+    local copy, so that is logged rather than failing the object.
+    '''
+    remote = False
+    if blob is not None:
+        try:
+            with stage("offload"):
+                remote = _get_blob_store().offload(blob, encoding)
+        except Exception:
+            logger.exception(f"offloading blob {blob} of {object_id} failed, it stays on local storage only")
+    return access_methods(object_id, remote)
+
+
+def _check_expression_pairing(members: dict):
+    '''
+    Problems with a class_dataset_expression archive, given its indexed members by base name: both matrices must be
+    there and agree on the samples, the gene matrix's columns being the phenotype matrix's rows. Sample ids are
+    compared when the gene matrix has a header; otherwise only the counts can be.
+    '''
+    missing = [name for name in (GENE_MATRIX, PHENO_MATRIX) if name not in members]
+    if len(missing) > 0:
+        return [f"missing {', '.join(missing)}"]
+    gene, pheno = members[GENE_MATRIX], members[PHENO_MATRIX]
+    samples = pheno["_row_labels"][1:] if has_header(pheno["_sample"]) else pheno["_row_labels"]
+    columns = gene["_header"][1:]
+    if len(columns) != len(samples):
+        return [f"{GENE_MATRIX} has {len(columns)} sample columns, {PHENO_MATRIX} has {len(samples)} sample rows"]
+    if has_header(gene["_sample"]) and set(columns) != set(samples):
+        return [f"sample ids of {GENE_MATRIX} and {PHENO_MATRIX} differ: {summarize(sorted(set(columns) ^ set(samples)))}"]
+    return []
+
+
+def _index_contents(object_id: str, file_path: str, drs_uri, data_type):
+    '''
+    The DRS contents of a zip object: one entry per file member, with its size, checksums, MIME type and dimension.
+    '''
+    expression = data_type == DataType.geneExpression
+    indexed = index_zip(file_path, row_labels_for=(PHENO_MATRIX,) if expression else ())
+    members = {}
+    contents_list = []
+    for member in indexed:
+        [path_head, subfile_name] = os.path.split(member["full_path"])
+        members.setdefault(subfile_name, member)
+        # full_path is format: archive_name/file_name
+        # use full_path to extract from archive, or to fetch it from /files/{object_id}/{full_path}
+        contents_list.append({"id": subfile_name, "name": subfile_name, "drs_uri": f"{drs_uri}/{subfile_name}", "contents": None,
+                              **{key: value for key, value in member.items() if not key.startswith("_")}})
+    if expression:
+        problems = _check_expression_pairing(members)
+        if len(problems) > 0:
+            message = f"{object_id} is not a valid {DataType.geneExpression.value} archive: {'; '.join(problems)}"
+            if g_zip_index_config.STRICT_PAIRING:
+                raise ValueError(message)
+            logger.warning(message)
+    return contents_list
+
+
+def _copy_from_twin(uploads, object_id: str, drs_uri, blob: str, encoding: str):
+    '''
+    Byte-identical uploads share a blob, so whatever was derived from one finished object's bytes
+    holds for this one too; only the member drs_uris and access methods need to point at the new object.
+    '''
+    twin = uploads.find_one({"blob": blob, "status": "finished", "object_id": {"$ne": object_id}},
+                            {"object_id": 1, "mime_type": 1, "dimension": 1, "columns": 1, "contents": 1, "matrices": 1}) if blob is not None else None
+    if twin is None:
+        return False
+    contents = [{**member, "drs_uri": f"{drs_uri}/{member['name']}"} for member in twin["contents"] or []]
+    uploads.update_one({"object_id": object_id},
+                       {"$set": {
+                           "dimension": twin["dimension"],
+                           "columns": twin["columns"],
+                           "updated_time": datetime.datetime.utcnow(),
+                           "mime_type": twin["mime_type"],
+                           "contents": contents,
+                           "matrices": twin.get("matrices"),
+                           "access_methods": _offload(object_id, blob, encoding),
+                           "status": "finished"
+                       }})
+    logger.info(f"status of {object_id} updated to 'finished', copied from identical object {twin['object_id']}")
+    return True
+
+
+def process_upload(object_id: str, file_path: str, drs_uri, encoding: str = IDENTITY):
+    '''
+    Post-processing for an object whose bytes are already stored (at file_path, with encoding): MIME
+    sniffing, CSV profiling, zip indexing, offloading to the storage backend and the final status update. Runs on a
+    queue worker, not in the request, so it uses the synchronous collection.
+    '''
+    uploads = _get_uploads().collection
+    try:
+        entry = uploads.find_one({"object_id": object_id}, {"blob": 1, "data_type": 1})
+        if entry is None:
+            # removed (deleted or expired) before its job ran; the reconciler reclaims its bytes
+            logger.info(f"{object_id} is gone, nothing to process")
+            return
+        blob = entry.get("blob")
+        with stage("twin_lookup"):
+            if _copy_from_twin(uploads, object_id, drs_uri, blob, encoding):
+                return
+        with stage("sniff"):
+            mime_type = sniff_mime_type(file_path, encoding)
+        logger.info(f"file type = {mime_type}")
+
+        dimension = None
+        columns = None
+        if mime_type in ['text/csv', 'application/csv', 'text/plain']:
+            with stage("profile"):
+                profile = profile_csv(file_path, encoding)
+            dimension = profile["dimension"]
+            columns = profile["columns"]
+
+        contents_list = []
+        if mime_type == 'application/zip':
+            logger.info(f"reading zip = {file_path}")
+            with stage("zip_scan"):
+                contents_list = _index_contents(object_id, file_path, drs_uri, entry.get("data_type"))
+            logger.info(f"{len(contents_list)} members in {file_path}")
+            logger.debug(f"members: {summarize([member['full_path'] for member in contents_list])}")
+
+        # expression and phenotype matrices get a memory-mappable copy for /objects/{object_id}/matrix
+        with stage("matrix"):
+            matrices = build_matrices(file_path, mime_type, derived_path(file_path), encoding)
+        methods = _offload(object_id, blob, encoding)
+
+        uploads.update_one({"object_id": object_id},
+                           {"$set": {
+                               "dimension": dimension,
+                               "columns": columns,
+                               "updated_time": datetime.datetime.utcnow(),
+                               "mime_type": mime_type,
+                               "contents": contents_list,
+                               "matrices": matrices,
+                               "access_methods": methods,
+                               "status": "finished"
+                           }})
+        logger.info(f"status of {object_id} updated to 'finished'")
+    except Exception as e:
+        uploads.update_one({"object_id": object_id},
+                           {"$set": {"updated_time": datetime.datetime.utcnow(),
+                                     "status": "failed",
+                                     "stderr": f"! Exception {type(e)} occurred while processing ({object_id}), message=[{e}] \n! traceback=\n{traceback.format_exc()}"}})
+        logger.exception(f"exception, setting upload status to failed for {object_id}")
+        # re-raise so rq records the job as failed too
+        raise
+
+
+class LocalJobQueue:
+    '''
+    In-process stand-in for rq, for running without redis (development, tests).
+    '''
+
+    def __init__(self, config: QueueConfig):
+        self._executor = ThreadPoolExecutor(max_workers=config.LOCAL_WORKERS, thread_name_prefix="upload-job")
+
+    def enqueue(self, fn, *args):
+        job_id = str(uuid.uuid4())
+        # in the submitting request's context, so the job's log records carry its request id
+        future = self._executor.submit(contextvars.copy_context().run, fn, *args)
+        # failures are already recorded on the object document; just keep them out of the void
+        future.add_done_callback(lambda f: f.exception() and logger.error(f"job {job_id} failed: {f.exception()}"))
+        return job_id
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        close_pool()
+
+
+def run_job(fn, *args):
+    '''
+    What rq workers run. rq forks a process for each job, which exits without running atexit hooks, so the zip
+    indexing pool a job may have started is shut down with the job rather than left behind.
+    '''
+    try:
+        return fn(*args)
+    finally:
+        close_pool()
+
+
+class RQJobQueue:
+    def __init__(self, config: QueueConfig):
+        from redis import Redis
+        from rq import Queue
+        self._queue = Queue(config.QUEUE_NAME, connection=Redis(host=config.REDIS_HOST, port=config.REDIS_PORT), default_timeout=config.JOB_TIMEOUT)
+
+    def enqueue(self, fn, *args):
+        return self._queue.enqueue(run_job, fn, *args).id
+
+    def close(self):
+        self._queue.connection.close()
+
+
+def make_job_queue(config: QueueConfig = None):
+    if config is None:
+        config = QueueConfig()
+    logger.info(f"using '{config.BACKEND}' job queue")
+    if config.BACKEND == "rq":
+        return RQJobQueue(config)
+    return LocalJobQueue(config)
@@ -0,0 +1,181 @@
+import contextvars
+import copy
+import datetime
+import json
+import logging
+import logging.handlers
+import queue
+import re
+import threading
+import time
+import uuid
+
+from uvicorn.logging import DefaultFormatter
+
+from fuse.models.Config import LogConfig
+
+g_log_config = LogConfig()
+
+# correlation id of the request being served, set by RequestIdMiddleware and stamped on every log record
+request_id_var = contextvars.ContextVar("request_id", default=None)
+
+_REQUEST_ID = re.compile(r"^[A-Za-z0-9._:-]{1,128}$")
+
+# LogRecord's own attributes; anything else on a record came from extra= and is written as a field of its own
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "color_message"}
+
+
+def summarize(value, max_chars: int = None):
+    '''
+    A log-sized description of value: strings are cut to max_chars (LOG_MAX_CHARS), and lists and dicts longer
+    than that when printed are reduced to their length and first few items or keys.
+    '''
+    if max_chars is None:
+        max_chars = g_log_config.LOG_MAX_CHARS
+    text = str(value)
+    if len(text) <= max_chars:
+        return text
+    if isinstance(value, dict):
+        keys = list(value)
+        return f"<dict of {len(keys)} keys: {', '.join(str(k) for k in keys[:10])}{', ...' if len(keys) > 10 else ''}>"
+    if isinstance(value, (list, tuple)):
+        return f"<{type(value).__name__} of {len(value)} items, first: {str(value[0])[:max_chars // 2]}>"
+    return f"{text[:max_chars]}... ({len(text)} chars)"
+
+
+class RequestContextFilter(logging.Filter):
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        return True
+
+
+class RateLimitFilter(logging.Filter):
+    '''
+    Token bucket per call site (file and line) for records below WARNING: once a site has logged a burst of
+    `burst` records, it gets `rate` a second and the rest are dropped. The next record that gets through
+    carries the number dropped in its `suppressed` field. Warnings and errors are never dropped.
+    '''
+
+    def __init__(self, rate: float, burst: int):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self._sites = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if self.rate <= 0 or record.levelno >= logging.WARNING:
+            return True
+        site = (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self._lock:
+            tokens, last, suppressed = self._sites.get(site, (self.burst, now, 0))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens < 1:
+                self._sites[site] = (tokens, now, suppressed + 1)
+                return False
+            self._sites[site] = (tokens - 1, now, 0)
+        if suppressed > 0:
+            record.suppressed = suppressed
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    '''
+    One JSON object per record: time, level, logger, func, message, plus request_id, any extra= fields, and the traceback, when there is one.
+    '''
+
+    def format(self, record):
+        entry = {"time": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec="milliseconds"),
+                 "level": record.levelname,
+                 "logger": record.name,
+                 "func": record.funcName,
+                 "message": record.getMessage()}
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and value is not None:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class AsyncQueueHandler(logging.handlers.QueueHandler):
+    '''
+    Hands records to a background thread that formats and writes them, so a log call only costs the caller
+    its filters and a queue put. If the writer falls behind and the queue fills up, records are dropped
+    rather than blocking the request; the next record queued reports how many in its `dropped` field.
+    '''
+
+    def __init__(self, target: logging.Handler, queue_size: int):
+        super().__init__(queue.Queue(queue_size))
+        self.dropped = 0
+        self._dropped_lock = threading.Lock()
+        self.listener = logging.handlers.QueueListener(self.queue, target, respect_handler_level=True)
+        self.listener.start()
+
+    def prepare(self, record):
+        # the message is rendered here, while its arguments are current; the traceback is formatted on the writer thread
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        with self._dropped_lock:
+            dropped, self.dropped = self.dropped, 0
+        if dropped > 0:
+            record.dropped = dropped
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._dropped_lock:
+                self.dropped += dropped + 1
+
+    def close(self):
+        # at exit, logging.shutdown() gets here first: write out what's queued before the stream goes
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+        super().close()
+
+
+def queue_handler(stream=None, json_format: bool = True, fmt: str = None, datefmt: str = None,
+                  queue_size: int = 10000, rate: float = 0, burst: int = 1):
+    '''
+    dictConfig factory (see LogConfig.handlers) for the non-blocking, rate-limited handler writing to stream.
+    '''
+    target = logging.StreamHandler(stream)
+    target.setFormatter(JsonFormatter() if json_format else DefaultFormatter(fmt, datefmt))
+    handler = AsyncQueueHandler(target, queue_size)
+    handler.addFilter(RateLimitFilter(rate, burst))
+    handler.addFilter(RequestContextFilter())
+    return handler
+
+
+class RequestIdMiddleware:
+    '''
+    Gives every request a correlation id for its log records: the caller's X-Request-ID, if it is a sane one,
+    or a new one, sent back in the response's X-Request-ID header either way. Work the request queues
+    in-process (upload processing) logs with the same id.
+    '''
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        request_id = dict(scope["headers"]).get(b"x-request-id", b"").decode("latin-1")
+        if not _REQUEST_ID.match(request_id):
+            request_id = uuid.uuid4().hex
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                message = {**message, "headers": list(message.get("headers", [])) + [(b"x-request-id", request_id.encode("latin-1"))]}
+            await send(message)
+
+        token = request_id_var.set(request_id)
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            request_id_var.reset(token)
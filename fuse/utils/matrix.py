@@ -0,0 +1,259 @@
+import csv
+import io
+import logging
+import os
+import shutil
+import threading
+import zipfile
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from fuse.models.Config import MatrixConfig, ProfileConfig
+from fuse.utils.compression import IDENTITY, open_decoded
+from fuse.utils.profile import has_header
+
+logger = logging.getLogger("fuse-provider-upload")
+
+g_matrix_config = MatrixConfig()
+g_profile_config = ProfileConfig()
+
+VALUES_FILE = "values.npy"
+ROWS_FILE = "rows.npy"
+COLS_FILE = "cols.npy"
+
+# upper bound on the text form of a float64 (repr is at most 24 characters), for numeric cells of a mixed matrix
+_NUMERIC_TEXT_WIDTH = 32
+
+
+def _chunks(open_text, header: bool, chunk_rows: int):
+    with open_text() as f:
+        yield from pd.read_csv(f, header=0 if header else None, index_col=0, chunksize=chunk_rows)
+
+
+def build_matrix(open_text, out_dir: str):
+    '''
+    Convert a CSV matrix (first column: row labels; first line: column labels, if it is a header) into
+    a memory-mappable sidecar in out_dir: values.npy, plus rows.npy/cols.npy holding the labels.
+
+    open_text() must return a fresh text stream over the CSV each time; it is read twice, once to
+    find the shape and cell type and once to fill the preallocated .npy, a chunk (PROFILE_CHUNK_CELLS)
+    at a time, so the whole matrix is never in memory. All-numeric matrices are stored as float64
+    (missing cells are NaN); anything else as fixed-width unicode (missing cells are empty).
+    Returns {"rows", "cols", "dtype"}.
+    '''
+    with open_text() as f:
+        sample = f.read(g_profile_config.SNIFF_BYTES)
+    header = has_header(sample)
+    chunk_rows = max(1, g_profile_config.CHUNK_CELLS // max(1, len(sample.split("\n", 1)[0].split(","))))
+
+    row_labels = []
+    col_labels = None
+    numeric = True
+    text_width = 1
+    for chunk in _chunks(open_text, header, chunk_rows):
+        if col_labels is None:
+            col_labels = [str(c) for c in chunk.columns] if header else [str(i) for i in range(chunk.shape[1])]
+        row_labels.extend(str(label) for label in chunk.index)
+        if all(pd.api.types.is_numeric_dtype(dtype) for dtype in chunk.dtypes):
+            text_width = max(text_width, _NUMERIC_TEXT_WIDTH)
+        else:
+            numeric = False
+            text_width = max(text_width, int(chunk.fillna("").astype(str).apply(lambda column: column.str.len().max()).max()))
+    if col_labels is None or len(col_labels) == 0:
+        raise ValueError("no matrix values: expected a row label column followed by at least one value column")
+
+    dtype = np.dtype(np.float64) if numeric else np.dtype(f"<U{text_width}")
+    tmp_dir = f"{out_dir}.{os.getpid()}.{threading.get_ident()}.tmp"
+    os.makedirs(tmp_dir)
+    try:
+        values = np.lib.format.open_memmap(os.path.join(tmp_dir, VALUES_FILE), mode="w+", dtype=dtype, shape=(len(row_labels), len(col_labels)))
+        row = 0
+        for chunk in _chunks(open_text, header, chunk_rows):
+            block = chunk.to_numpy(dtype=np.float64) if numeric else chunk.fillna("").astype(str).to_numpy(dtype=dtype)
+            values[row:row + len(chunk)] = block
+            row += len(chunk)
+        values.flush()
+        del values
+        np.save(os.path.join(tmp_dir, ROWS_FILE), np.array(row_labels, dtype=str))
+        np.save(os.path.join(tmp_dir, COLS_FILE), np.array(col_labels, dtype=str))
+        # sidecars are derived from content-addressed bytes, so one that is already in place is identical
+        if os.path.isdir(out_dir):
+            shutil.rmtree(tmp_dir)
+        else:
+            os.replace(tmp_dir, out_dir)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    logger.info(f"built {len(row_labels)}x{len(col_labels)} {dtype} matrix at {out_dir}")
+    return {"rows": len(row_labels), "cols": len(col_labels), "dtype": "float64" if numeric else "str"}
+
+
+def build_matrices(file_path: str, mime_type: str, derived_dir: str, encoding: str = IDENTITY):
+    '''
+    Sidecars for a CSV object (stored with encoding), or for every CSV member of a zip object, written under derived_dir.
+    Returns the `matrices` entries for the object's document; a member that isn't a matrix is
+    logged and skipped rather than failing the upload.
+    '''
+    sources = []
+    if mime_type in ['text/csv', 'application/csv', 'text/plain']:
+        sources.append((None, lambda: open_decoded(file_path, encoding, text=True)))
+    elif mime_type == 'application/zip':
+        with zipfile.ZipFile(file_path) as archive:
+            members = [info.filename for info in archive.infolist() if not info.is_dir() and info.filename.lower().endswith(".csv")]
+        for member in members:
+            sources.append((member, lambda member=member: _open_member(file_path, member)))
+
+    matrices = []
+    for member, open_text in sources:
+        sidecar = f"matrix-{len(matrices)}"
+        try:
+            matrix = build_matrix(open_text, os.path.join(derived_dir, sidecar))
+        except Exception as e:
+            logger.warning(f"no matrix sidecar for {member or file_path}: {type(e)}: {e}")
+            continue
+        matrices.append({"member": member, "sidecar": sidecar, **matrix})
+    return matrices
+
+
+class _MemberText(io.TextIOWrapper):
+    # closes the archive along with the member
+    def __init__(self, archive: zipfile.ZipFile, member: str):
+        self._archive = archive
+        super().__init__(archive.open(member), newline='')
+
+    def close(self):
+        super().close()
+        self._archive.close()
+
+
+def _open_member(file_path: str, member: str):
+    return _MemberText(zipfile.ZipFile(file_path), member)
+
+
+def _range_bounds(item: str):
+    '''
+    (start, stop) of a start:stop position range, either of them None if left out; None if item isn't one.
+    '''
+    if item.count(":") != 1:
+        return None
+    try:
+        return tuple(int(bound) if bound.strip() != "" else None for bound in item.split(":"))
+    except ValueError:
+        return None
+
+
+class Matrix:
+    '''
+    A sidecar opened for slicing: values are memory-mapped, so a slice only reads the pages
+    holding the requested rows; the labels are small and loaded into dicts for lookup.
+    '''
+
+    def __init__(self, path: str):
+        self.path = path
+        self.values = np.load(os.path.join(path, VALUES_FILE), mmap_mode="r")
+        self.row_labels = np.load(os.path.join(path, ROWS_FILE))
+        self.col_labels = np.load(os.path.join(path, COLS_FILE))
+        # duplicated labels resolve to their first occurrence
+        self._rows = {label: i for i, label in reversed(list(enumerate(self.row_labels.tolist())))}
+        self._cols = {label: i for i, label in reversed(list(enumerate(self.col_labels.tolist())))}
+
+    @staticmethod
+    def _select(spec: str, index: dict, n: int):
+        '''
+        Positions for spec, a comma-separated list of labels and/or start:stop position ranges
+        (stop exclusive, either end may be left out); None selects everything. An item is a range only if both
+        its ends are integers or left out, so labels containing ':' work as they are; labels containing ','
+        are double-quoted, as in CSV.
+        '''
+        if spec is None:
+            return np.arange(n)
+        positions = []
+        for item in next(csv.reader([spec], skipinitialspace=True)):
+            item = item.strip()
+            bounds = _range_bounds(item)
+            if bounds is not None:
+                positions.extend(range(*slice(*bounds).indices(n)))
+            elif item in index:
+                positions.append(index[item])
+            else:
+                raise KeyError(f"no such label ({item})")
+        return np.array(positions, dtype=np.intp)
+
+    def slice(self, rows: str = None, cols: str = None, max_cells: int = None):
+        '''
+        Returns (row labels, column labels, values) for the selection, in the order asked for.
+        '''
+        if max_cells is None:
+            max_cells = g_matrix_config.SLICE_MAX_CELLS
+        row_positions = self._select(rows, self._rows, self.values.shape[0])
+        col_positions = self._select(cols, self._cols, self.values.shape[1])
+        if len(row_positions) * len(col_positions) > max_cells:
+            raise ValueError(f"slice of {len(row_positions)}x{len(col_positions)} exceeds the maximum of {max_cells} cells")
+        return self.row_labels[row_positions], self.col_labels[col_positions], self.values[np.ix_(row_positions, col_positions)]
+
+
+class MatrixCache:
+    '''
+    LRU of opened sidecars, so label indexes are built once rather than on every slice request.
+    Sidecars never change once written, so entries only go away by eviction or invalidate().
+    '''
+
+    def __init__(self, max_entries: int = None):
+        self.max_entries = max_entries if max_entries is not None else g_matrix_config.CACHE_SIZE
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path: str) -> Matrix:
+        with self._lock:
+            cached = self._entries.get(path)
+            if cached is not None:
+                self._entries.move_to_end(path)
+                return cached
+        matrix = Matrix(path)
+        with self._lock:
+            self._entries[path] = matrix
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return matrix
+
+    def invalidate(self, path: str):
+        '''
+        Drop the sidecar at path, or every one under it if it's a directory.
+        '''
+        prefix = os.path.join(path, "")
+        with self._lock:
+            for cached in [cached for cached in self._entries if cached == path or cached.startswith(prefix)]:
+                del self._entries[cached]
+
+
+def slice_to_json(row_labels, col_labels, values):
+    if values.dtype.kind == "f":
+        # NaN isn't JSON
+        values = np.where(np.isnan(values), None, values)
+    return {"rows": row_labels.tolist(), "cols": col_labels.tolist(), "values": values.tolist()}
+
+
+def iter_slice_csv(row_labels, col_labels, values, batch_rows: int = 1000):
+    '''
+    Yields the slice as CSV in the same layout as the uploaded matrix, batch_rows lines at a time.
+    '''
+    out = io.StringIO()
+    writer = csv.writer(out, lineterminator="\n")
+    writer.writerow([""] + col_labels.tolist())
+    for start in range(0, len(row_labels), batch_rows):
+        block = values[start:start + batch_rows]
+        if block.dtype.kind == "f":
+            block = np.where(np.isnan(block), "", block)
+        writer.writerows([label] + row for label, row in zip(row_labels[start:start + batch_rows].tolist(), block.tolist()))
+        yield out.getvalue()
+        out.seek(0)
+        out.truncate()
+    yield out.getvalue()
+
+
+def slice_to_npz(row_labels, col_labels, values):
+    out = io.BytesIO()
+    np.savez(out, values=values, rows=row_labels, cols=col_labels)
+    return out.getvalue()
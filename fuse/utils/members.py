@@ -0,0 +1,169 @@
+'''
+Per-member indexing of zip objects. The work is done by index_members(), which also runs in the worker
+processes of the indexing pool, so this module keeps its imports light (no pandas).
+'''
+import csv
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import magic
+
+from fuse.models.Config import ProfileConfig, UploadConfig, ZipIndexConfig
+from fuse.utils.ingest import StreamingDigest
+
+logger = logging.getLogger("fuse-provider-upload")
+
+g_profile_config = ProfileConfig()
+g_upload_config = UploadConfig()
+g_zip_index_config = ZipIndexConfig()
+
+# members that get a dimension, as for whole objects
+TEXT_TYPES = ('text/csv', 'application/csv', 'text/plain')
+
+_magic = None
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _mime_type(head: bytes):
+    global _magic
+    if _magic is None:
+        _magic = magic.Magic(mime=True)
+    return _magic.from_buffer(head)
+
+
+def _first_field(line: bytes):
+    fields = next(csv.reader([line.decode("utf-8", "replace")]), [])
+    return fields[0] if len(fields) > 0 else ""
+
+
+def _index_member(archive: zipfile.ZipFile, full_path: str, row_labels: bool, chunk_size: int):
+    '''
+    Stream one member once: size and checksums, MIME type from its first chunk and, for text, its dimension, with the
+    same meaning as for whole objects ("<lines>x<fields on the first line - 1>"). With row_labels, the first field of
+    every line is kept too. Keys starting with '_' are for the caller and aren't part of the DRS entry.
+    '''
+    digest = StreamingDigest()
+    head = b""
+    first_line = None
+    pending = b""
+    labels = [] if row_labels else None
+    lines = 0
+    last_byte = b"\n"
+    with archive.open(full_path) as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+            lines += chunk.count(b"\n")
+            last_byte = chunk[-1:]
+            if first_line is None or len(head) < g_profile_config.SNIFF_BYTES:
+                head += chunk
+                # a member with no line breaks in its first few chunks isn't text: stop looking
+                if first_line is None and (b"\n" in head or len(head) >= 4 * chunk_size):
+                    first_line = head.split(b"\n", 1)[0]
+            if labels is not None:
+                pending += chunk
+                *complete, pending = pending.split(b"\n")
+                labels.extend(_first_field(line) for line in complete)
+    if first_line is None:
+        first_line = head
+    # a final line without a trailing newline still counts
+    if last_byte != b"\n":
+        lines += 1
+        if labels is not None:
+            labels.append(_first_field(pending))
+
+    mime_type = _mime_type(head[:chunk_size])
+    first_text = first_line.decode("utf-8", "replace").rstrip()
+    return {"full_path": full_path,
+            "size": digest.size,
+            "checksums": digest.checksums,
+            "mime_type": mime_type,
+            "dimension": f"{lines}x{len(first_text.split(sep=',')) - 1}" if mime_type in TEXT_TYPES else None,
+            "_header": next(csv.reader([first_text]), []),
+            "_sample": head[:g_profile_config.SNIFF_BYTES].decode("utf-8", "replace"),
+            "_row_labels": labels}
+
+
+def index_members(file_path: str, requests: list, chunk_size: int = None):
+    '''
+    _index_member for a batch of (full_path, row_labels) of the zip at file_path; one task on the pool.
+    '''
+    if chunk_size is None:
+        chunk_size = g_upload_config.CHUNK_SIZE
+    with zipfile.ZipFile(file_path) as archive:
+        return [_index_member(archive, full_path, row_labels, chunk_size) for full_path, row_labels in requests]
+
+
+def _batches(requests: list, sizes: list, n: int):
+    '''
+    Split requests into at most n batches of about equal total size: biggest first, each into the lightest batch so far.
+    '''
+    batches = [([], 0) for _ in range(min(n, len(requests)))]
+    for request, size in sorted(zip(requests, sizes), key=lambda r: r[1], reverse=True):
+        i = min(range(len(batches)), key=lambda b: batches[b][1])
+        batches[i] = (batches[i][0] + [request], batches[i][1] + size)
+    return [batch for batch, _ in batches if len(batch) > 0]
+
+
+def _init_worker():
+    '''
+    Runs once in each pool process. Interrupts and shutdown are the parent's to handle: it shuts the pool down
+    (close_pool) rather than having every worker die with a KeyboardInterrupt traceback of its own.
+    '''
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # load libmagic's database before the first batch rather than in it
+    _mime_type(b"")
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawned, not forked: the job runs in a process full of threads (event loop, mongo, log writer) whose locks a fork would copy.
+            # A spawned process re-imports the parent's __main__ module, so entry points (fuse.utils.server, rq's, bench.run)
+            # keep theirs import-safe; main.py hands over to fuse.utils.server rather than being __main__ itself
+            _pool = ProcessPoolExecutor(max_workers=g_zip_index_config.WORKERS, mp_context=multiprocessing.get_context("spawn"),
+                                        initializer=_init_worker)
+            logger.info(f"started zip indexing pool of {g_zip_index_config.WORKERS} processes")
+        return _pool
+
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=True)
+
+
+def index_zip(file_path: str, row_labels_for=()):
+    '''
+    Index every file member of the zip at file_path, in archive order; members whose base name is in row_labels_for
+    also get their row labels. Archives of ZIP_INDEX_INLINE_BYTES or more are split into batches by size and indexed
+    by the process pool, so a big archive is read and hashed on every core at once.
+    '''
+    global _pool
+    with zipfile.ZipFile(file_path) as archive:
+        infos = [info for info in archive.infolist() if not info.is_dir()]
+    requests = [(info.filename, os.path.basename(info.filename) in row_labels_for) for info in infos]
+    sizes = [info.file_size for info in infos]
+    if g_zip_index_config.WORKERS < 2 or len(infos) < 2 or sum(sizes) < g_zip_index_config.INLINE_BYTES:
+        return index_members(file_path, requests)
+
+    pool = _get_pool()
+    try:
+        futures = [pool.submit(index_members, file_path, batch) for batch in _batches(requests, sizes, g_zip_index_config.WORKERS * g_zip_index_config.BATCHES_PER_WORKER)]
+        indexed = {entry["full_path"]: entry for future in futures for entry in future.result()}
+    except BrokenProcessPool:
+        # a worker died (e.g., killed for memory); the next archive gets a fresh pool
+        with _pool_lock:
+            if _pool is pool:
+                _pool = None
+        raise
+    return [indexed[info.filename] for info in infos]
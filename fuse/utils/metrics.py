@@ -0,0 +1,128 @@
+import contextlib
+import contextvars
+import logging
+import os
+import time
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+
+from fuse.models.Config import MetricsConfig
+
+logger = logging.getLogger("fuse-provider-upload")
+
+g_metrics_config = MetricsConfig()
+
+REQUEST_SECONDS = Histogram("fuse_upload_request_seconds", "Time to serve a request, by route", ["method", "route", "status"])
+REQUESTS_IN_FLIGHT = Gauge("fuse_upload_requests_in_flight", "Requests being served", ["method"], multiprocess_mode="livesum")
+RECEIVED_BYTES = Counter("fuse_upload_received_bytes", "Request body bytes received, by route", ["route"])
+SENT_BYTES = Counter("fuse_upload_sent_bytes", "Response body bytes sent, by route", ["route"])
+STAGE_SECONDS = Histogram("fuse_upload_stage_seconds", "Time spent in each stage of ingest, processing and retrieval", ["stage"])
+MONGO_SECONDS = Histogram("fuse_upload_mongo_seconds", "Mongo call latency, including the wait for an executor thread", ["collection", "operation"])
+
+# (stage, seconds) recorded while serving the current request, for the slow-request log
+_request_stages = contextvars.ContextVar("request_stages", default=None)
+
+
+def record_stage(name: str, seconds: float):
+    STAGE_SECONDS.labels(name).observe(seconds)
+    stages = _request_stages.get()
+    if stages is not None:
+        stages.append((name, seconds))
+
+
+def record_mongo_call(collection: str, operation: str, seconds: float):
+    MONGO_SECONDS.labels(collection, operation).observe(seconds)
+    stages = _request_stages.get()
+    if stages is not None:
+        stages.append((f"mongo.{operation}", seconds))
+
+
+@contextlib.contextmanager
+def stage(name: str):
+    '''
+    Time the enclosed block as a pipeline stage. Works around awaits; inside the event loop the
+    time is also attributed to the request being served.
+    '''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - start)
+
+
+def render():
+    '''
+    The metrics in Prometheus text format. With PROMETHEUS_MULTIPROC_DIR set, every process writing
+    to that directory (API workers, queue workers) is aggregated.
+    '''
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+
+
+class MetricsMiddleware:
+    '''
+    ASGI middleware recording per-route latency, in-flight requests and body bytes in each direction,
+    and logging the stage breakdown of slow requests when SLOW_REQUEST_SECONDS is set. Routes are
+    labelled by their path template, so object ids don't explode the label space.
+    '''
+
+    def __init__(self, app, routes=None, config: MetricsConfig = None):
+        self.app = app
+        self.routes = routes
+        self.config = config if config is not None else g_metrics_config
+        self._templates = None
+
+    def _route(self, scope):
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return "unmatched"
+        if self._templates is None:
+            self._templates = {route.endpoint: route.path for route in self.routes() if hasattr(route, "endpoint")}
+        return self._templates.get(endpoint, endpoint.__name__)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        method = scope["method"]
+        received = 0
+        sent = 0
+        status = 500
+
+        async def counting_receive():
+            nonlocal received
+            message = await receive()
+            received += len(message.get("body", b""))
+            return message
+
+        async def counting_send(message):
+            nonlocal sent, status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                sent += len(message.get("body", b""))
+            await send(message)
+
+        stages = []
+        token = _request_stages.set(stages)
+        in_flight = REQUESTS_IN_FLIGHT.labels(method)
+        in_flight.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, counting_receive, counting_send)
+        finally:
+            elapsed = time.perf_counter() - start
+            in_flight.dec()
+            _request_stages.reset(token)
+            route = self._route(scope)
+            REQUEST_SECONDS.labels(method, route, str(status)).observe(elapsed)
+            if received:
+                RECEIVED_BYTES.labels(route).inc(received)
+            if sent:
+                SENT_BYTES.labels(route).inc(sent)
+            if 0 < self.config.SLOW_REQUEST_SECONDS <= elapsed:
+                breakdown = ", ".join(f"{name}={seconds:.3f}s" for name, seconds in stages)
+                logger.warning(f"slow request: {method} {scope['path']} -> {status} in {elapsed:.3f}s "
+                               f"({received} bytes in, {sent} out) [{breakdown}]")
@@ -0,0 +1,133 @@
+import csv
+import logging
+
+import numpy as np
+import pandas as pd
+
+from fuse.models.Config import ProfileConfig
+from fuse.utils.compression import IDENTITY, open_decoded
+
+logger = logging.getLogger("fuse-provider-upload")
+
+g_profile_config = ProfileConfig()
+
+
+class _ColumnSummary:
+    def __init__(self, name):
+        self.name = name
+        self.dtype = None
+        self.null_count = 0
+        self.min = None
+        self.max = None
+        self.numeric = True
+        self.entrez_like = True
+
+    def update(self, dtype, null_count, chunk_min=None, chunk_max=None, integral=False):
+        self.null_count += int(null_count)
+        self.dtype = dtype if self.dtype is None else _merge_dtypes(self.dtype, dtype)
+        if not self.numeric:
+            return
+        if not pd.api.types.is_numeric_dtype(dtype) or pd.api.types.is_bool_dtype(dtype):
+            self.numeric = self.entrez_like = False
+            return
+        if chunk_min is None:
+            # all-null chunk
+            return
+        self.min = chunk_min if self.min is None else min(self.min, chunk_min)
+        self.max = chunk_max if self.max is None else max(self.max, chunk_max)
+        # Entrez gene ids are positive integers, possibly parsed as floats when the column has gaps
+        self.entrez_like = bool(self.entrez_like and chunk_min > 0 and integral)
+
+    def to_dict(self):
+        is_numeric = self.numeric and self.min is not None
+        return {"name": self.name,
+                "dtype": str(self.dtype),
+                "null_count": self.null_count,
+                "min": self.min.item() if is_numeric else None,
+                "max": self.max.item() if is_numeric else None,
+                "entrez_like": bool(self.entrez_like and is_numeric)}
+
+
+def _profile_chunk(chunk: pd.DataFrame, summaries):
+    # whole-chunk reductions; only the per-column bookkeeping below is a python loop
+    chunk = chunk.iloc[:, :len(summaries)]
+    null_counts = chunk.isna().sum().to_numpy()
+    numeric = chunk.select_dtypes(include="number", exclude="bool")
+    mins, maxs = numeric.min(), numeric.max()
+    integral = (numeric.isna() | (numeric % 1 == 0)).all()
+    for i, (name, dtype) in enumerate(chunk.dtypes.items()):
+        if name in numeric.columns:
+            # mixed-dtype reductions come back upcast to float; restore the column's own type
+            chunk_min, chunk_max = (dtype.type(mins[name]), dtype.type(maxs[name])) if not pd.isna(mins[name]) else (None, None)
+            summaries[i].update(dtype, null_counts[i], chunk_min, chunk_max, integral[name])
+        else:
+            summaries[i].update(dtype, null_counts[i])
+
+
+def _merge_dtypes(a, b):
+    if a == b:
+        return a
+    if pd.api.types.is_numeric_dtype(a) and pd.api.types.is_numeric_dtype(b):
+        return np.result_type(a, b)
+    return np.dtype(object)
+
+
+def has_header(sample: str):
+    '''
+    Guess from the first PROFILE_SNIFF_BYTES of a CSV whether its first line is a header.
+    '''
+    try:
+        return csv.Sniffer().has_header(sample)
+    except csv.Error:
+        return False
+
+
+def _has_header(file_path, encoding=IDENTITY):
+    with open_decoded(file_path, encoding, text=True) as f:
+        return has_header(f.read(g_profile_config.SNIFF_BYTES))
+
+
+def _count_lines(file_path, encoding=IDENTITY):
+    number_of_lines = 0
+    last_byte = b"\n"
+    with open_decoded(file_path, encoding) as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            number_of_lines += block.count(b"\n")
+            last_byte = block[-1:]
+    # a final line without a trailing newline still counts
+    if last_byte != b"\n":
+        number_of_lines += 1
+    return number_of_lines
+
+
+def profile_csv(file_path: str, encoding: str = IDENTITY):
+    '''
+    Make one chunked pass over a CSV (stored with encoding) and return its dimension plus per-column summaries.
+
+    dimension keeps its historical meaning: "<lines>x<fields on the first line - 1>", where the
+    first field is the row label. Chunks are sized in cells (PROFILE_CHUNK_CELLS) so memory stays
+    flat no matter how many rows or columns the matrix has. If the file doesn't parse as CSV,
+    only the dimension is computed, from a streaming line count.
+    '''
+    with open_decoded(file_path, encoding, text=True) as f:
+        number_of_fields = len(f.readline().rstrip().split(sep=","))
+    number_of_columns = number_of_fields - 1
+    header = _has_header(file_path, encoding)
+    chunk_rows = max(1, g_profile_config.CHUNK_CELLS // max(1, number_of_fields))
+    logger.info(f"profiling {file_path}: header={header}, chunk_rows={chunk_rows}")
+
+    summaries = None
+    number_of_rows = 1 if header else 0
+    try:
+        with open_decoded(file_path, encoding, text=True) as f:
+            for chunk in pd.read_csv(f, header=0 if header else None, chunksize=chunk_rows, skip_blank_lines=False):
+                if summaries is None:
+                    summaries = [_ColumnSummary(str(name)) for name in chunk.columns[:g_profile_config.MAX_COLUMNS]]
+                number_of_rows += len(chunk)
+                _profile_chunk(chunk, summaries)
+    except (pd.errors.ParserError, UnicodeDecodeError, ValueError) as e:
+        logger.warning(f"{file_path} could not be parsed as csv ({type(e)}: {e}), counting lines only")
+        return {"dimension": f"{_count_lines(file_path, encoding)}x{number_of_columns}", "columns": None}
+
+    return {"dimension": f"{number_of_rows}x{number_of_columns}",
+            "columns": [summary.to_dict() for summary in summaries] if summaries is not None else []}
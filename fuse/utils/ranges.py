@@ -0,0 +1,123 @@
+import os
+import uuid
+
+import aiofiles
+from starlette.responses import Response
+
+from fuse.models.Config import DownloadConfig
+
+g_download_config = DownloadConfig()
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def parse_range(header: str, size: int):
+    '''
+    Parse a `Range: bytes=...` header into a list of inclusive (start, end) offsets.
+    Returns None if the header is absent, malformed or asks for too many ranges, in which case
+    the whole object is served (RFC 7233 says to ignore a Range header we can't use).
+    Raises RangeNotSatisfiable if none of the ranges overlap the object.
+    '''
+    if not header or not header.startswith("bytes="):
+        return None
+    specs = header[len("bytes="):].split(",")
+    if len(specs) > g_download_config.MAX_RANGES:
+        return None
+    ranges = []
+    for spec in specs:
+        first, sep, last = spec.strip().partition("-")
+        if sep != "-":
+            return None
+        try:
+            if first == "":
+                # suffix range: the last N bytes
+                suffix = int(last)
+                if suffix == 0:
+                    continue
+                start, end = max(0, size - suffix), size - 1
+            else:
+                start = int(first)
+                if last != "" and int(last) < start:
+                    return None
+                end = min(int(last), size - 1) if last != "" else size - 1
+        except ValueError:
+            return None
+        if start < size:
+            ranges.append((start, end))
+    if not ranges:
+        raise RangeNotSatisfiable()
+    return ranges
+
+
+def etag_for(checksums):
+    '''
+    Strong ETag from the stored sha-256 (or whatever checksum we have), None if there is none.
+    '''
+    by_type = {c["type"]: c["checksum"] for c in checksums or []}
+    checksum = by_type.get("sha-256") or next(iter(by_type.values()), None)
+    return f'"{checksum}"' if checksum is not None else None
+
+
+def etag_matches(header: str, etag: str):
+    '''
+    If-None-Match uses weak comparison, so W/ prefixes are ignored.
+    '''
+    if not header or etag is None:
+        return False
+    candidates = [candidate.strip() for candidate in header.split(",")]
+    return "*" in candidates or etag in [candidate[2:] if candidate.startswith("W/") else candidate for candidate in candidates]
+
+
+class FileRangeResponse(Response):
+    '''
+    Serves a file, or byte ranges of it (206, multipart/byteranges for more than one range), read in
+    DOWNLOAD_CHUNK_SIZE blocks without blocking the event loop.
+    '''
+
+    def __init__(self, path: str, size: int, ranges=None, headers: dict = None, media_type: str = None):
+        self.path = path
+        self.size = size
+        self.ranges = ranges
+        self.media_type = media_type
+        self.background = None
+        self.body = b""
+        self.boundary = uuid.uuid4().hex
+        headers = dict(headers or {})
+        headers["accept-ranges"] = "bytes"
+        self.parts = []
+        if ranges is None:
+            self.status_code = 200
+            self.parts.append((b"", 0, size - 1))
+        elif len(ranges) == 1:
+            self.status_code = 206
+            start, end = ranges[0]
+            headers["content-range"] = f"bytes {start}-{end}/{size}"
+            self.parts.append((b"", start, end))
+        else:
+            self.status_code = 206
+            for start, end in ranges:
+                preamble = f"\r\n--{self.boundary}\r\nContent-Type: {media_type}\r\nContent-Range: bytes {start}-{end}/{size}\r\n\r\n"
+                self.parts.append((preamble.encode("latin-1"), start, end))
+            self.media_type = f"multipart/byteranges; boundary={self.boundary}"
+        self.epilogue = f"\r\n--{self.boundary}--\r\n".encode("latin-1") if ranges is not None and len(ranges) > 1 else b""
+        content_length = sum(len(preamble) + end - start + 1 for preamble, start, end in self.parts) + len(self.epilogue)
+        headers["content-length"] = str(content_length)
+        self.init_headers(headers)
+
+    async def __call__(self, scope, receive, send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        async with aiofiles.open(self.path, mode="rb") as f:
+            for preamble, start, end in self.parts:
+                if preamble:
+                    await send({"type": "http.response.body", "body": preamble, "more_body": True})
+                await f.seek(start, os.SEEK_SET)
+                remaining = end - start + 1
+                while remaining > 0:
+                    chunk = await f.read(min(g_download_config.CHUNK_SIZE, remaining))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": self.epilogue, "more_body": False})
@@ -0,0 +1,324 @@
+import asyncio
+import datetime
+import logging
+import os
+import shutil
+import socket
+import time
+import uuid
+
+from pymongo import ASCENDING
+from pymongo.errors import DuplicateKeyError
+from starlette.concurrency import run_in_threadpool
+
+from fuse.models.Config import ReconcileConfig
+from fuse.utils.blobs import BlobStore
+from fuse.utils.compression import IDENTITY
+from fuse.utils.db import UploadsCollection
+from fuse.utils.health import g_health
+
+logger = logging.getLogger("fuse-provider-upload")
+
+g_reconcile_config = ReconcileConfig()
+
+_LEASE_ID = "reconciler"
+
+# what removing an object needs to know about it
+_ENTRY_FIELDS = {"_id": 1, "object_id": 1, "blob": 1, "blob_encoding": 1, "size": 1}
+
+
+def _age(path: str):
+    '''
+    Seconds since path was last modified, or None if it is gone.
+    '''
+    try:
+        return time.time() - os.stat(path).st_mtime
+    except FileNotFoundError:
+        return None
+
+
+def _list(directory: str):
+    try:
+        return sorted(os.listdir(directory))
+    except FileNotFoundError:
+        return []
+
+
+def _remove(path: str):
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class Reconciler:
+    '''
+    Background upkeep of the data volume and the uploads collection, in small, paced passes:
+
+    - reclaims the bytes of removed objects: removing an object (DELETE /delete/{object_id}, or one of the policies
+      below) only records a tombstone and removes the document, and the blob reference (or the legacy data
+      directory) is released here;
+    - removes objects still 'started' after STARTED_TTL and, if configured, 'failed' ones after FAILED_RETENTION and
+      finished ones after RETENTION or beyond their submitter's quota;
+    - removes what nothing references any more: blob files and sidecar directories without a blob document,
+      {object_id}-data directories without an object, and stale files in the blob store's .incoming and .trash;
+    - corrects blob reference counts that have drifted from the number of objects referencing them.
+
+    Every item costs a pause (OPS_PER_SECOND), which stretches while this worker has more than MAX_IN_FLIGHT
+    requests to serve. Only the holder of a lease in mongo runs passes, so that several workers don't repeat
+    each other's work; every step is safe to repeat if a pass is cut short.
+    '''
+
+    def __init__(self, uploads: UploadsCollection, blob_store: BlobStore, config: ReconcileConfig = None,
+                 on_object_removed=None, on_bytes_freed=None):
+        self.uploads = uploads
+        self.blob_store = blob_store
+        self.tombstones = uploads.sibling("tombstones")
+        self.leases = uploads.sibling("leases")
+        self.config = config if config is not None else g_reconcile_config
+        # hooks for this process's caches
+        self.on_object_removed = on_object_removed if on_object_removed is not None else (lambda object_id: None)
+        self.on_bytes_freed = on_bytes_freed if on_bytes_freed is not None else (lambda path: None)
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._wake = asyncio.Event()
+        # where the incremental scans pick up on the next pass
+        self._shard = 0
+        self._blob_after = None
+
+    async def remove(self, entry: dict, reason: str):
+        '''
+        Remove an object as far as clients can tell: a tombstone records where its bytes are, then its document
+        (entry, with at least the fields in _ENTRY_FIELDS) is deleted. The bytes are reclaimed by the next pass.
+        Returns the document's DeleteResult, or None if the object is already being removed.
+        '''
+        try:
+            await self.tombstones.insert_one({"_id": entry["_id"],
+                                              "object_id": entry["object_id"],
+                                              "blob": entry.get("blob"),
+                                              "blob_encoding": entry.get("blob_encoding"),
+                                              "reason": reason,
+                                              "removed_time": datetime.datetime.utcnow()})
+        except DuplicateKeyError:
+            return None
+        ret = await self.uploads.delete_one({"_id": entry["_id"]})
+        self.on_object_removed(entry["object_id"])
+        self._wake.set()
+        return ret
+
+    async def _pace(self):
+        deferred = 0.0
+        while g_health.in_flight > self.config.MAX_IN_FLIGHT and deferred < self.config.MAX_DEFER:
+            await asyncio.sleep(0.1)
+            deferred += 0.1
+        if self.config.OPS_PER_SECOND > 0:
+            await asyncio.sleep(1 / self.config.OPS_PER_SECOND)
+
+    async def lead(self):
+        '''
+        Take or renew the lease; False if another worker holds it.
+        '''
+        now = datetime.datetime.utcnow()
+        try:
+            await self.leases.find_one_and_update({"_id": _LEASE_ID, "$or": [{"owner": self.owner}, {"expires": {"$lt": now}}]},
+                                                  {"$set": {"owner": self.owner, "expires": now + datetime.timedelta(seconds=self.config.LEASE_SECONDS)}},
+                                                  upsert=True)
+            return True
+        except DuplicateKeyError:
+            return False
+
+    async def reclaim(self):
+        '''
+        Release the bytes of removed objects, oldest tombstones first.
+        '''
+        reclaimed = 0
+        for tombstone in await self.tombstones.find({}, limit=self.config.BATCH_SIZE, sort=[("removed_time", ASCENDING)]):
+            await self._pace()
+            # normally gone already; not if the remover died between the tombstone and the delete
+            await self.uploads.delete_one({"_id": tombstone["_id"]})
+            blob = tombstone.get("blob")
+            if blob is not None:
+                # keyed by the tombstone, so a release retried after a crash isn't counted twice
+                token = str(tombstone["_id"])
+                if await self.blob_store.release(blob, token):
+                    self.on_bytes_freed(self.blob_store.stored_path(blob, tombstone.get("blob_encoding") or IDENTITY))
+                await self.tombstones.delete_one({"_id": tombstone["_id"]})
+                await self.blob_store.forget_release(blob, token)
+            else:
+                # stored before the blob store existed (or never stored at all)
+                path = self.blob_store.legacy_dir(tombstone["object_id"])
+                await run_in_threadpool(shutil.rmtree, path, True)
+                self.on_bytes_freed(path)
+                await self.tombstones.delete_one({"_id": tombstone["_id"]})
+            logger.info(f"reclaimed the bytes of {tombstone['object_id']} ({tombstone['reason']})")
+            reclaimed += 1
+        return reclaimed
+
+    async def expire(self):
+        '''
+        Remove the objects the policies say are due: stale 'started' ones, old 'failed' ones, and finished ones past
+        RETENTION or over their submitter's quota.
+        '''
+        now = datetime.datetime.utcnow()
+        removed = 0
+        for status, ttl, reason in (("started", self.config.STARTED_TTL, "stale"),
+                                    ("failed", self.config.FAILED_RETENTION, "failed"),
+                                    ("finished", self.config.RETENTION, "retention")):
+            if ttl <= 0:
+                continue
+            cutoff = now - datetime.timedelta(seconds=ttl)
+            for entry in await self.uploads.find({"status": status, "created_time": {"$lt": cutoff}}, _ENTRY_FIELDS, limit=self.config.BATCH_SIZE):
+                await self._pace()
+                if await self.remove(entry, reason) is not None:
+                    logger.info(f"removed {status} object {entry['object_id']} ({reason})")
+                    removed += 1
+        if self.config.SUBMITTER_QUOTA_BYTES > 0:
+            removed += await self._enforce_quota()
+        return removed
+
+    async def _enforce_quota(self):
+        quota = self.config.SUBMITTER_QUOTA_BYTES
+        over = await self.uploads.aggregate([{"$match": {"status": "finished"}},
+                                             {"$group": {"_id": "$submitter_id", "bytes": {"$sum": "$size"}}},
+                                             {"$match": {"bytes": {"$gt": quota}}}])
+        removed = 0
+        for submitter in over:
+            excess = submitter["bytes"] - quota
+            # oldest first, until the submitter is back within quota
+            for entry in await self.uploads.find({"submitter_id": submitter["_id"], "status": "finished"}, _ENTRY_FIELDS,
+                                                 limit=self.config.BATCH_SIZE, sort=[("_id", ASCENDING)]):
+                if excess <= 0:
+                    break
+                await self._pace()
+                if await self.remove(entry, "quota") is not None:
+                    logger.warning(f"removed {entry['object_id']}: {submitter['_id']} is {excess} bytes over the quota of {quota}")
+                    excess -= entry.get("size") or 0
+                    removed += 1
+        return removed
+
+    async def scan_volume(self):
+        '''
+        Remove files nothing refers to: leftovers in the blob store's staging directories, blob files and sidecars
+        without a blob document (a shard directory or more per pass), and legacy data directories without an object.
+        Nothing modified within GRACE_SECONDS is touched.
+        '''
+        grace = self.config.GRACE_SECONDS
+        removed = 0
+        for directory in (self.blob_store.incoming_dir, self.blob_store.trash_dir):
+            for name in await run_in_threadpool(_list, directory):
+                path = os.path.join(directory, name)
+                age = _age(path)
+                if age is not None and age > grace:
+                    await self._pace()
+                    await run_in_threadpool(_remove, path)
+                    removed += 1
+
+        examined = 0
+        for _ in range(256):
+            if examined >= self.config.BATCH_SIZE:
+                break
+            shard_dir = os.path.join(self.blob_store.config.BLOB_DIR, f"{self._shard:02x}")
+            self._shard = (self._shard + 1) % 256
+            names = await run_in_threadpool(_list, shard_dir)
+            if len(names) == 0:
+                continue
+            await self._pace()
+            # blob files are {sha256}{encoding suffix}, their sidecars {blob file}.d
+            shas = {name.split(".", 1)[0] for name in names}
+            known = {blob["_id"] for blob in await self.blob_store.blobs.find({"_id": {"$in": list(shas)}}, {"_id": 1})}
+            for name in names:
+                path = os.path.join(shard_dir, name)
+                age = _age(path)
+                if name.split(".", 1)[0] not in known and age is not None and age > grace:
+                    await self._pace()
+                    await run_in_threadpool(_remove, path)
+                    self.on_bytes_freed(path)
+                    logger.info(f"removed orphaned {path}")
+                    removed += 1
+            examined += len(names)
+
+        data_dir = self.blob_store.storage_config.DATA_DIR
+        legacy = [name for name in await run_in_threadpool(_list, data_dir)
+                  if name.endswith("-data") and os.path.isdir(os.path.join(data_dir, name))]
+        for start in range(0, len(legacy), self.config.BATCH_SIZE):
+            names = legacy[start:start + self.config.BATCH_SIZE]
+            object_ids = [name[:-len("-data")] for name in names]
+            await self._pace()
+            # tombstoned objects' directories are the reclaimer's
+            known = {entry["object_id"] for entry in await self.uploads.find({"object_id": {"$in": object_ids}}, {"_id": 0, "object_id": 1})}
+            known |= {entry["object_id"] for entry in await self.tombstones.find({"object_id": {"$in": object_ids}}, {"_id": 0, "object_id": 1})}
+            for name, object_id in zip(names, object_ids):
+                path = os.path.join(data_dir, name)
+                age = _age(path)
+                if object_id not in known and age is not None and age > grace:
+                    await self._pace()
+                    await run_in_threadpool(shutil.rmtree, path, True)
+                    self.on_bytes_freed(path)
+                    logger.info(f"removed orphaned {path}")
+                    removed += 1
+        return removed
+
+    async def recount_blobs(self):
+        '''
+        Compare the reference counts of a batch of blobs, untouched for GRACE_SECONDS, with the objects referencing them,
+        correcting (and freeing) the ones that drifted, e.g. after a crash between storing bytes and recording them.
+        '''
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.config.GRACE_SECONDS)
+        query = {"$or": [{"touched_time": {"$lt": cutoff}}, {"touched_time": None, "created_time": {"$lt": cutoff}}]}
+        if self._blob_after is not None:
+            query["_id"] = {"$gt": self._blob_after}
+        blobs = await self.blob_store.blobs.find(query, {"refcount": 1, "touched_time": 1, "encoding": 1}, limit=self.config.BATCH_SIZE, sort=[("_id", ASCENDING)])
+        # pick up from the start again once the end is reached
+        self._blob_after = blobs[-1]["_id"] if len(blobs) == self.config.BATCH_SIZE else None
+        if len(blobs) == 0:
+            return 0
+        await self._pace()
+        shas = [blob["_id"] for blob in blobs]
+        references = {group["_id"]: group["n"] for group in await self.uploads.aggregate([{"$match": {"blob": {"$in": shas}}},
+                                                                                          {"$group": {"_id": "$blob", "n": {"$sum": 1}}}])}
+        # blobs with a removal in progress are the reclaimer's
+        pending = {tombstone["blob"] for tombstone in await self.tombstones.find({"blob": {"$in": shas}}, {"blob": 1})}
+        corrected = 0
+        for blob in blobs:
+            if blob["_id"] in pending or blob["refcount"] == references.get(blob["_id"], 0):
+                continue
+            await self._pace()
+            if await self.blob_store.recount(blob["_id"], blob, references.get(blob["_id"], 0)):
+                self.on_bytes_freed(self.blob_store.stored_path(blob["_id"], blob.get("encoding", IDENTITY)))
+            corrected += 1
+        return corrected
+
+    async def run_pass(self):
+        stats = {}
+        for name, step in (("expired", self.expire), ("reclaimed", self.reclaim), ("orphans_removed", self.scan_volume),
+                           ("refcounts_corrected", self.recount_blobs)):
+            # renewed before each step, in case a step is slow
+            if not await self.lead():
+                break
+            stats[name] = await step()
+        logger.info(f"reconcile pass: {stats}")
+        return stats
+
+    async def run(self):
+        '''
+        A full pass every INTERVAL seconds, and a reclaim whenever an object is removed in this worker.
+        '''
+        next_pass = time.monotonic()
+        while not g_health.draining:
+            try:
+                if g_health.database and await self.lead():
+                    if time.monotonic() >= next_pass:
+                        # also if the pass fails: it is retried on the next interval, not in a tight loop
+                        next_pass = time.monotonic() + self.config.INTERVAL
+                        await self.run_pass()
+                    else:
+                        await self.reclaim()
+            except Exception as e:
+                logger.error(f"Exception {type(e)} occurred while reconciling: {e}")
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=max(1.0, next_pass - time.monotonic()))
+            except asyncio.TimeoutError:
+                pass
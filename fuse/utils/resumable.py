@@ -0,0 +1,111 @@
+import asyncio
+import datetime
+import logging
+import os
+import shutil
+import uuid
+
+import aiofiles
+from starlette.concurrency import run_in_threadpool
+
+from fuse.models.Config import ResumableConfig, UploadConfig
+from fuse.utils.compression import IDENTITY, Encoder, choose_encoding
+from fuse.utils.db import UploadsCollection
+from fuse.utils.ingest import StreamingDigest
+
+logger = logging.getLogger("fuse-provider-upload")
+
+g_resumable_config = ResumableConfig()
+g_upload_config = UploadConfig()
+
+
+def session_path(upload_id: str):
+    return os.path.join(g_resumable_config.SESSION_DIR, upload_id)
+
+
+def part_path(upload_id: str, part_number: int):
+    return os.path.join(session_path(upload_id), f"{part_number:05d}.part")
+
+
+async def write_part(chunks, path: str, supplied_checksums=None, max_size: int = None):
+    '''
+    Stream a part's body (an async iterator of bytes) to path, hashing it on the way.
+    The part is written under a temporary name, verified against supplied_checksums and only then
+    renamed into place, so a re-sent part atomically replaces the previous attempt, a corrupt one
+    never does, and concurrent parts never see each other half-written.
+    '''
+    if max_size is None:
+        max_size = g_resumable_config.MAX_PART_SIZE
+    digest = StreamingDigest(["sha-256", "md5"])
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        async with aiofiles.open(tmp_path, 'wb') as out_file:
+            async for chunk in chunks:
+                digest.update(chunk)
+                if digest.size > max_size:
+                    raise ValueError(f"part exceeds the maximum part size ({max_size} bytes)")
+                await out_file.write(chunk)
+        digest.verify(supplied_checksums)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return digest
+
+
+def assemble_parts(part_paths, file_path: str, digest: StreamingDigest, storage_encoding: str = None):
+    '''
+    Concatenate the parts, in order, into file_path while computing the whole-object checksums, compressing
+    with storage_encoding (or the configured default) unless the head of the first part shows the object
+    is already compressed. Returns the digest and the encoding the file was written with.
+    Blocking; run it in the threadpool.
+    '''
+    encoder = None
+    with open(file_path, 'wb') as out_file:
+        for path in part_paths:
+            with open(path, 'rb') as part:
+                for chunk in iter(lambda: part.read(g_upload_config.CHUNK_SIZE), b""):
+                    if encoder is None:
+                        encoder = Encoder(choose_encoding(storage_encoding, chunk))
+                    digest.update(chunk)
+                    out_file.write(encoder.compress(chunk))
+        if encoder is None:
+            encoder = Encoder(IDENTITY)
+        out_file.write(encoder.flush())
+    return digest, encoder.encoding
+
+
+async def remove_session_dir(upload_id: str):
+    await run_in_threadpool(shutil.rmtree, session_path(upload_id), True)
+
+
+async def reap_sessions(sessions: UploadsCollection, ttl: int = None):
+    '''
+    Expire sessions that haven't changed within ttl seconds, freeing their parts: open ones that haven't seen a part
+    (or been created) since, and completing ones whose complete never finished, e.g., because its worker died while
+    assembling them. An object such a complete had registered is left 'started', for the reconciler's STARTED_TTL.
+    '''
+    if ttl is None:
+        ttl = g_resumable_config.SESSION_TTL
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=ttl)
+    abandoned = await sessions.find({"status": {"$in": ["open", "completing"]}, "updated_time": {"$lt": cutoff}}, {"_id": 0, "upload_id": 1, "status": 1})
+    for session in abandoned:
+        # only reap it if it is still idle; a part (or a complete) may have arrived since the query
+        reaped = await sessions.find_one_and_update({"upload_id": session["upload_id"], "status": session["status"], "updated_time": {"$lt": cutoff}},
+                                                    {"$set": {"status": "expired", "updated_time": datetime.datetime.utcnow()}})
+        if reaped is not None:
+            await remove_session_dir(session["upload_id"])
+            logger.info(f"reaped abandoned upload session {session['upload_id']} ({session['status']})")
+    return len(abandoned)
+
+
+async def run_reaper(sessions: UploadsCollection, interval: int = None):
+    if interval is None:
+        interval = g_resumable_config.REAP_INTERVAL
+    while True:
+        try:
+            await reap_sessions(sessions)
+        except Exception as e:
+            logger.error(f"Exception {type(e)} occurred while reaping upload sessions: {e}")
+        await asyncio.sleep(interval)
@@ -0,0 +1,63 @@
+import base64
+import datetime
+import json
+
+from bson import ObjectId
+from fastapi.encoders import jsonable_encoder
+
+# fields that can't be asked for with `fields`; _id is only used internally, as the paging key
+_HIDDEN_FIELDS = {"_id"}
+
+
+def encode_page_token(last_id: ObjectId) -> str:
+    return base64.urlsafe_b64encode(last_id.binary).decode("ascii").rstrip("=")
+
+
+def decode_page_token(token: str) -> ObjectId:
+    '''
+    Raises ValueError if the token wasn't issued by encode_page_token.
+    '''
+    try:
+        return ObjectId(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+    except Exception:
+        raise ValueError(f"invalid page token ({token})")
+
+
+def search_filter(base: dict, data_type=None, file_type=None, status=None,
+                  created_after: datetime.datetime = None, created_before: datetime.datetime = None, page_token: str = None):
+    '''
+    Adds the optional filters to base. Results are ordered by _id (insertion order), so a page token
+    is simply the last _id returned, and the next page starts after it; pages stay stable while new
+    objects are added.
+    '''
+    query = dict(base)
+    for field, value in (("data_type", data_type), ("file_type", file_type), ("status", status)):
+        if value is not None:
+            query[field] = getattr(value, "value", value)
+    created = {}
+    if created_after is not None:
+        created["$gte"] = created_after
+    if created_before is not None:
+        created["$lt"] = created_before
+    if created:
+        query["created_time"] = created
+    if page_token is not None:
+        query["_id"] = {"$gt": decode_page_token(page_token)}
+    return query
+
+
+def search_projection(fields: str):
+    '''
+    Projection for a comma-separated list of top-level field names; _id is always included for paging.
+    '''
+    names = [name.strip() for name in fields.split(",") if name.strip() != ""]
+    for name in names:
+        if name in _HIDDEN_FIELDS or name.startswith("$"):
+            raise ValueError(f"field ({name}) can't be selected")
+    if len(names) == 0:
+        raise ValueError("no fields selected")
+    return {"_id": 1, **{name: 1 for name in names}}
+
+
+def ndjson_line(document: dict) -> bytes:
+    return (json.dumps(jsonable_encoder(document)) + "\n").encode("utf-8")
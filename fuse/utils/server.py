@@ -0,0 +1,83 @@
+import asyncio
+import logging
+from logging.config import dictConfig
+
+import uvicorn
+from uvicorn.supervisors import Multiprocess
+
+from fuse.models.Config import LogConfig, ServerConfig
+from fuse.utils.health import g_health
+
+logger = logging.getLogger("fuse-provider-upload")
+
+
+class DrainingServer(uvicorn.Server):
+    '''
+    uvicorn's server with a graceful drain. On the first SIGTERM/SIGINT the worker turns unready but keeps
+    accepting connections for DRAIN_SECONDS, giving the orchestrator time to stop routing to it; then the
+    listener closes and in-flight requests get up to GRACEFUL_TIMEOUT to finish before the app's shutdown
+    hooks run (which finish queued jobs and close the database). A second SIGINT exits at once.
+    '''
+
+    def __init__(self, config: uvicorn.Config, server_config: ServerConfig):
+        super().__init__(config)
+        self.server_config = server_config
+        self._gave_up = False
+
+    def handle_exit(self, sig, frame):
+        if g_health.draining:
+            return super().handle_exit(sig, frame)
+        g_health.begin_drain()
+        asyncio.get_event_loop().call_later(self.server_config.DRAIN_SECONDS, super().handle_exit, sig, frame)
+
+    def _give_up(self):
+        logger.warning(f"{len(self.server_state.connections)} connections still open after {self.server_config.GRACEFUL_TIMEOUT}s, closing them")
+        self._gave_up = True
+        self.force_exit = True
+
+    async def shutdown(self, sockets=None):
+        timer = asyncio.get_running_loop().call_later(self.server_config.GRACEFUL_TIMEOUT, self._give_up)
+        try:
+            await super().shutdown(sockets)
+        finally:
+            timer.cancel()
+        # uvicorn skips the shutdown hooks on a forced exit; a timed-out drain still needs them
+        if self._gave_up:
+            await self.lifespan.shutdown()
+
+
+class _Supervisor(Multiprocess):
+    # signal every worker before waiting for any, so they drain in parallel rather than one after the other
+    def shutdown(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join()
+        logger.info(f"stopped {len(self.processes)} workers")
+
+
+def serve(app: str, config: ServerConfig = None):
+    '''
+    Run app (an import string, e.g. "main:app", so that worker processes can import it) as configured.
+    '''
+    if config is None:
+        config = ServerConfig()
+    # uvicorn's loggers are configured by LogConfig, here and in the app, rather than by uvicorn
+    dictConfig(LogConfig().dict())
+    if config.RELOAD:
+        # the reloader restarts the process on every change; a drain would only slow it down
+        uvicorn.run(app, host=config.HOST, port=config.PORT, reload=True, log_config=None)
+        return
+    uvicorn_config = uvicorn.Config(app, host=config.HOST, port=config.PORT, workers=config.WORKERS, log_config=None)
+    server = DrainingServer(uvicorn_config, config)
+    logger.info(f"serving {app} on {config.HOST}:{config.PORT} with {config.WORKERS} worker(s)")
+    if config.WORKERS > 1:
+        _Supervisor(uvicorn_config, target=server.run, sockets=[uvicorn_config.bind_socket()]).run()
+    else:
+        server.run()
+
+
+if __name__ == "__main__":
+    # python -m fuse.utils.server [module:app]; worker processes re-import only this small module, not the app's
+    import sys
+    serve(sys.argv[1] if len(sys.argv) > 1 else "main:app")
@@ -0,0 +1,136 @@
+import logging
+import os
+import shutil
+import uuid
+
+from fuse.models.Config import StorageConfig
+
+logger = logging.getLogger("fuse-provider-upload")
+
+# access_ids of the access methods on an object
+FILES_ACCESS_ID = "files"
+S3_ACCESS_ID = "s3"
+
+
+class LocalStorage:
+    '''
+    Keeps blobs on the local filesystem under root, by key. When root is the blob store's own directory
+    (the default), every operation on a blob already in place is a no-op.
+    '''
+    remote = False
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def path(self, key: str):
+        return os.path.join(self.root, key)
+
+    def put(self, local_path: str, key: str):
+        path = self.path(key)
+        if os.path.abspath(path) == os.path.abspath(local_path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        shutil.copyfile(local_path, tmp_path)
+        os.replace(tmp_path, path)
+
+    def fetch(self, key: str, local_path: str):
+        shutil.copyfile(self.path(key), local_path)
+
+    def exists(self, key: str):
+        return os.path.exists(self.path(key))
+
+    def delete(self, key: str):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def presigned_url(self, key: str, file_name: str = None, media_type: str = None, encoding: str = None):
+        return None
+
+
+class S3Storage:
+    '''
+    Keeps blobs in an S3-compatible bucket (AWS, MinIO, ...), uploaded and downloaded as multipart transfers.
+    Hands out presigned GET URLs, so clients fetch the bytes from the bucket rather than through the API.
+    '''
+    remote = True
+
+    def __init__(self, config: StorageConfig):
+        try:
+            import boto3
+            from boto3.s3.transfer import TransferConfig
+            from botocore.config import Config
+        except ImportError:
+            raise ValueError("STORAGE_BACKEND=s3 requires the boto3 package")
+        self.config = config
+        self.bucket = config.S3_BUCKET
+        self.prefix = config.S3_PREFIX
+        # boto3 clients are thread-safe, so one is shared by the request threads and the job workers
+        self.client = boto3.client("s3",
+                                   endpoint_url=config.S3_ENDPOINT_URL,
+                                   region_name=config.S3_REGION,
+                                   aws_access_key_id=config.S3_ACCESS_KEY_ID,
+                                   aws_secret_access_key=config.S3_SECRET_ACCESS_KEY,
+                                   config=Config(signature_version="s3v4", s3={"addressing_style": config.S3_ADDRESSING_STYLE}))
+        self.transfer_config = TransferConfig(multipart_threshold=config.S3_MULTIPART_THRESHOLD, multipart_chunksize=config.S3_MULTIPART_THRESHOLD,
+                                              max_concurrency=config.S3_MAX_CONCURRENCY)
+
+    def _key(self, key: str):
+        return f"{self.prefix}{key}"
+
+    def put(self, local_path: str, key: str):
+        self.client.upload_file(local_path, self.bucket, self._key(key), Config=self.transfer_config)
+
+    def fetch(self, key: str, local_path: str):
+        self.client.download_file(self.bucket, self._key(key), local_path, Config=self.transfer_config)
+
+    def exists(self, key: str):
+        from botocore.exceptions import ClientError
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._key(key))
+            return True
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+
+    def delete(self, key: str):
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(key))
+
+    def presigned_url(self, key: str, file_name: str = None, media_type: str = None, encoding: str = None):
+        '''
+        A GET URL for the key, valid for PRESIGN_EXPIRES seconds; the response headers the API would have sent
+        (file name, type, encoding of the stored bytes) are signed into it.
+        '''
+        params = {"Bucket": self.bucket, "Key": self._key(key)}
+        if file_name is not None:
+            params["ResponseContentDisposition"] = f"attachment; filename={file_name}"
+        if media_type is not None:
+            params["ResponseContentType"] = media_type
+        if encoding is not None:
+            params["ResponseContentEncoding"] = encoding
+        return self.client.generate_presigned_url("get_object", Params=params, ExpiresIn=self.config.PRESIGN_EXPIRES)
+
+
+def make_storage(blob_dir: str, config: StorageConfig = None):
+    if config is None:
+        config = StorageConfig()
+    logger.info(f"using '{config.BACKEND}' storage")
+    if config.BACKEND == "s3":
+        return S3Storage(config)
+    return LocalStorage(blob_dir)
+
+
+def access_methods(object_id: str, remote: bool, config: StorageConfig = None):
+    '''
+    The DRS access_methods of a stored object: always its /files URL on this API, and, once its bytes are
+    in the bucket, an access_id resolved to a presigned URL by /objects/{object_id}/access/{access_id}.
+    '''
+    if config is None:
+        config = StorageConfig()
+    methods = [{"type": "https", "access_id": FILES_ACCESS_ID, "access_url": {"url": f"{config.PUBLIC_URL}/files/{object_id}"}}]
+    if remote:
+        methods.append({"type": "s3", "access_id": S3_ACCESS_ID, "region": config.S3_REGION})
+    return methods
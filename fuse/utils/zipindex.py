@@ -0,0 +1,142 @@
+import logging
+import mimetypes
+import os
+import threading
+import zipfile
+from collections import OrderedDict
+
+from fuse.models.Config import DownloadConfig
+from fuse.utils.compression import is_compressed
+
+logger = logging.getLogger("fuse-provider-upload")
+
+g_download_config = DownloadConfig()
+
+
+class ZipIndexCache:
+    '''
+    LRU of open ZipFile objects, so an archive's central directory is parsed once rather than on
+    every member request. Entries are keyed by path and invalidated when the file's mtime or size
+    changes. ZipFile reference-counts its file handle, so evicting an archive that is still being
+    streamed doesn't cut the stream off.
+    '''
+
+    def __init__(self, max_entries: int = None):
+        self.max_entries = max_entries if max_entries is not None else g_download_config.ZIP_INDEX_CACHE_SIZE
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, path: str) -> zipfile.ZipFile:
+        stat = os.stat(path)
+        key = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            cached = self._entries.get(path)
+            if cached is not None and cached[0] == key:
+                self._entries.move_to_end(path)
+                return cached[1]
+        logger.info(f"indexing {path}")
+        archive = zipfile.ZipFile(path)
+        with self._lock:
+            stale = self._entries.pop(path, None)
+            self._entries[path] = (key, archive)
+            evicted = [stale[1]] if stale is not None else []
+            while len(self._entries) > self.max_entries:
+                evicted.append(self._entries.popitem(last=False)[1][1])
+        for old in evicted:
+            old.close()
+        return archive
+
+    def invalidate(self, path: str):
+        '''
+        Drop (and close) the cached archive at path, or every one under it if it's a directory, e.g. when an object is deleted.
+        '''
+        prefix = os.path.join(path, "")
+        with self._lock:
+            evicted = [self._entries.pop(cached)[1] for cached in list(self._entries) if cached == path or cached.startswith(prefix)]
+        for archive in evicted:
+            archive.close()
+
+
+def find_member(archive: zipfile.ZipFile, member: str) -> zipfile.ZipInfo:
+    '''
+    Look a member up by its full path in the archive, or by its file name as listed in the
+    object's `contents`; raises KeyError if there is no such member or the name is ambiguous.
+    '''
+    try:
+        return archive.getinfo(member)
+    except KeyError:
+        pass
+    matches = [info for info in archive.infolist() if not info.is_dir() and os.path.basename(info.filename) == member]
+    if len(matches) != 1:
+        raise KeyError(f"{len(matches)} members of {archive.filename} match ({member})")
+    return matches[0]
+
+
+def member_media_type(member: str):
+    return mimetypes.guess_type(member)[0] or "application/octet-stream"
+
+
+def iter_member(archive: zipfile.ZipFile, info: zipfile.ZipInfo, start: int = 0, end: int = None, chunk_size: int = None):
+    '''
+    Yield the decompressed bytes [start, end] of a member straight from the archive, without
+    extracting it. Seeking within a deflated member means decompressing up to start, but nothing
+    before it is sent or kept.
+    '''
+    if chunk_size is None:
+        chunk_size = g_download_config.CHUNK_SIZE
+    if end is None:
+        end = info.file_size - 1
+    with archive.open(info) as member_file:
+        if start > 0:
+            member_file.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = member_file.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+class _Chunks:
+    # write-only, unseekable sink: ZipFile falls back to data descriptors, and what it writes is collected for the generator
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        chunks, self.chunks = self.chunks, []
+        return b"".join(chunks)
+
+
+def iter_zip(paths, chunk_size: int = None):
+    '''
+    Yield a zip archive of the files at paths (stored under their base names) as it is built: nothing
+    is written to disk and at most about a chunk is buffered, whatever the size of the files. Files that
+    are already compressed are stored; everything else is deflated. Blocking; iterate it in the threadpool.
+    '''
+    if chunk_size is None:
+        chunk_size = g_download_config.CHUNK_SIZE
+    sink = _Chunks()
+    with zipfile.ZipFile(sink, "w") as archive:
+        for path in paths:
+            info = zipfile.ZipInfo.from_file(path, os.path.basename(path), strict_timestamps=False)
+            with open(path, "rb") as f:
+                chunk = f.read(chunk_size)
+                info.compress_type = zipfile.ZIP_STORED if is_compressed(chunk) else zipfile.ZIP_DEFLATED
+                # sizes aren't known up front on an unseekable stream; zip64 keeps members over 2GiB valid
+                with archive.open(info, "w", force_zip64=True) as member:
+                    while chunk:
+                        member.write(chunk)
+                        data = sink.take()
+                        if data:
+                            yield data
+                        chunk = f.read(chunk_size)
+            yield sink.take()
+    yield sink.take()
@@ -1,25 +1,42 @@
+import asyncio
 import datetime
 import json
 import logging
 import os
-import shutil
+import sys
 import traceback
 import uuid
-import zipfile
 from logging.config import dictConfig
+from typing import List
 
-import aiofiles
-import magic
-import pymongo
-import uvicorn
-from fastapi import FastAPI, Depends, Path, Query, File, UploadFile
+from pymongo import ASCENDING, IndexModel, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
+from pymongo.results import DeleteResult
+from fastapi import FastAPI, Depends, Path, Query, File, Form, UploadFile, Request
 from fastapi import HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fuse_cdm.main import ProviderParameters, Passports
-from starlette.responses import StreamingResponse
-
-from fuse.models.Config import LogConfig
-from fuse.models.Objects import ProviderExampleObject
+from fuse_cdm.main import DataType, FileType, ProviderParameters, Passports
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import RedirectResponse, Response, StreamingResponse
+
+from fuse.models.Config import DownloadConfig, DrsConfig, LogConfig, MongoConfig, ObjectCacheConfig, ResumableConfig, SearchConfig, ServerConfig, UploadConfig
+from fuse.models.Objects import BulkObjectAccessIds, BulkObjectIds, ProviderExampleObject
+from fuse.utils.blobs import BlobStore, derived_path
+from fuse.utils.cache import ObjectCache
+from fuse.utils.compression import ENCODINGS, IDENTITY, SUFFIXES, accepts, iter_decoded
+from fuse.utils.db import UploadsCollection
+from fuse.utils.health import InFlightMiddleware, g_health
+from fuse.utils.ingest import StreamingDigest, checksum_types_for, stream_to_file
+from fuse.utils.jobs import make_job_queue, process_upload, use_uploads
+from fuse.utils.logs import RequestIdMiddleware, summarize
+from fuse.utils.matrix import MatrixCache, iter_slice_csv, slice_to_json, slice_to_npz
+from fuse.utils.metrics import MetricsMiddleware, g_metrics_config, render, stage
+from fuse.utils.reconcile import Reconciler, g_reconcile_config
+from fuse.utils.ranges import FileRangeResponse, RangeNotSatisfiable, etag_for, etag_matches, parse_range
+from fuse.utils.resumable import assemble_parts, part_path, remove_session_dir, run_reaper, session_path, write_part
+from fuse.utils.search import encode_page_token, ndjson_line, search_filter, search_projection
+from fuse.utils.storage import FILES_ACCESS_ID, S3_ACCESS_ID, access_methods
+from fuse.utils.zipindex import ZipIndexCache, find_member, iter_member, iter_zip, member_media_type
 
 dictConfig(LogConfig().dict())
 logger = logging.getLogger("fuse-provider-upload")
@@ -33,6 +50,13 @@ g_container_port = os.getenv('API_PORT')
 
 g_api_version = "0.0.1"
 
+g_download_config = DownloadConfig()
+g_drs_config = DrsConfig()
+g_resumable_config = ResumableConfig()
+g_search_config = SearchConfig()
+g_server_config = ServerConfig()
+g_upload_config = UploadConfig()
+
 app = FastAPI(openapi_url=f"/api/{g_api_version}/openapi.json",
               title="Upload Provider",
               description="Fuse-certified Tool for serving data that can be submitted by individuals. Can stand alone or integrated with other data sources and tools using http://github.com/RENCI/fuse-agent.",
@@ -64,71 +88,349 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+if g_metrics_config.ENABLED:
+    # outermost, so the time and bytes of everything below it are counted
+    app.add_middleware(MetricsMiddleware, routes=lambda: app.routes)
+# outside the metrics middleware, so its slow-request log carries the request id too
+app.add_middleware(RequestIdMiddleware)
+# counts the requests being served, which the reconciler makes way for
+app.add_middleware(InFlightMiddleware)
 
 # mongo_client = pymongo.MongoClient('mongodb://%s:%s@upload-tx-persistence:27018/test' % (os.getenv('MONGO_NON_ROOT_USERNAME'), os.getenv('MONGO_NON_ROOT_PASSWORD')))
 # mongo_db = mongo_client["test"]
 # mongo_db_datasets_column = mongo_db["uploads"]
-mongo_client_str = os.getenv("MONGO_CLIENT")
-logger.info(f"connecting to {mongo_client_str}")
-mongo_client = pymongo.MongoClient(mongo_client_str)
+# all database access goes through this, so pymongo calls never block the event loop;
+# pymongo connects in the background, so nothing here waits for (or fails without) the server
+mongo_uploads = UploadsCollection(MongoConfig())
+mongo_db_version = None
+
+job_queue = make_job_queue()
+zip_index_cache = ZipIndexCache()
+matrix_cache = MatrixCache()
+upload_sessions = mongo_uploads.sibling("upload_sessions")
+blob_store = BlobStore(mongo_uploads.sibling("blobs"))
+use_uploads(mongo_uploads, blob_store)
+object_cache = ObjectCache(ObjectCacheConfig())
+
+
+def _forget_bytes(path: str):
+    zip_index_cache.invalidate(path)
+    matrix_cache.invalidate(derived_path(path))
+
+
+reconciler = Reconciler(mongo_uploads, blob_store, on_object_removed=object_cache.invalidate, on_bytes_freed=_forget_bytes)
+g_resumable_reaper = None
+g_reconciler = None
+g_connect_task = None
+
+
+async def create_indexes():
+    await run_in_threadpool(mongo_uploads.ensure_indexes, [
+        IndexModel([("object_id", ASCENDING)], unique=True),
+        # also serves /search/{submitter_id}, which pages in _id order
+        IndexModel([("submitter_id", ASCENDING), ("_id", ASCENDING)]),
+        IndexModel([("data_type", ASCENDING)]),
+        # finding an already-processed twin of a new upload
+        IndexModel([("blob", ASCENDING), ("status", ASCENDING)]),
+        # the reconciler's expiry of stale, failed and retained objects
+        IndexModel([("status", ASCENDING), ("created_time", ASCENDING)])
+    ])
+    await run_in_threadpool(reconciler.tombstones.ensure_indexes, [
+        IndexModel([("removed_time", ASCENDING)]),
+        IndexModel([("blob", ASCENDING)]),
+        IndexModel([("object_id", ASCENDING)])
+    ])
+    await run_in_threadpool(upload_sessions.ensure_indexes, [
+        IndexModel([("upload_id", ASCENDING)], unique=True),
+        IndexModel([("status", ASCENDING), ("updated_time", ASCENDING)])
+    ])
+
+
+async def _connect_database():
+    '''
+    Reach mongo, record its version and put the indexes in place; False if it can't be reached yet.
+    '''
+    global mongo_db_version
+    try:
+        mongo_db_version = await run_in_threadpool(mongo_uploads.server_version)
+    except PyMongoError as e:
+        logger.warning(f"mongodb can't be reached yet, retrying in {g_server_config.CONNECT_RETRY_SECONDS}s: {e}")
+        return False
+    logger.info(f"mongodb version = {mongo_db_version}")
+    await create_indexes()
+    g_health.database = True
+    return True
+
+
+async def _keep_connecting():
+    while not await _connect_database():
+        await asyncio.sleep(g_server_config.CONNECT_RETRY_SECONDS)
+
+
+@app.on_event("startup")
+async def connect_database():
+    '''
+    If mongo is down, the worker still starts (live, but not ready) and keeps trying in the background.
+    '''
+    global g_connect_task
+    if not await _connect_database():
+        g_connect_task = asyncio.create_task(_keep_connecting())
 
-mongo_db = mongo_client.test
-mongo_db_version = mongo_db.command({'buildInfo': 1})['version']
-mongo_db_major_version = mongo_client.server_info()["versionArray"][0]
-mongo_db_minor_version = mongo_client.server_info()["versionArray"][1]
-mongo_uploads = mongo_db.uploads
 
+@app.on_event("startup")
+async def start_resumable_reaper():
+    global g_resumable_reaper
+    g_resumable_reaper = asyncio.create_task(run_reaper(upload_sessions))
 
-# SHARED
-# mongo migration functions to support running outside of container with more current instance
-def _mongo_insert(fn, coll, obj):
-    if mongo_db_major_version < 4:
-        logger.info(f"[{fn}] using collection.insert")
-        coll.insert(obj)
-    else:
-        logger.info(f"[{fn}] using collection.insert_one")
-        coll.insert_one(obj)
 
+@app.on_event("startup")
+async def start_reconciler():
+    global g_reconciler
+    if g_reconcile_config.ENABLED:
+        g_reconciler = asyncio.create_task(reconciler.run())
 
-def _mongo_count(coll, obj):
-    if mongo_db_major_version < 3 and mongo_db_minor_version < 7:
-        logger.info(f"mongodb version = {mongo_db_version}, use deprecated entry count function")
-        entry = coll.find(obj, {})
-        num_matches = entry[0].count()
-    else:
-        logger.info(f"mongo_db version = {mongo_db_version}, use count_documents function")
-        num_matches = coll.count_documents(obj)
-    logger.info(f"found ({num_matches}) matches")
-    return num_matches
 
+@app.on_event("startup")
+async def startup_done():
+    g_health.started = True
 
-# end mongo migration functions
 
+@app.on_event("shutdown")
+async def stop_resumable_reaper():
+    if g_resumable_reaper is not None:
+        g_resumable_reaper.cancel()
 
-def _gen_object_id(prefix, submitter_id, requested_object_id, coll):
+
+@app.on_event("shutdown")
+async def stop_reconciler():
+    if g_reconciler is not None:
+        g_reconciler.cancel()
+
+
+@app.on_event("shutdown")
+async def close_resources():
+    '''
+    Runs once in-flight requests are done: jobs already queued in-process are finished before the database is closed.
+    '''
+    g_health.begin_drain()
+    if g_connect_task is not None:
+        g_connect_task.cancel()
+    await run_in_threadpool(job_queue.close)
+    await run_in_threadpool(mongo_uploads.close)
+
+
+async def _gen_object_id(prefix, submitter_id, requested_object_id, coll):
+    '''
+    The requested object_id, or a new one if none was requested; 409 if the requested one is already taken.
+    '''
+    if requested_object_id is None:
+        return f"{prefix}_{submitter_id}_{uuid.uuid4()}"
+    logger.info(f"top prefex={prefix}, submitter={submitter_id}, requested:{requested_object_id}")
+    if await coll.find_one({"object_id": requested_object_id}, {"_id": 1}) is not None:
+        raise HTTPException(status_code=409, detail=f"! requested object_id ({requested_object_id}) is already taken")
+    return requested_object_id
+
+
+def _search_parameters(data_type: DataType = Query(default=None, description="only objects of this data_type"),
+                       file_type: FileType = Query(default=None, description="only objects of this file_type"),
+                       status: str = Query(default=None, description="only objects with this status, e.g. 'finished'"),
+                       created_after: datetime.datetime = Query(default=None, description="only objects created at or after this time (UTC)"),
+                       created_before: datetime.datetime = Query(default=None, description="only objects created before this time (UTC)"),
+                       fields: str = Query(default="object_id", description="comma-separated object fields to return"),
+                       limit: int = Query(default=None, ge=1, le=g_search_config.MAX_LIMIT,
+                                          description=f"maximum objects per page; defaults to {g_search_config.DEFAULT_LIMIT}, or everything when streaming"),
+                       page_token: str = Query(default=None, description="the Next-Page-Token from the previous page"),
+                       format: str = Query(default="json", regex="^(json|ndjson)$",
+                                           description="'ndjson' streams one object per line as they are read; if a limit cuts it short, the last line is {\"next_page_token\": ...}")):
+    return locals()
+
+
+async def _search(base: dict, params: dict, response: Response):
+    '''
+    One page of objects matching base and the search parameters, in insertion order. A JSON page
+    is returned as a list with the token for the next one, if any, in the Next-Page-Token header.
+    A page_token this API didn't issue, or fields that can't be selected, are a 400.
+    '''
     try:
-        object_id = f"{prefix}_{submitter_id}_{uuid.uuid4()}"
-        if requested_object_id is not None:
-            logger.info(f"top prefex={prefix}, submitter={submitter_id}, requested:{requested_object_id}")
-            entry = coll.find({"object_id": requested_object_id}, {"_id": 0, "object_id": 1})
-            num_matches = _mongo_count(coll, {"object_id": requested_object_id})
-            if num_matches >= 1:
-                logger.info(f"found ({num_matches}) matches for requested object_id={requested_object_id}")
-                return requested_object_id
-        return object_id
+        query = search_filter(base, params["data_type"], params["file_type"], params["status"],
+                              params["created_after"], params["created_before"], params["page_token"])
+        projection = search_projection(params["fields"])
+    except ValueError as e:
+        # a page_token this API didn't issue, or fields that can't be selected
+        raise HTTPException(status_code=400, detail=f"! {e}")
+    limit = params["limit"]
+    sort = [("_id", ASCENDING)]
+    if params["format"] == "ndjson":
+        async def stream():
+            last_id = None
+            sent = 0
+            # one extra document tells whether there is another page
+            async for document in mongo_uploads.iter_find(query, projection, limit=limit + 1 if limit is not None else 0, sort=sort,
+                                                          batch_size=g_search_config.STREAM_BATCH_SIZE):
+                if limit is not None and sent == limit:
+                    yield ndjson_line({"next_page_token": encode_page_token(last_id)})
+                    break
+                last_id = document.pop("_id")
+                sent += 1
+                yield ndjson_line(document)
+            logger.info(f"[search] streamed {sent} objects")
+
+        return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+    if limit is None:
+        limit = g_search_config.DEFAULT_LIMIT
+    ret = await mongo_uploads.find(query, projection, limit=limit + 1, sort=sort)
+    if len(ret) > limit:
+        ret = ret[:limit]
+        response.headers["Next-Page-Token"] = encode_page_token(ret[-1]["_id"])
+    for document in ret:
+        del document["_id"]
+    logger.info(f"[search] returning {len(ret)} objects")
+    return ret
+
+
+@app.post("/admin/objects", description="Admin function for listing all objects. Useful for debugging database inconsistencies. Paged like /search/{submitter_id}")
+async def list_all(response: Response, params: dict = Depends(_search_parameters)):
+    try:
+        return await _search({}, params, response)
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.exception(f"? Exception {type(e)} occurred when using {requested_object_id}, using {object_id} instead. message=[{e}] ! traceback={traceback.format_exc()}")
+        raise HTTPException(status_code=500,
+                            detail=f"! Exception {type(e)} occurred while retrieving object_ids for submitter=(message=[{e}] ! traceback={traceback.format_exc()}")
 
 
-@app.post("/admin/objects", description="Admin function for listing all objects. Useful for debugging database inconsistencies")
-async def list_all():
+@app.post("/admin/reconcile", description="Admin function for running a reconciler pass now, rather than waiting for the next one; returns what it did")
+async def reconcile_now():
+    if not await reconciler.lead():
+        raise HTTPException(status_code=409, detail="another worker holds the reconciler lease, its next pass is due within RECONCILE_INTERVAL")
     try:
-        ret = list(map(lambda a: a, mongo_uploads.find({}, {"_id": 0, "object_id": 1})))
-        logger.info(f"ret:{ret}")
-        return ret
+        return await reconciler.run_pass()
     except Exception as e:
         raise HTTPException(status_code=500,
-                            detail=f"! Exception {type(e)} occurred while retrieving object_ids for submitter=(message=[{e}] ! traceback={traceback.format_exc()}")
+                            detail=f"! Exception {type(e)} occurred while reconciling, message=[{e}] ! traceback={traceback.format_exc()}")
+
+
+async def _new_object(parameters: ProviderParameters, file_name: str):
+    '''
+    Registers a new object as 'started' and creates its data directory; shared by every ingest path. Raises a 409
+    HTTPException if the requested object_id is taken.
+    '''
+    object_id = await _gen_object_id("upload", parameters.submitter_id, parameters.requested_object_id, mongo_uploads)
+
+    meta_data, drs_uri = _object_metadata(object_id, parameters, file_name)
+    logger.debug(f"new object metadata = {summarize(meta_data)}")
+    try:
+        row_id = (await mongo_uploads.insert_one(meta_data)).inserted_id
+    except DuplicateKeyError:
+        # requested by a concurrent upload since it was looked up
+        raise HTTPException(status_code=409, detail=f"! requested object_id ({object_id}) is already taken")
+    logger.info(f"new object {object_id} for client file_name={file_name}, row_id={row_id}")
+    return object_id, drs_uri
+
+
+def _object_metadata(object_id: str, parameters: ProviderParameters, file_name: str):
+    '''
+    The document for a new object in the 'started' state, and its drs_uri.
+    '''
+    drs_uri = f"drs:///{g_host_name}:{g_host_port}/{g_container_network}/{g_container_name}:{g_container_port}/{object_id}",
+
+    meta_data = {"object_id": object_id,
+                 "id": object_id,
+                 "name": file_name,
+                 "description": parameters.description,
+                 "self_uri": drs_uri,
+                 "size": None,
+                 "dimension": None,
+                 "columns": None,
+                 "created_time": datetime.datetime.utcnow(),
+                 "updated_time": None,
+                 "version": parameters.version,
+                 "mime_type": None,
+                 "aliases": parameters.aliases,
+                 "checksums": [c.dict() for c in parameters.checksums] if parameters.checksums is not None else None,
+                 "access_methods": None,
+                 "contents": None,
+                 "data_type": parameters.data_type,
+                 "submitter_id": parameters.submitter_id,
+                 "file_type": parameters.file_type,
+                 "status": "started",
+                 "stderr": None,
+                 "blob": None,
+                 "blob_encoding": None,
+                 "matrices": None
+                 }
+    return meta_data, drs_uri
+
+
+async def _gen_object_ids(prefix, parameters: List[ProviderParameters]):
+    '''
+    _gen_object_id for a batch, with a single lookup for all the requested object_ids. Returns the object_ids and, for
+    each, why it can't be registered (None if it can): the requested object_id is taken, or requested earlier in the batch.
+    '''
+    requested = [p.requested_object_id for p in parameters if p.requested_object_id is not None]
+    taken = set()
+    if len(requested) > 0:
+        taken = {d["object_id"] for d in await mongo_uploads.find({"object_id": {"$in": requested}}, {"_id": 0, "object_id": 1})}
+    object_ids = []
+    refused = []
+    for p in parameters:
+        if p.requested_object_id is None:
+            object_ids.append(f"{prefix}_{p.submitter_id}_{uuid.uuid4()}")
+            refused.append(None)
+        elif p.requested_object_id in taken:
+            object_ids.append(p.requested_object_id)
+            refused.append(f"! requested object_id ({p.requested_object_id}) is already taken")
+        else:
+            taken.add(p.requested_object_id)
+            object_ids.append(p.requested_object_id)
+            refused.append(None)
+    return object_ids, refused
+
+
+async def _update_object(object_id: str, update: dict):
+    '''
+    Every change to an object document goes through here so that it is never served stale from the object cache.
+    '''
+    ret = await mongo_uploads.update_one({"object_id": object_id}, update)
+    object_cache.invalidate(object_id)
+    return ret
+
+
+async def _update_objects(updates: list):
+    '''
+    _update_object for a list of (object_id, update), in one bulk write.
+    '''
+    if len(updates) == 0:
+        return None
+    ret = await mongo_uploads.bulk_write([UpdateOne({"object_id": object_id}, update) for object_id, update in updates], ordered=False)
+    for object_id, _ in updates:
+        object_cache.invalidate(object_id)
+    return ret
+
+
+async def _object_stored(object_id: str, incoming_path: str, drs_uri, digest: StreamingDigest, encoding: str = IDENTITY):
+    '''
+    Moves bytes that are now safely on disk (written with encoding) into the blob store, records their size
+    and checksums, and queues the rest of the processing.
+    '''
+    with stage("blob_commit"):
+        blob, blob_encoding = await blob_store.commit(incoming_path, digest, encoding)
+    await _update_object(object_id,
+                         {"$set": {
+                             "size": digest.size,
+                             "checksums": digest.checksums,
+                             "blob": blob,
+                             "blob_encoding": blob_encoding,
+                             "updated_time": datetime.datetime.utcnow()
+                         }})
+    ret = await api_provider_object(object_id)
+
+    # the bytes are safe; MIME sniffing, profiling and zip indexing happen on a queue worker
+    with stage("enqueue"):
+        job_id = await run_in_threadpool(job_queue.enqueue, process_upload, object_id, blob_store.stored_path(blob, blob_encoding), drs_uri, blob_encoding)
+    logger.info(f"queued job {job_id} for {object_id}")
+    return ret
 
 
 # API is described in:
@@ -138,137 +440,295 @@ async def list_all():
 # curl -X 'GET'    'http://localhost:8083/openapi.json' -H 'accept: application/json' 2> /dev/null |python -m json.tool |jq '.paths."/submit".post.parameters' -C |less
 # for example, an array of parameter names can be retrieved with:
 # curl -X 'GET'    'http://localhost:8083/openapi.json' -H 'accept: application/json' 2> /dev/null |python -m json.tool |jq '.paths."/submit".post.parameters[].name' 
-@app.post("/submit", description="Submit a digital object to be stored by this data provider")
-async def upload(parameters: ProviderParameters = Depends(ProviderParameters.as_form), client_file: UploadFile = File(...)):
-    logger.info(f"parameters: {parameters}")
+def _compression_parameters(compression: str = Query(default=None, regex=f"^({'|'.join(ENCODINGS)})$",
+                                                     description="how to store the object's bytes; defaults to the server's UPLOAD_COMPRESSION. Archives and already-compressed files are always stored as sent, "
+                                                                 "and bytes identical to an object already stored share its encoding; blob_encoding in the response is the one used"),
+                            content_encoding: str = Query(default=None, regex=f"^({'|'.join(e for e in ENCODINGS if e != IDENTITY)})$",
+                                                          description="the file is sent compressed (e.g., data.csv.gz); it is stored and described as the decompressed object, without the .gz/.zst suffix")):
+    return {"compression": compression, "content_encoding": content_encoding or IDENTITY}
+
+
+def _logical_name(file_name: str, content_encoding: str):
+    '''
+    The object's name for a file sent compressed: without the suffix of its encoding.
+    '''
+    suffix = SUFFIXES[content_encoding]
+    if suffix != "" and file_name is not None and file_name.lower().endswith(suffix):
+        return file_name[:-len(suffix)]
+    return file_name
+
+
+@app.post("/submit", status_code=202, description="Submit a digital object to be stored by this data provider")
+async def upload(parameters: ProviderParameters = Depends(ProviderParameters.as_form), client_file: UploadFile = File(...),
+                 compression: dict = Depends(_compression_parameters)):
+    logger.debug(f"parameters: {summarize(parameters)}")
     '''
     Please notes:
     - mime-type: mime types are limited to text, csv, and archive
     - A data_type: of 'class_dataset_expression' can either be a zip containing files named geneBySampleMatrix.csv and phenoDataMatrix.csv, or two separate files uploaded and with any file name. Expression data files have entrez-gene ids on the columns and samples on the rows. There is no header. The properties files (phenoDataMatrix.csv) has a header with arbitrary property/phenotype names on the columns and sample names on the rows. Row1 of phenoDataMatrix.csv corresponds to Column2 of geneBySampleMatrix.csv and so forth.
     - File status: will be set in the persistent database as 'started' when the upload begins, 'failed' if an exception is thrown', and 'finished' when complete, in accordance with redis job.status() codes.
+    - Processing is asynchronous: the object is returned with status 'started' (HTTP 202) as soon as its bytes are stored; poll /objects/{object_id} until the status is 'finished' or 'failed'.
     '''
+    object_id = None
+    incoming_path = blob_store.incoming_path()
     try:
-        # xxx use _gen_object_id here, but first replace _mongo_count signature to remove {fn}, projection file-wide
-        object_id = _gen_object_id("upload", parameters.submitter_id, parameters.requested_object_id, mongo_uploads)
-
-        logger.info(f"object_id={object_id}")
-        logger.info(f"client file_name={client_file.filename}")
-
-        drs_uri = f"drs:///{g_host_name}:{g_host_port}/{g_container_network}/{g_container_name}:{g_container_port}/{object_id}",
-        logger.info(f"drs_uri={drs_uri}")
-
-        meta_data = {"object_id": object_id,
-                     "id": object_id,
-                     "name": client_file.filename,
-                     "description": parameters.description,
-                     "self_uri": drs_uri,
-                     "size": None,
-                     "dimension": None,
-                     "created_time": datetime.datetime.utcnow(),
-                     "updated_time": None,
-                     "version": parameters.version,
-                     "mime_type": None,
-                     "aliases": parameters.aliases,
-                     "checksums": parameters.checksums,
-                     "access_methods": None,
-                     "contents": None,
-                     "data_type": parameters.data_type,
-                     "submitter_id": parameters.submitter_id,
-                     "file_type": parameters.file_type,
-                     "status": "started",
-                     "stderr": None
-                     }
-
-        logger.info(f"new object metatdata = {meta_data}")
-        row_id = mongo_uploads.insert_one(meta_data).inserted_id
-        logger.info(f"new row_id = {row_id}")
-
-        local_path = os.path.abspath(f"/app/data/{object_id}-data")
-        os.mkdir(local_path)
-        logger.info(f"localpath = {local_path}")
-        file_path = os.path.join(local_path, client_file.filename)
-        async with aiofiles.open(file_path, 'wb') as out_file:
-            contents = await client_file.read()
-            await out_file.write(contents)
-        logger.info(f"file upload done.")
-
-        # For MIME types
-        mime = magic.Magic(mime=True)
-        mime_type = mime.from_file(file_path)
-        logger.info(f"file type = {mime_type}")
-        assert (
-                mime_type == 'application/zip' or mime_type == 'application/csv' or mime_type == 'application/json' or mime_type == 'text/csv' or mime_type == 'text/plain' or 'application/vnd.ms-excel')
-
-        if mime_type in ['text/csv', 'application/csv', 'text/plain']:
-            with open(file_path) as f:
-                number_of_columns = len(f.readline().rstrip().split(sep=",")) - 1
-            f.close()
-
-            with open(file_path) as f:
-                number_of_rows = len(f.readlines())
-            f.close()
-
-            dimension = f"{number_of_rows}x{number_of_columns}"
-            meta_data["dimension"] = dimension
-
-        contents_list = []
-        if mime_type == 'application/zip':
-            logger.info(f"reading zip = {file_path}")
-            zip = zipfile.ZipFile(file_path)
-            for subfile_path in zip.namelist():
-                logger.info(f"  subfile_path = {subfile_path}")
-                [path_head, subfile_name] = os.path.split(subfile_path)
-                logger.info(f"  subfile_name = {subfile_name}")
-                subfile_drs_uri = f"{drs_uri}/{subfile_name}"
-                logger.info(f"  subfile_drs_uri={subfile_drs_uri}")
-                file_obj = {"id": subfile_name, "name": subfile_name, "drs_uri": subfile_drs_uri, "contents": None, "full_path": subfile_path}
-                # full_path is format: archive_name/file_name
-                # use full_path to extract from archive; e.g.:
-                #   with zip.open(full_path) as f:
-                #     f.read()
-                contents_list.append(file_obj)
-
-        meta_data["size"] = os.path.getsize(file_path)
-        meta_data["updated_time"] = datetime.datetime.utcnow()
-        meta_data["mime_type"] = mime_type
-        meta_data["contents"] = contents_list
-        meta_data["status"] = "finished"
-
-        logger.info(f"meta_data = {meta_data}")
-        mongo_uploads.update_one({"object_id": object_id},
-                                 {"$set": {
-                                     "size": meta_data["size"],
-                                     "dimension": meta_data["dimension"],
-                                     "updated_time": meta_data["updated_time"],
-                                     "mime_type": meta_data["mime_type"],
-                                     "contents": meta_data["contents"],
-                                     "status": meta_data["status"]
-                                 }})
-        logger.info(f"status of {object_id} updated to 'finished'")
-        # maybe check here if the file is an archive, and if so, set the list of files attribute
-
-        return api_provider_object(object_id)
-
+        supplied_checksums = [c.dict() for c in parameters.checksums] if parameters.checksums is not None else None
+        object_id, drs_uri = await _new_object(parameters, _logical_name(client_file.filename, compression["content_encoding"]))
+        # stream to disk in fixed-size chunks; size and checksums (of the decompressed bytes) are computed in the same pass
+        digest, encoding = await stream_to_file(client_file, incoming_path, StreamingDigest(checksum_types_for(supplied_checksums)),
+                                                content_encoding=compression["content_encoding"], storage_encoding=compression["compression"])
+        logger.info(f"file upload done, stored as {encoding}.")
+        digest.verify(supplied_checksums)
+
+        return await _object_stored(object_id, incoming_path, drs_uri, digest, encoding)
+
+    except HTTPException:
+        # the requested object_id is taken; nothing was registered or stored
+        raise
     except Exception as e:
+        if os.path.exists(incoming_path):
+            os.remove(incoming_path)
         # assume the upload failed and update the status accordingly
-        mongo_uploads.update_one({"object_id": object_id},
-                                 {"$set": {"start_date": datetime.datetime.utcnow(), "status": "failed"}})
+        await _update_object(object_id, {"$set": {"start_date": datetime.datetime.utcnow(), "status": "failed"}})
         logger.info(f"exception, setting upload status to failed for {object_id}")
         raise HTTPException(status_code=404,
                             detail=f"! Exception {type(e)} occurred while running upload for ({object_id}), message=[{e}] \n! traceback=\n{traceback.format_exc()}")
 
 
+def _batch_parameters(parameters: ProviderParameters, manifest: str, file_names: List[str]):
+    '''
+    Per-file parameters for /submit/batch: the shared form parameters, overridden by the file's manifest entry, if any.
+    '''
+    entries = {}
+    for entry in (json.loads(manifest) if manifest is not None else []):
+        assert isinstance(entry, dict) and "file_name" in entry, f"manifest entries must be objects with a file_name, got ({entry})"
+        entries[entry["file_name"]] = entry
+    unknown = set(entries) - set(file_names)
+    assert len(unknown) == 0, f"manifest names files that weren't sent: {sorted(unknown)}"
+    shared = parameters.dict()
+    return [ProviderParameters(**{**shared, **{k: v for k, v in entries.get(file_name, {}).items() if k != "file_name"}}) for file_name in file_names]
+
+
+@app.post("/submit/batch", status_code=202, description="Submit many digital objects to be stored by this data provider in one request")
+async def upload_batch(parameters: ProviderParameters = Depends(ProviderParameters.as_form),
+                       client_files: List[UploadFile] = File(...),
+                       manifest: str = Form(default=None, description="optional json list of per-file parameters, e.g. [{\"file_name\": \"a.csv\", \"requested_object_id\": \"...\", \"checksums\": [{\"type\": \"sha-256\", \"checksum\": \"...\"}]}]; fields given override the form parameters for that file"),
+                       compression: dict = Depends(_compression_parameters)):
+    '''
+    Like /submit, for many files at once. Files are stored concurrently (up to the configured limit) and the metadata
+    for the whole batch is written with bulk operations. One file failing doesn't fail the others: the response lists,
+    in the order the files were sent, each file's object_id, status ('started' or 'failed'), stderr and object.
+    '''
+    try:
+        assert len(client_files) <= g_upload_config.BATCH_MAX_FILES, f"at most {g_upload_config.BATCH_MAX_FILES} files per batch, got {len(client_files)}"
+        file_parameters = _batch_parameters(parameters, manifest, [f.filename for f in client_files])
+        object_ids, refused = await _gen_object_ids("upload", file_parameters)
+    except Exception as e:
+        raise HTTPException(status_code=404,
+                            detail=f"! Exception {type(e)} occurred while starting batch upload, message=[{e}] \n! traceback=\n{traceback.format_exc()}")
+    logger.info(f"batch of {len(client_files)} files")
+
+    new_objects = [_object_metadata(object_id, p, _logical_name(f.filename, compression["content_encoding"])) for object_id, p, f in zip(object_ids, file_parameters, client_files)]
+    results = [{"file_name": f.filename, "object_id": object_id, "status": "started" if reason is None else "failed", "stderr": reason}
+               for object_id, f, reason in zip(object_ids, client_files, refused)]
+    registered = [reason is None for reason in refused]
+    inserted = [i for i in range(len(results)) if registered[i]]
+    try:
+        if len(inserted) > 0:
+            await mongo_uploads.insert_many([new_objects[i][0] for i in inserted], ordered=False)
+    except BulkWriteError as e:
+        for error in e.details["writeErrors"]:
+            i = inserted[error["index"]]
+            registered[i] = False
+            # a requested object_id taken by a concurrent upload since it was looked up, for example
+            results[i].update(status="failed", stderr=f"! object could not be registered, message=[{error['errmsg']}]")
+
+    def failed(i, e):
+        results[i].update(status="failed",
+                          stderr=f"! Exception {type(e)} occurred while running upload for ({object_ids[i]}), message=[{e}] \n! traceback=\n{traceback.format_exc()}")
+
+    semaphore = asyncio.Semaphore(g_upload_config.BATCH_CONCURRENCY)
+
+    async def store(i):
+        async with semaphore:
+            incoming_path = blob_store.incoming_path()
+            try:
+                supplied_checksums = [c.dict() for c in file_parameters[i].checksums] if file_parameters[i].checksums is not None else None
+                digest, encoding = await stream_to_file(client_files[i], incoming_path, StreamingDigest(checksum_types_for(supplied_checksums)),
+                                                        content_encoding=compression["content_encoding"], storage_encoding=compression["compression"])
+                digest.verify(supplied_checksums)
+                return incoming_path, digest, encoding
+            except Exception as e:
+                if os.path.exists(incoming_path):
+                    os.remove(incoming_path)
+                failed(i, e)
+                return None
+
+    stored = await asyncio.gather(*[store(i) for i in range(len(results)) if registered[i]])
+    stored = [(i, s) for i, s in zip([i for i in range(len(results)) if registered[i]], stored) if s is not None]
+
+    blobs = []
+    try:
+        with stage("blob_commit"):
+            blobs = await blob_store.commit_many([s for _, s in stored])
+    except Exception as e:
+        for i, (incoming_path, _, _) in stored:
+            if os.path.exists(incoming_path):
+                os.remove(incoming_path)
+            failed(i, e)
+        stored = []
+    now = datetime.datetime.utcnow()
+    updates = [(object_ids[i], {"$set": {"size": digest.size, "checksums": digest.checksums, "blob": blob, "blob_encoding": blob_encoding, "updated_time": now}})
+               for (i, (_, digest, _)), (blob, blob_encoding) in zip(stored, blobs)]
+    updates += [(object_ids[i], {"$set": {"updated_time": now, "status": "failed", "stderr": r["stderr"]}})
+                for i, r in enumerate(results) if registered[i] and r["status"] == "failed"]
+    await _update_objects(updates)
+
+    for (i, _), (blob, blob_encoding) in zip(stored, blobs):
+        job_id = await run_in_threadpool(job_queue.enqueue, process_upload, object_ids[i], blob_store.stored_path(blob, blob_encoding), new_objects[i][1], blob_encoding)
+        logger.info(f"queued job {job_id} for {object_ids[i]}")
+
+    documents = {d["object_id"]: d for d in await mongo_uploads.find({"object_id": {"$in": [object_ids[i] for i in range(len(results)) if registered[i]]}}, {"_id": 0})}
+    for i, r in enumerate(results):
+        r["object"] = documents.get(r["object_id"]) if registered[i] else None
+    logger.info(f"batch done: {sum(r['status'] == 'started' for r in results)} started, {sum(r['status'] == 'failed' for r in results)} failed")
+    return results
+
+
+# Resumable uploads: create a session, PUT numbered parts (concurrently, and re-sent as needed), then complete.
+# Parts are assembled server-side and the object is registered exactly as /submit would.
+@app.post("/uploads", status_code=201, summary="Start a resumable, multi-part upload session")
+async def create_upload_session(parameters: ProviderParameters = Depends(ProviderParameters.as_form),
+                                file_name: str = Form(..., description="name of the file being uploaded"),
+                                compression: str = Query(default=None, regex=f"^({'|'.join(ENCODINGS)})$",
+                                                         description="how to store the object's bytes; defaults to the server's UPLOAD_COMPRESSION. "
+                                                                     "Bytes identical to an object already stored share its encoding; blob_encoding on the object is the one used")):
+    '''
+    Returns an upload_id. Send the object's bytes as numbered parts (1..N, any size up to the configured maximum, in any order and in parallel) with
+    PUT /uploads/{upload_id}/parts/{part_number}, then POST /uploads/{upload_id}/complete. Sessions idle for longer than the configured TTL are discarded.
+    '''
+    try:
+        upload_id = str(uuid.uuid4())
+        now = datetime.datetime.utcnow()
+        session = {"upload_id": upload_id,
+                   "file_name": os.path.basename(file_name),
+                   "parameters": json.loads(parameters.json()),
+                   "parts": {},
+                   "compression": compression,
+                   "status": "open",
+                   "object_id": None,
+                   "created_time": now,
+                   "updated_time": now}
+        os.makedirs(session_path(upload_id))
+        await upload_sessions.insert_one(session)
+        logger.info(f"created upload session {upload_id} for {file_name}")
+        del session["_id"]
+        return session
+    except Exception as e:
+        raise HTTPException(status_code=404,
+                            detail=f"! Exception {type(e)} occurred while creating upload session, message=[{e}] \n! traceback=\n{traceback.format_exc()}")
+
+
+@app.get("/uploads/{upload_id}", summary="Get the state of a resumable upload session, including the parts received so far")
+async def get_upload_session(upload_id: str):
+    session = await upload_sessions.find_one({"upload_id": upload_id}, {"_id": 0})
+    if session is None:
+        raise HTTPException(status_code=404, detail=f"! upload session ({upload_id}) not found")
+    return session
+
+
+@app.put("/uploads/{upload_id}/parts/{part_number}", summary="Upload one part of a resumable upload")
+async def put_upload_part(request: Request, upload_id: str,
+                          part_number: int = Path(..., ge=1, le=g_resumable_config.MAX_PARTS, description="1-based position of this part in the object"),
+                          checksum: str = Query(default=None, description="optional sha-256 of the part, verified on receipt")):
+    try:
+        session = await upload_sessions.find_one({"upload_id": upload_id, "status": "open"}, {"_id": 0, "upload_id": 1})
+        assert session is not None, f"no open upload session ({upload_id})"
+        with stage("part_write"):
+            digest = await write_part(request.stream(), part_path(upload_id, part_number),
+                                      [{"type": "sha-256", "checksum": checksum}] if checksum is not None else None)
+        part = {"size": digest.size, "checksums": digest.checksums}
+        updated = await upload_sessions.find_one_and_update({"upload_id": upload_id, "status": "open"},
+                                                            {"$set": {f"parts.{part_number}": part,
+                                                                      "updated_time": datetime.datetime.utcnow()}},
+                                                            {"_id": 1})
+        assert updated is not None, f"upload session ({upload_id}) was closed while the part was being received"
+        logger.info(f"[{upload_id}] part {part_number} received, {digest.size} bytes")
+        return {"upload_id": upload_id, "part_number": part_number, **part}
+    except Exception as e:
+        raise HTTPException(status_code=404,
+                            detail=f"! Exception {type(e)} occurred while receiving part ({part_number}) of ({upload_id}), message=[{e}] \n! traceback=\n{traceback.format_exc()}")
+
+
+@app.post("/uploads/{upload_id}/complete", status_code=202, summary="Assemble the parts of a resumable upload into a new object")
+async def complete_upload_session(upload_id: str,
+                                  checksum: str = Query(default=None, description="optional sha-256 of the whole object, verified against the assembled bytes")):
+    '''
+    Parts must be numbered 1..N without gaps. The optional checksum, and any checksums supplied when the session was created, are verified
+    against the assembled bytes. On success the new object is returned as from /submit; on failure the session is re-opened
+    so that parts can be re-sent.
+    '''
+    # claim the session so that concurrent completes (or the reaper) can't both act on it
+    session = await upload_sessions.find_one_and_update({"upload_id": upload_id, "status": "open"},
+                                                        {"$set": {"status": "completing", "updated_time": datetime.datetime.utcnow()}})
+    if session is None:
+        raise HTTPException(status_code=404, detail=f"! no open upload session ({upload_id})")
+    object_id = None
+    incoming_path = blob_store.incoming_path()
+    try:
+        part_numbers = sorted(int(n) for n in session["parts"])
+        assert len(part_numbers) > 0 and part_numbers == list(range(1, len(part_numbers) + 1)), f"parts must be numbered 1..N without gaps, received {part_numbers}"
+        parameters = ProviderParameters(**session["parameters"])
+        supplied_checksums = (session["parameters"].get("checksums") or []) + ([{"type": "sha-256", "checksum": checksum}] if checksum is not None else [])
+
+        object_id, drs_uri = await _new_object(parameters, session["file_name"])
+        with stage("assemble"):
+            digest, encoding = await run_in_threadpool(assemble_parts, [part_path(upload_id, n) for n in part_numbers], incoming_path,
+                                                       StreamingDigest(checksum_types_for(supplied_checksums)), session.get("compression"))
+        digest.verify(supplied_checksums)
+        ret = await _object_stored(object_id, incoming_path, drs_uri, digest, encoding)
+
+        await upload_sessions.update_one({"upload_id": upload_id},
+                                         {"$set": {"status": "completed", "object_id": object_id, "updated_time": datetime.datetime.utcnow()}})
+        await remove_session_dir(upload_id)
+        return ret
+    except Exception as e:
+        if os.path.exists(incoming_path):
+            os.remove(incoming_path)
+        if object_id is not None:
+            await _update_object(object_id, {"$set": {"updated_time": datetime.datetime.utcnow(), "status": "failed"}})
+        await upload_sessions.update_one({"upload_id": upload_id},
+                                         {"$set": {"status": "open", "updated_time": datetime.datetime.utcnow()}})
+        if isinstance(e, HTTPException):
+            raise
+        raise HTTPException(status_code=404,
+                            detail=f"! Exception {type(e)} occurred while completing upload session ({upload_id}), message=[{e}] \n! traceback=\n{traceback.format_exc()}")
+
+
+@app.delete("/uploads/{upload_id}", summary="Abort a resumable upload session and discard its parts")
+async def abort_upload_session(upload_id: str):
+    session = await upload_sessions.find_one_and_update({"upload_id": upload_id, "status": "open"},
+                                                        {"$set": {"status": "aborted", "updated_time": datetime.datetime.utcnow()}})
+    if session is None:
+        raise HTTPException(status_code=404, detail=f"! no open upload session ({upload_id})")
+    await remove_session_dir(upload_id)
+    return {"upload_id": upload_id, "status": "aborted"}
+
+
 # xxx check param defaults
-# xxx add parameters for finding object_id's of specific data_types (e.g., class_dataset_expression (DataType.geneExpression), etc.
 @app.get("/search/{submitter_id}", summary="Get infos for all the DrsObject for this submitter_id.")
-async def objects_search(submitter_id: str = Path(default="", description="submitter_id of user that uploaded the archive")):
+async def objects_search(response: Response,
+                         submitter_id: str = Path(default="", description="submitter_id of user that uploaded the archive"),
+                         params: dict = Depends(_search_parameters)):
+    '''
+    Returns a page of this submitter's objects, optionally filtered, with the requested fields (object_id by default).
+    If there are more, the Next-Page-Token response header holds the page_token for the next page.
+    '''
     try:
         logger.info(f"[search] submitter_id:{submitter_id}")
-        ret = list(map(lambda a: a, mongo_uploads.find({"submitter_id": submitter_id},
-                                                       {"_id": 0, "object_id": 1})))
-        logger.info(f"[search] ret:{ret}")
-        return ret
-
+        return await _search({"submitter_id": submitter_id}, params, response)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=404,
                             detail=f"! Exception {type(e)} occurred while searching for (???), message=[{e}] \n! traceback=\n{traceback.format_exc()}")
@@ -284,11 +744,12 @@ async def delete(object_id: str):
     - the sytem state needs to be corrected, e.g., after a bugfix.
 
     <br>**Note**: If the object was changed on the data provider's server, the old copy should be versioned in order to keep an appropriate record of the input data for past dependent analyses.
-    <br>**Note**: Object will be deleted from disk regardless of whether or not it was found in the database. This can be useful for manual correction of erroneous system states.
+    <br>**Note**: The object is gone as soon as this returns; its bytes are reclaimed shortly after, in the background. Objects with identical bytes share storage, which is only freed when the last object referencing it is deleted.
+    <br>**Note**: Data on disk that no object refers to (e.g., left by a manual correction of the database) is removed by the background reconciler once it is RECONCILE_GRACE_SECONDS old.
     <br>**Returns**: 
     - status = 'deleted' if object is found in the database and 1 object successfully deleted.
-    - status = 'exception' if an exception is encountered while removing the object from the database or filesystem, regardless of whether or not the object was successfully deleted, see other returned fields for more information.
-    - status = 'failed' if 0 or greater than 1 object is not found in database.
+    - status = 'failed' (404) if the object isn't in the database, including when it was already deleted: "Wrong number of records deleted (0)".
+    - status = 'exception' (404) if an exception is encountered while removing the object from the database; see the other returned fields for more information. The filesystem isn't touched by this request, so it can't fail it.
     '''
     delete_status = "done"
     info = ""
@@ -296,43 +757,35 @@ async def delete(object_id: str):
 
     ret_mongo = ""
     ret_mongo_err = ""
+    entry = None
     try:
         logger.warning(f"Deleting object_id: {object_id}")
-        ret = mongo_uploads.delete_one({"object_id": object_id})
-        # <class 'pymongo.results.DeleteResult'>
+        entry = await mongo_uploads.find_one({"object_id": object_id}, {"object_id": 1, "blob": 1, "blob_encoding": 1})
+        # a tombstone and the document deleted; the reconciler releases the bytes
+        ret = await reconciler.remove(entry, "deleted") if entry is not None else None
+        # <class 'pymongo.results.DeleteResult'>, or None if it wasn't there (or is already being deleted)
+        if ret is None:
+            ret = DeleteResult({"n": 0}, acknowledged=True)
         delete_status = "deleted"
         if ret.acknowledged is not True:
             delete_status = "failed"
             ret_mongo += "ret.acknoledged not True.\n"
             logger.error(f"delete failed, ret.acknowledged ! = True")
         if ret.deleted_count != 1:
-            # should never happen if index was created for this field
+            # more than one can't happen with the unique index on object_id; 0 means it wasn't there
             delete_status = "failed"
             ret_mongo += f"Wrong number of records deleted ({ret.deleted_count})."
             logger.error(f"delete failed, wrong number deleted, count[1]={ret.deleted_count}")
-        ## xxx
-        # could check if there are any remaining; but this should instead be enforced by creating an index for this columnxs
         # could check ret.raw_result['n'] and ['ok'], but 'ok' seems to always be 1.0, and 'n' is the same as deleted_count
-        ##
         ret_mongo += f"Deleted count=({ret.deleted_count}), Acknowledged=({ret.acknowledged})."
     except Exception as e:
         logger.error(f"Exception {type(e)} occurred while deleting {object_id} from database")
         ret_mongo_err += f"! Exception {type(e)} occurred while deleting {object_id} from database, message=[{e}] \n! traceback=\n{traceback.format_exc()}"
         delete_status = "exception"
 
-    # Data are cached on a mounted filesystem, unlink that too if it's there
-    logger.info(f"Deleting {object_id} from file system")
+    # the filesystem (or bucket) is left to the reconciler
     ret_os = ""
     ret_os_err = ""
-    try:
-        local_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
-        local_path = os.path.join(local_path, f"{object_id}-data")
-        logger.info(f"removing tree ({local_path})")
-        shutil.rmtree(local_path, ignore_errors=False)
-    except Exception as e:
-        logger.error(f"Exception {type(e)} occurred while deleting {object_id} from filesystem")
-        ret_os_err += f"! Exception {type(e)} occurred while deleting job from filesystem, message=[{e}] \n! traceback=\n{traceback.format_exc()}"
-        delete_status = "exception"
     try:
         info = f"{ret_mongo}\n {ret_os}"
         stderr = f"{ret_mongo_err}\n {ret_os_err}"
@@ -349,37 +802,172 @@ async def delete(object_id: str):
                             detail=f"! Message=[{info}]   Error while deleting ({object_id}), status=[{delete_status}] stderr=[{stderr}]")
 
 
-# xxx parse {object_id} for '/' - if found, retrieve a specific file from within the archive
+def _object_data_path(entry: dict):
+    '''
+    Where an object's bytes live: its content-addressed blob, or, for objects stored before the
+    blob store existed, the file in its own data directory.
+    '''
+    if entry.get("blob") is not None:
+        return blob_store.stored_path(entry["blob"], entry.get("blob_encoding") or IDENTITY)
+    return os.path.join(blob_store.legacy_dir(entry["object_id"]), entry["name"])
+
+
 @app.get("/files/{object_id}")
-def get_file(object_id: str):
+async def get_file(request: Request, object_id: str):
+    '''
+    Streams the object's bytes. Supports `Range` (single and multiple byte ranges), and
+    `If-None-Match`/`If-Range` against a strong ETag derived from the object's sha-256 checksum.
+
+    Objects stored compressed are sent as stored, with `Content-Encoding`, to clients whose `Accept-Encoding`
+    allows it; other clients, and range requests (ranges are always over the object's own bytes), get
+    the bytes decompressed on the fly. Only a single range is served from a compressed object.
+
+    Objects stored before the blob store as several files are sent as a zip of those files, `{object_id}.zip`.
+
+    Objects whose bytes are only in the storage bucket (STORAGE_KEEP_LOCAL=false) are redirected (307) to a presigned URL.
+    '''
     try:
-        file_path = os.path.abspath(f"/app/data/{object_id}-data")
-        logger.info(f"Retrieving {object_id} at {file_path}")
-
-        assert os.path.isdir(file_path)
-        assert len(os.listdir(file_path)) >= 1
-
-        def iterfile(file_path):
-            for file in os.listdir(file_path):
-                with open(os.path.join(file_path, file), mode="rb") as file_data:
-                    yield from file_data
-
-        entry = mongo_uploads.find({"object_id": object_id}, {"mime_type": 1, "name": 1})
-        num_matches = _mongo_count(mongo_uploads, {"object_id": object_id})
-        assert num_matches == 1
-        logger.info(f"total entries found = {num_matches}")
-        file_name = entry[0]["name"]
-        logger.info(f"filename = {file_name}")
-        media_type = entry[0]["mime_type"]
-        logger.info(f"media_type = {media_type}")
-        response = StreamingResponse(iterfile(file_path), media_type=media_type)
-        response.headers["Content-Disposition"] = "attachment; filename=" + file_name
-        return response
+        entry = await _find_object(object_id)
+        file_name = entry["name"]
+        media_type = entry["mime_type"]
+        headers = {"Content-Disposition": "attachment; filename=" + file_name}
+
+        if entry.get("blob") is None:
+            # stored before the blob store existed: bytes are in the object's own directory
+            file_path = blob_store.legacy_dir(object_id)
+            logger.info(f"Retrieving {object_id} at {file_path}")
+            assert os.path.isdir(file_path)
+            file_names = sorted(os.listdir(file_path))
+            assert len(file_names) >= 1
+            if len(file_names) > 1:
+                # several files make one object: send them as a zip, built while it streams
+                headers["Content-Disposition"] = f"attachment; filename={object_id}.zip"
+                return StreamingResponse(iter_zip([os.path.join(file_path, file) for file in file_names]),
+                                         media_type="application/zip", headers=headers)
+
+        encoding = entry.get("blob_encoding") or IDENTITY
+        send_encoded = encoding != IDENTITY and request.headers.get("range") is None and accepts(request.headers.get("accept-encoding"), encoding)
+        etag = etag_for(entry.get("checksums"))
+        if etag is not None and send_encoded:
+            # the encoded representation is a different set of bytes, so it needs its own validator
+            etag = f'{etag[:-1]}.{encoding}"'
+        if encoding != IDENTITY:
+            headers["Vary"] = "Accept-Encoding"
+        if etag is not None:
+            headers["ETag"] = etag
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            return Response(status_code=304, headers={k: v for k, v in headers.items() if k in ("ETag", "Vary")})
+
+        data_path = _object_data_path(entry)
+        if not os.path.exists(data_path) and blob_store.storage.remote:
+            # only in the bucket: send the client there for the stored bytes (S3 handles any ranges),
+            # or fetch them back to decompress for a client that can't take them as stored
+            if encoding == IDENTITY or send_encoded:
+                return RedirectResponse(blob_store.access_url(entry["blob"], encoding, file_name, media_type), status_code=307)
+            data_path = await run_in_threadpool(blob_store.ensure_local, entry["blob"], encoding)
+        logger.debug(f"Retrieving {object_id} ({file_name}, {media_type}) at {data_path} ({encoding})")
+        if send_encoded:
+            headers["Content-Encoding"] = encoding
+            return FileRangeResponse(data_path, os.path.getsize(data_path), headers=headers, media_type=media_type)
+        size = entry["size"] if encoding != IDENTITY else os.path.getsize(data_path)
+        ranges = None
+        if_range = request.headers.get("if-range")
+        # a stale If-Range means the client's partial copy is out of date: send the whole object
+        if if_range is None or (etag is not None and if_range == etag):
+            try:
+                ranges = parse_range(request.headers.get("range"), size)
+            except RangeNotSatisfiable:
+                return Response(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+        logger.debug(f"ranges = {summarize(ranges)}")
+        if encoding != IDENTITY:
+            status_code = 200
+            start, end = 0, size - 1
+            # multiple ranges would each mean decompressing from the start again; send the whole object
+            if ranges is not None and len(ranges) == 1:
+                status_code = 206
+                start, end = ranges[0]
+                headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+            headers["Accept-Ranges"] = "bytes"
+            headers["Content-Length"] = str(end - start + 1)
+            return StreamingResponse(iter_decoded(data_path, encoding, start, end, g_download_config.CHUNK_SIZE), status_code=status_code,
+                                     media_type=media_type, headers=headers)
+        return FileRangeResponse(data_path, size, ranges=ranges, headers=headers, media_type=media_type)
     except Exception as e:
         raise HTTPException(status_code=404,
                             detail=f"! Exception {type(e)} occurred while retrieving for ({object_id}), message=[{e}] \n! traceback=\n{traceback.format_exc()}")
 
 
+@app.get("/files/{object_id}/{member:path}", summary="Retrieve a single file from within an archived object")
+async def get_file_member(request: Request, object_id: str, member: str = Path(..., description="name of the file in the archive, or its full_path as listed in the object's contents")):
+    '''
+    Streams one member of a zip object straight from the stored archive, without extracting it.
+    A single `Range` over the decompressed bytes is supported.
+    '''
+    try:
+        entry = await _find_object(object_id)
+        assert entry["mime_type"] == "application/zip"
+        archive_path = _object_data_path(entry)
+        if entry.get("blob") is not None:
+            # the archive is read by random access, so it needs a local copy
+            archive_path = await run_in_threadpool(blob_store.ensure_local, entry["blob"], entry.get("blob_encoding") or IDENTITY)
+        logger.info(f"Retrieving {member} from {archive_path}")
+
+        archive = await run_in_threadpool(zip_index_cache.get, archive_path)
+        info = find_member(archive, member)
+        size = info.file_size
+        headers = {"Content-Disposition": "attachment; filename=" + os.path.basename(info.filename),
+                   "Accept-Ranges": "bytes"}
+        status_code = 200
+        start, end = 0, size - 1
+        try:
+            ranges = parse_range(request.headers.get("range"), size)
+        except RangeNotSatisfiable:
+            return Response(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+        # multiple ranges over a decompressed stream aren't worth the rewinds; send the whole member
+        if ranges is not None and len(ranges) == 1:
+            status_code = 206
+            start, end = ranges[0]
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        headers["Content-Length"] = str(end - start + 1)
+        return StreamingResponse(iter_member(archive, info, start, end), status_code=status_code,
+                                 media_type=member_media_type(info.filename), headers=headers)
+    except Exception as e:
+        raise HTTPException(status_code=404,
+                            detail=f"! Exception {type(e)} occurred while retrieving ({member}) from ({object_id}), message=[{e}] \n! traceback=\n{traceback.format_exc()}")
+
+
+@app.get("/health/live", summary="Liveness: this worker's event loop is answering")
+async def health_live():
+    return {"status": "alive"}
+
+
+@app.get("/health/ready", summary="Readiness: this worker has started, can reach mongo and isn't shutting down")
+async def health_ready(response: Response):
+    '''
+    503 until startup has finished and mongo has been reached, whenever a ping to mongo fails or is slow, and
+    from the moment the worker starts draining for shutdown; route traffic here only while it is 200.
+    '''
+    checks = g_health.checks()
+    ready = g_health.ready()
+    if ready:
+        try:
+            await asyncio.wait_for(mongo_uploads.ping(), g_server_config.READY_TIMEOUT)
+        except Exception as e:
+            logger.warning(f"readiness: mongo ping failed: {type(e)}: {e}")
+            checks["database"] = ready = False
+    if not ready:
+        response.status_code = 503
+    return {"status": "ready" if ready else "unavailable", "checks": checks}
+
+
+@app.get("/metrics", summary="Prometheus metrics for this service", include_in_schema=g_metrics_config.ENABLED)
+async def metrics():
+    if not g_metrics_config.ENABLED:
+        raise HTTPException(status_code=404, detail="! metrics are disabled (METRICS_ENABLED)")
+    content, media_type = await run_in_threadpool(render)
+    return Response(content, media_type=media_type)
+
+
 # ----------------- GA4GH endpoints ---------------------
 @app.get("/service-info", summary="Retrieve information about this service")
 async def service_info():
@@ -414,17 +1002,138 @@ async def service_info():
 # READ-ONLY endpoints follow the GA4GH DRS API, modeled below
 # https://editor.swagger.io/?url=https://ga4gh.github.io/data-repository-service-schemas/preview/release/drs-1.2.0/openapi.yaml
 
-def api_provider_object(object_id: str):
-    entry = mongo_uploads.find({"object_id": object_id})
-    num_matches = _mongo_count(mongo_uploads, {"object_id": object_id})
-    logger.info(f"total found for [{object_id}]={num_matches}")
-    assert num_matches == 1
-    logger.info(f"found Object[{object_id}]={entry[0]}")
+async def _find_object(object_id: str):
+    '''
+    The object's document, from the object cache if it's there; otherwise one query, which also catches duplicates.
+    '''
+    obj = object_cache.get(object_id)
+    if obj is not None:
+        return obj
+    entry = await mongo_uploads.find({"object_id": object_id}, {"_id": 0}, limit=2)
+    logger.debug(f"total found for [{object_id}]={len(entry)}")
+    assert len(entry) == 1
     obj = entry[0]
-    del obj['_id']
+    object_cache.put(object_id, obj)
+    return obj
+
+
+async def _find_objects(object_ids: List[str]):
+    '''
+    _find_object for many ids: whatever isn't cached is read with a single $in query.
+    Returns {object_id: document} for the ids that exist.
+    '''
+    found = {}
+    for object_id in object_ids:
+        obj = object_cache.get(object_id)
+        if obj is not None:
+            found[object_id] = obj
+    missing = list({object_id for object_id in object_ids if object_id not in found})
+    if len(missing) > 0:
+        for obj in await mongo_uploads.find({"object_id": {"$in": missing}}, {"_id": 0}):
+            found[obj["object_id"]] = obj
+            object_cache.put(obj["object_id"], obj)
+    logger.debug(f"found {len(found)} of {len(object_ids)} objects, {len(missing)} read from the database")
+    return found
+
+
+def _access_url(entry: dict, access_id: str):
+    '''
+    The AccessURL for one of an object's access methods: its /files URL on this API, or, once its bytes are in the
+    storage bucket, a presigned URL for them, so the download doesn't go through the API at all. Presigning is
+    local computation, no round trip. Raises KeyError for an access_id the object doesn't have.
+    '''
+    if access_id == FILES_ACCESS_ID:
+        return access_methods(entry["object_id"], False)[0]["access_url"]
+    if access_id == S3_ACCESS_ID and any(m.get("access_id") == S3_ACCESS_ID for m in entry.get("access_methods") or []):
+        return {"url": blob_store.access_url(entry["blob"], entry.get("blob_encoding") or IDENTITY, entry["name"], entry["mime_type"])}
+    raise KeyError(f"({entry['object_id']}) has no access method ({access_id})")
+
+
+def _check_bulk_length(n: int):
+    if n > g_drs_config.MAX_BULK_REQUEST_LENGTH:
+        raise HTTPException(status_code=413, detail=f"! {n} ids requested, the maximum per request is {g_drs_config.MAX_BULK_REQUEST_LENGTH}")
+
+
+def _unresolved(object_ids):
+    return [{"error_code": 404, "object_ids": object_ids}] if len(object_ids) > 0 else []
+
+
+def _unsupported(access_ids: dict):
+    '''
+    The unresolved entry for {object_id: [access_id, ...]} of existing objects that have no such access methods.
+    '''
+    if len(access_ids) == 0:
+        return []
+    return [{"error_code": 400, "object_ids": list(access_ids),
+             "object_access_ids": [{"bulk_object_id": object_id, "bulk_access_ids": ids} for object_id, ids in access_ids.items()]}]
+
+
+async def api_provider_object(object_id: str):
+    obj = await _find_object(object_id)
+    logger.debug(f"found Object[{object_id}]={summarize(obj)}")
     return obj
 
 
+# the bulk endpoints are declared before /objects/{object_id} so that 'access' isn't taken for an object_id
+@app.post("/objects", summary="Get info about multiple DrsObjects with an optional Passport(s).")
+async def bulk_objects(body: BulkObjectIds,
+                       expand: bool = Query(default=False, description="ignored: objects in this provider are never bundles of other objects")):
+    '''
+    Returns the metadata of every requested object that exists, read with a single query, and lists the ids that don't.
+    '''
+    _check_bulk_length(len(body.bulk_object_ids))
+    try:
+        found = await _find_objects(body.bulk_object_ids)
+        unresolved = [object_id for object_id in body.bulk_object_ids if object_id not in found]
+        return {
+            "summary": {"requested": len(body.bulk_object_ids), "resolved": len(body.bulk_object_ids) - len(unresolved), "unresolved": len(unresolved)},
+            "resolved_drs_object": [found[object_id] for object_id in body.bulk_object_ids if object_id in found],
+            "unresolved_drs_objects": _unresolved(unresolved)
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500,
+                            detail=f"! Exception {type(e)} occurred while resolving ({len(body.bulk_object_ids)}) objects, message=[{e}] \n! traceback=\n{traceback.format_exc()}")
+
+
+@app.post("/objects/access", summary="Get URLs for fetching bytes from multiple objects with an optional Passport(s).")
+async def bulk_access(body: BulkObjectAccessIds):
+    '''
+    Resolves every requested (object_id, access_id) pair of the objects that exist, looking the objects up with a single query.
+    Objects that don't exist are listed as unresolved with error_code 404; access_ids an existing object doesn't have
+    (e.g., s3 for an object that isn't in a bucket) with error_code 400, as the (object_id, access_ids) pairs asked for.
+    The summary counts pairs: requested = resolved + unresolved (no such object) + unsupported (no such access method).
+    '''
+    requested = sum(len(a.bulk_access_ids) for a in body.bulk_object_access_ids)
+    _check_bulk_length(requested)
+    try:
+        found = await _find_objects([a.bulk_object_id for a in body.bulk_object_access_ids])
+        resolved = []
+        unresolved = []
+        unsupported = {}
+        missing = 0
+        for a in body.bulk_object_access_ids:
+            if a.bulk_object_id not in found:
+                missing += len(a.bulk_access_ids)
+                if a.bulk_object_id not in unresolved:
+                    unresolved.append(a.bulk_object_id)
+                continue
+            for access_id in a.bulk_access_ids:
+                try:
+                    resolved.append({"drs_object_id": a.bulk_object_id, "drs_access_id": access_id, **_access_url(found[a.bulk_object_id], access_id)})
+                except KeyError:
+                    access_ids = unsupported.setdefault(a.bulk_object_id, [])
+                    if access_id not in access_ids:
+                        access_ids.append(access_id)
+        return {
+            "summary": {"requested": requested, "resolved": len(resolved), "unresolved": missing, "unsupported": requested - len(resolved) - missing},
+            "resolved_drs_object_access_urls": resolved,
+            "unresolved_drs_objects": _unresolved(unresolved) + _unsupported(unsupported)
+        }
+    except Exception as e:
+        raise HTTPException(status_code=500,
+                            detail=f"! Exception {type(e)} occurred while resolving access for ({requested}) objects, message=[{e}] \n! traceback=\n{traceback.format_exc()}")
+
+
 @app.get("/objects/{object_id}", summary="Get info about a DrsObject.")
 async def objects(object_id: str = Path(default="", description="DrsObject identifier"),
                   expand: bool = Query(default=False,
@@ -433,13 +1142,44 @@ async def objects(object_id: str = Path(default="", description="DrsObject ident
     Returns object metadata, and a list of access methods that can be used to fetch object bytes.
     '''
     try:
-        return api_provider_object(object_id)
+        return await api_provider_object(object_id)
 
     except Exception as e:
         raise HTTPException(status_code=404,
                             detail="! Exception {type(e)} occurred while searching for ({object_id}), message=[{e}] \n! traceback=\n{traceback.format_exc()}")
 
 
+@app.get("/objects/{object_id}/matrix", summary="Get a slice of an expression or phenotype matrix")
+async def get_matrix(object_id: str = Path(default="", description="DrsObject identifier"),
+                     member: str = Query(default=None, description="for a zip object holding more than one matrix: the file name or full_path of the one to slice"),
+                     rows: str = Query(default=None, description="comma-separated row labels (double-quoted if they contain a comma) and/or start:stop row positions; all rows if omitted"),
+                     cols: str = Query(default=None, description="comma-separated column labels (double-quoted if they contain a comma) and/or start:stop column positions; all columns if omitted"),
+                     format: str = Query(default="json", regex="^(json|csv|npz)$", description="json, csv (same layout as the upload), or npz (numpy arrays values, rows, cols)")):
+    '''
+    Returns part of a CSV matrix (or one inside a zip) from the memory-mapped sidecar built when the
+    object was processed, without reading or parsing the rest of the matrix. Row and column labels are
+    the first column and, if the matrix has a header, the first line; otherwise columns are labelled by position.
+    '''
+    try:
+        entry = await _find_object(object_id)
+        matrices = entry.get("matrices") or []
+        if member is not None:
+            matrices = [m for m in matrices if m["member"] is not None and member in (m["member"], os.path.basename(m["member"]))]
+        assert len(matrices) == 1, f"{len(matrices)} matrices of ({object_id}) match, name one with 'member'"
+        matrix = await run_in_threadpool(matrix_cache.get, os.path.join(derived_path(_object_data_path(entry)), matrices[0]["sidecar"]))
+        with stage("matrix_slice"):
+            row_labels, col_labels, values = await run_in_threadpool(matrix.slice, rows, cols)
+        logger.info(f"[{object_id}] sliced {values.shape[0]}x{values.shape[1]} from {matrices[0]['member'] or entry['name']}")
+        if format == "csv":
+            return StreamingResponse(iter_slice_csv(row_labels, col_labels, values), media_type="text/csv")
+        if format == "npz":
+            return Response(await run_in_threadpool(slice_to_npz, row_labels, col_labels, values), media_type="application/octet-stream")
+        return await run_in_threadpool(slice_to_json, row_labels, col_labels, values)
+    except Exception as e:
+        raise HTTPException(status_code=404,
+                            detail=f"! Exception {type(e)} occurred while slicing the matrix of ({object_id}), message=[{e}] \n! traceback=\n{traceback.format_exc()}")
+
+
 # xxx add value for passport example that doesn't cause server error
 # xxx figure out how to add the following description to 'passports':
 # the encoded JWT GA4GH Passport that contains embedded Visas. The overall JWT is signed as are the individual Passport Visas
@@ -466,10 +1206,11 @@ async def get_objects(object_id: str = Path(default="", description="DrsObject i
     AccessMethod that contains an access_id (e.g., for servers that
     use signed URLs for fetching object bytes).
     '''
-    return {
-        "url": "http://localhost/object.zip",
-        "headers": "Authorization: None"
-    }
+    try:
+        return _access_url(await _find_object(object_id), access_id)
+    except Exception as e:
+        raise HTTPException(status_code=404,
+                            detail=f"! Exception {type(e)} occurred while resolving ({access_id}) of ({object_id}), message=[{e}] \n! traceback=\n{traceback.format_exc()}")
 
 
 # xxx figure out how to add the following description to 'passports':
@@ -487,11 +1228,14 @@ async def post_objects(object_id: str = Path(default="", description="DrsObject
     authorize access.
 
     '''
-    return {
-        "url": "http://localhost/object.zip",
-        "headers": "Authorization: None"
-    }
+    try:
+        return _access_url(await _find_object(object_id), access_id)
+    except Exception as e:
+        raise HTTPException(status_code=404,
+                            detail=f"! Exception {type(e)} occurred while resolving ({access_id}) of ({object_id}), message=[{e}] \n! traceback=\n{traceback.format_exc()}")
 
 
 if __name__ == '__main__':
-    uvicorn.run("main:app", host='0.0.0.0', port=int(os.getenv("HOST_PORT")), reload=True)
+    # hand over to the server module: processes started with spawn (uvicorn's workers, the zip indexing pool) re-import
+    # the __main__ module, which would otherwise be this whole app, connecting to mongo again in each of them
+    os.execv(sys.executable, [sys.executable, "-m", "fuse.utils.server", "main:app"])
@@ -4,7 +4,7 @@ package Support;
 require Exporter;
 @ISA = qw(Exporter);
 our @EXPORT = qw($verbose $no_download $dry_run $HOST_PATH $EMAIL $GROUPID $APIKEY $dl_taskid $analysis_taskid 
-		 cleanup_out f cmd generalize_output rawf dl_poll json_struct);
+		 cleanup_out f cmd generalize_output rawf dl_poll poll_status json_struct);
 
 use Cpanel::JSON::XS;
 use Switch;
@@ -82,6 +82,21 @@ sub generalize_output {
     `cat $raw_outfile |python -m json.tool|jq --sort-keys > t/out/${fn}`;
 }
 
+sub poll_status {
+    # submissions are processed asynchronously; wait for the object to leave the 'started' state
+    my ($endpoint, $tries) = @_;
+    $tries //= 60;
+    my $status = "started";
+    if($dry_run != 0) { return "finished"; }
+    for(my $i = 0; $i < $tries && $status eq "started"; $i++) {
+	$status = `curl -s '${HOST_PATH}/${endpoint}' -H 'accept: application/json' | jq -r .status`;
+	chomp $status;
+	if($verbose) { print("+ [poll_status] ${endpoint}: ${status}\n"); }
+	if($status eq "started") { sleep 1; }
+    }
+    return $status;
+}
+
 sub json_struct {
     my $outfile = $_[0];
     my $json_text = do {
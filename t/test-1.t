@@ -18,7 +18,7 @@ use warnings;
 
 use Getopt::Long qw(GetOptions);
 
-use Test::More tests => 14;
+use Test::More tests => 16;
 use Test::File::Contents;
 
 use lib './t';
@@ -66,6 +66,9 @@ $fn = "write-1b.json";
 generalize_output($fn, cmd("POST", rawf($fn), "submit?submitter_id=${SUBMITTER_ID}&requested_object_id=${OBJID2}&data_type=class_dataset_expression&file_type=filetype_dataset_properties&version=1.0", "-F 'client_file=@./t/input/phenotypes.csv;type=application/csv' -H 'Content-Type: multipart/form-data' -H 'accept: application/json'"), ["created_time", "updated_time"]);
 files_eq(f($fn), "t/out/${fn}",                                                                            "($fn) Submit csv file");
 
+is(poll_status("objects/${OBJID}"), "finished",                                                             "Zip file processing finished");
+is(poll_status("objects/${OBJID2}"), "finished",                                                            "Csv file processing finished");
+
 
 $fn = "DRS-2.json";
 generalize_output($fn, cmd("GET", rawf($fn), "objects/{$OBJID}"), ["created_time", "updated_time"]);
@@ -93,10 +96,10 @@ $fn = "write-3b.json";
 files_eq(f($fn), cmd("DELETE", $fn, "delete/${OBJID2}"),                                                   "($fn) Delete the csv object (status=deleted)");
 $fn = "write-4.json";
 generalize_output($fn, cmd("DELETE", rawf($fn), "delete/${OBJID}"), ["stderr"]);
-files_eq(f($fn), "t/out/${fn}",                                                                            "($fn) Delete the zip'd object again (status=exception)");
+files_eq(f($fn), "t/out/${fn}",                                                                            "($fn) Delete the zip'd object again (status=failed)");
 $fn = "write-4b.json";
 generalize_output($fn, cmd("DELETE", rawf($fn), "delete/${OBJID2}"), ["stderr"]);
-files_eq(f($fn), "t/out/${fn}",                                                                            "($fn) Delete the csv object again (status=exception)");
+files_eq(f($fn), "t/out/${fn}",                                                                            "($fn) Delete the csv object again (status=failed)");
 
 
 
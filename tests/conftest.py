@@ -0,0 +1,94 @@
+'''
+Unit tests for the fuse.utils modules, against mongomock and a temporary directory; the end-to-end tests
+against a running instance are the perl suite in t/.
+'''
+import asyncio
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+
+import mongomock
+import pymongo
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# read when the config models are first imported: nothing outside a temporary directory is written, even by importing main
+_data_dir = tempfile.mkdtemp(prefix="fuse-tests-")
+atexit.register(shutil.rmtree, _data_dir, True)
+os.environ.setdefault("DATA_DIR", _data_dir)
+
+from fuse.models.Config import BlobConfig, MongoConfig, StorageConfig  # noqa: E402
+from fuse.utils import jobs  # noqa: E402
+from fuse.utils.blobs import BlobStore  # noqa: E402
+from fuse.utils.db import UploadsCollection  # noqa: E402
+from fuse.utils.ingest import StreamingDigest  # noqa: E402
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+@pytest.fixture
+def uploads(monkeypatch):
+    monkeypatch.setattr(pymongo, "MongoClient", lambda *args, **kwargs: mongomock.MongoClient())
+    collection = UploadsCollection(MongoConfig(CLIENT="mongodb://localhost/test"))
+    yield collection
+    collection.close()
+
+
+@pytest.fixture
+def storage_config(tmp_path):
+    return StorageConfig(DATA_DIR=str(tmp_path), BACKEND="local")
+
+
+@pytest.fixture
+def blob_store(uploads, tmp_path, storage_config):
+    return BlobStore(uploads.sibling("blobs"), BlobConfig(BLOB_DIR=str(tmp_path / "blobs")), storage_config)
+
+
+class InlineJobQueue:
+    '''
+    Runs each job as it is queued, so an object is processed by the time its request returns.
+    '''
+
+    def enqueue(self, fn, *args):
+        fn(*args)
+        return "inline"
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def app(monkeypatch, tmp_path, storage_config):
+    '''
+    The main module, against an empty mongomock database with its indexes, a blob store in tmp_path and jobs run inline.
+    '''
+    monkeypatch.setattr(pymongo, "MongoClient", lambda *args, **kwargs: mongomock.MongoClient())
+    import main
+    database = main.mongo_uploads.collection.database
+    for name in database.list_collection_names():
+        database.drop_collection(name)
+    main.object_cache.clear()
+    blob_store = BlobStore(main.mongo_uploads.sibling("blobs"), BlobConfig(BLOB_DIR=str(tmp_path / "blobs")), storage_config)
+    monkeypatch.setattr(main, "blob_store", blob_store)
+    monkeypatch.setattr(main.reconciler, "blob_store", blob_store)
+    monkeypatch.setattr(main, "job_queue", InlineJobQueue())
+    monkeypatch.setattr(jobs, "_uploads", main.mongo_uploads)
+    monkeypatch.setattr(jobs, "_blob_store", blob_store)
+    run(main.create_indexes())
+    return main
+
+
+def incoming(blob_store: BlobStore, data: bytes):
+    '''
+    data written to the blob store's incoming directory, as an upload would, with its digest.
+    '''
+    path = blob_store.incoming_path()
+    with open(path, "wb") as f:
+        f.write(data)
+    digest = StreamingDigest()
+    digest.update(data)
+    return path, digest
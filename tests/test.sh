@@ -1,3 +1,4 @@
 #!/bin/bash
 
 prove t/test.t
+python -m pytest -q tests
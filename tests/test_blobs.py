@@ -0,0 +1,77 @@
+import os
+import threading
+
+from conftest import incoming, run
+from fuse.utils.blobs import derived_path
+from fuse.utils.compression import GZIP, IDENTITY
+
+
+def test_identical_bytes_share_a_blob_until_the_last_release(blob_store):
+    sha256, encoding = run(blob_store.commit(*incoming(blob_store, b"a,b\n1,2\n")))
+    assert run(blob_store.commit(*incoming(blob_store, b"a,b\n1,2\n"))) == (sha256, encoding)
+    path = blob_store.stored_path(sha256, encoding)
+    os.makedirs(derived_path(path))
+    assert blob_store.blobs.collection.find_one({"_id": sha256})["refcount"] == 2
+    assert os.listdir(blob_store.incoming_dir) == []
+
+    assert not run(blob_store.release(sha256))
+    assert os.path.exists(path)
+    assert run(blob_store.release(sha256))
+    assert not os.path.exists(path) and not os.path.exists(derived_path(path))
+    assert blob_store.blobs.collection.find_one({"_id": sha256}) is None
+
+
+def test_refcount_never_goes_below_zero(blob_store):
+    sha256, _ = run(blob_store.commit(*incoming(blob_store, b"x")))
+    assert run(blob_store.release(sha256))
+    # releasing a freed (or unknown) blob is a no-op, not a negative count
+    assert not run(blob_store.release(sha256))
+    assert not run(blob_store.release("0" * 64))
+    assert blob_store.blobs.collection.count_documents({}) == 0
+
+
+def test_commit_after_free_stores_the_bytes_again(blob_store):
+    sha256, _ = run(blob_store.commit(*incoming(blob_store, b"x")))
+    run(blob_store.release(sha256))
+    run(blob_store.commit(*incoming(blob_store, b"x")))
+    assert open(blob_store.stored_path(sha256), "rb").read() == b"x"
+
+
+def test_commit_many(blob_store):
+    committed = run(blob_store.commit_many([(*incoming(blob_store, data), IDENTITY) for data in (b"1", b"2", b"1")]))
+    assert committed[0] == committed[2] and committed[0] != committed[1]
+    assert blob_store.blobs.collection.find_one({"_id": committed[0][0]})["refcount"] == 2
+    assert os.listdir(blob_store.incoming_dir) == []
+
+
+def test_twin_with_another_encoding_keeps_its_own(blob_store):
+    path, digest = incoming(blob_store, b"a,b\n")
+    sha256, encoding = run(blob_store.commit(path, digest, GZIP))
+    assert encoding == GZIP
+    assert run(blob_store.commit(*incoming(blob_store, b"a,b\n"), IDENTITY)) == (sha256, GZIP)
+    assert os.listdir(blob_store.incoming_dir) == []
+
+
+def test_commit_many_reports_the_encoding_of_an_existing_twin(blob_store):
+    sha256, _ = run(blob_store.commit(*incoming(blob_store, b"a,b\n"), GZIP))
+    path, digest = incoming(blob_store, b"a,b\n")
+    assert run(blob_store.commit_many([(path, digest, IDENTITY)])) == [(sha256, GZIP)]
+    assert not os.path.exists(blob_store.stored_path(sha256, IDENTITY))
+
+
+def test_file_moves_stay_off_the_event_loop(blob_store, monkeypatch):
+    on_loop = []
+    for name in ("replace", "remove", "makedirs"):
+        def recording(*args, _fn=getattr(os, name), _name=name, **kwargs):
+            if threading.current_thread() is threading.main_thread():
+                on_loop.append(_name)
+            return _fn(*args, **kwargs)
+
+        monkeypatch.setattr(os, name, recording)
+    sha256, encoding = run(blob_store.commit(*incoming(blob_store, b"a,b\n1,2\n")))
+    run(blob_store.commit_many([incoming(blob_store, b"a,b\n1,2\n") + (encoding,), incoming(blob_store, b"gz") + (GZIP,)]))
+    run(blob_store.commit(*incoming(blob_store, b"a,b\n1,2\n"), GZIP))
+    for _ in range(4):
+        run(blob_store.release(sha256))
+    assert blob_store.blobs.collection.find_one({"_id": sha256}) is None
+    assert on_loop == []
@@ -0,0 +1,80 @@
+import gzip
+
+import pytest
+
+from fuse.utils.compression import GZIP, IDENTITY, ZSTD, Decoder, Encoder, accepts, choose_encoding, iter_decoded
+
+DATA = b"gene,s1,s2\n" + b"".join(b"g%d,%d,%d\n" % (i, i, i * 2) for i in range(5000))
+
+
+def _encode(encoding, data):
+    encoder = Encoder(encoding)
+    return encoder.compress(data) + encoder.flush()
+
+
+def test_choose_encoding():
+    assert choose_encoding(GZIP, b"gene,s1") == GZIP
+    assert choose_encoding(None, b"gene,s1") == IDENTITY
+    # archives and compressed content are stored as sent
+    assert choose_encoding(ZSTD, b"PK\x03\x04...") == IDENTITY
+    assert choose_encoding(GZIP, b"\x1f\x8b\x08") == IDENTITY
+    with pytest.raises(ValueError):
+        choose_encoding("brotli", b"")
+
+
+@pytest.mark.parametrize("encoding", [IDENTITY, GZIP, ZSTD])
+def test_round_trip_in_chunks(encoding):
+    encoded = _encode(encoding, DATA)
+    decoder = Decoder(encoding)
+    decoded = b"".join(decoder.decompress(encoded[i:i + 1000]) for i in range(0, len(encoded), 1000))
+    decoder.finish()
+    assert decoded == DATA
+
+
+@pytest.mark.parametrize("encoding", [GZIP, ZSTD])
+def test_concatenated_streams(encoding):
+    decoder = Decoder(encoding)
+    decoded = decoder.decompress(_encode(encoding, DATA[:100]) + _encode(encoding, DATA[100:]))
+    decoder.finish()
+    assert decoded == DATA
+
+
+@pytest.mark.parametrize("encoding", [GZIP, ZSTD])
+def test_incomplete_stream(encoding):
+    decoder = Decoder(encoding)
+    decoder.decompress(_encode(encoding, DATA)[:-10])
+    with pytest.raises(ValueError):
+        decoder.finish()
+    with pytest.raises(ValueError):
+        Decoder(encoding).finish()
+
+
+@pytest.mark.parametrize("encoding", [IDENTITY, GZIP, ZSTD])
+def test_iter_decoded_slice(tmp_path, encoding):
+    path = tmp_path / "blob"
+    path.write_bytes(_encode(encoding, DATA))
+    assert b"".join(iter_decoded(str(path), encoding)) == DATA
+    assert b"".join(iter_decoded(str(path), encoding, 1000, 2999, chunk_size=256)) == DATA[1000:3000]
+    assert b"".join(iter_decoded(str(path), encoding, len(DATA) - 5)) == DATA[-5:]
+    assert b"".join(iter_decoded(str(path), encoding, len(DATA) + 5)) == b""
+
+
+def test_gzip_is_standard():
+    assert gzip.decompress(_encode(GZIP, DATA)) == DATA
+
+
+@pytest.mark.parametrize("header, encoding, expected", [
+    (None, GZIP, False),
+    ("", GZIP, False),
+    ("gzip", GZIP, True),
+    ("GZIP;q=0.5", GZIP, True),
+    ("gzip;q=0", GZIP, False),
+    ("x-gzip", GZIP, True),
+    ("deflate, br", GZIP, False),
+    ("*", ZSTD, True),
+    ("*, zstd;q=0", ZSTD, False),
+    ("gzip;q=abc", GZIP, False),
+    ("br, zstd ; q=1.0", ZSTD, True),
+])
+def test_accepts(header, encoding, expected):
+    assert accepts(header, encoding) is expected
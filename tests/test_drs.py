@@ -0,0 +1,80 @@
+import pytest
+from starlette.testclient import TestClient
+
+from fuse.utils.db import UploadsCollection
+from fuse.utils.storage import FILES_ACCESS_ID, S3_ACCESS_ID, access_methods
+
+
+def _object(object_id: str, status: str = "finished"):
+    return {"object_id": object_id, "id": object_id, "name": f"{object_id}.csv", "mime_type": "text/csv", "size": 1, "status": status,
+            "blob": None, "access_methods": access_methods(object_id, False)}
+
+
+@pytest.fixture
+def client(app):
+    app.mongo_uploads.collection.insert_many([_object("a"), _object("b"), _object("c")])
+    return TestClient(app.app)
+
+
+def test_bulk_objects(client):
+    response = client.post("/objects", json={"bulk_object_ids": ["b", "nope", "a"]})
+    assert response.status_code == 200
+    body = response.json()
+    assert body["summary"] == {"requested": 3, "resolved": 2, "unresolved": 1}
+    assert [o["object_id"] for o in body["resolved_drs_object"]] == ["b", "a"]
+    assert body["unresolved_drs_objects"] == [{"error_code": 404, "object_ids": ["nope"]}]
+
+
+def test_bulk_objects_reads_only_what_is_not_cached(app, client, monkeypatch):
+    assert client.get("/objects/a").status_code == 200
+    # the cached copy is served even once the database has changed underneath it
+    app.mongo_uploads.collection.update_one({"object_id": "a"}, {"$set": {"description": "changed"}})
+    queries = []
+    find = UploadsCollection.find
+
+    async def recording_find(self, filter, *args, **kwargs):
+        queries.append(filter)
+        return await find(self, filter, *args, **kwargs)
+
+    monkeypatch.setattr(UploadsCollection, "find", recording_find)
+    body = client.post("/objects", json={"bulk_object_ids": ["a", "b", "nope"]}).json()
+    assert body["summary"]["resolved"] == 2 and "description" not in body["resolved_drs_object"][0]
+    assert len(queries) == 1 and sorted(queries[0]["object_id"]["$in"]) == ["b", "nope"]
+    # a started object isn't cached, so it is read every time
+    app.mongo_uploads.collection.insert_one(_object("d", status="started"))
+    client.post("/objects", json={"bulk_object_ids": ["d"]})
+    client.post("/objects", json={"bulk_object_ids": ["d"]})
+    assert [q["object_id"]["$in"] for q in queries[1:]] == [["d"], ["d"]]
+
+
+def test_bulk_access(client):
+    response = client.post("/objects/access", json={"bulk_object_access_ids": [
+        {"bulk_object_id": "a", "bulk_access_ids": [FILES_ACCESS_ID, S3_ACCESS_ID]},
+        {"bulk_object_id": "nope", "bulk_access_ids": [FILES_ACCESS_ID, S3_ACCESS_ID]},
+        {"bulk_object_id": "b", "bulk_access_ids": [FILES_ACCESS_ID]},
+        {"bulk_object_id": "c", "bulk_access_ids": ["ftp"]}]})
+    assert response.status_code == 200
+    body = response.json()
+    assert body["summary"] == {"requested": 6, "resolved": 2, "unresolved": 2, "unsupported": 2}
+    assert [(r["drs_object_id"], r["drs_access_id"]) for r in body["resolved_drs_object_access_urls"]] == [("a", FILES_ACCESS_ID), ("b", FILES_ACCESS_ID)]
+    assert body["resolved_drs_object_access_urls"][0]["url"].endswith("/files/a")
+    assert body["unresolved_drs_objects"] == [
+        {"error_code": 404, "object_ids": ["nope"]},
+        {"error_code": 400, "object_ids": ["a", "c"],
+         "object_access_ids": [{"bulk_object_id": "a", "bulk_access_ids": [S3_ACCESS_ID]}, {"bulk_object_id": "c", "bulk_access_ids": ["ftp"]}]}]
+
+
+def test_bulk_access_of_existing_objects_has_no_error_entries(client):
+    body = client.post("/objects/access", json={"bulk_object_access_ids": [{"bulk_object_id": "a", "bulk_access_ids": [FILES_ACCESS_ID]}]}).json()
+    assert body["summary"] == {"requested": 1, "resolved": 1, "unresolved": 0, "unsupported": 0}
+    assert body["unresolved_drs_objects"] == []
+
+
+def test_bulk_requests_are_limited(app, client, monkeypatch):
+    monkeypatch.setattr(app.g_drs_config, "MAX_BULK_REQUEST_LENGTH", 2)
+    assert client.post("/objects", json={"bulk_object_ids": ["a", "b"]}).status_code == 200
+    response = client.post("/objects", json={"bulk_object_ids": ["a", "b", "c"]})
+    assert response.status_code == 413 and "maximum per request is 2" in response.json()["detail"]
+    # access requests are counted in (object_id, access_id) pairs
+    response = client.post("/objects/access", json={"bulk_object_access_ids": [{"bulk_object_id": "a", "bulk_access_ids": [FILES_ACCESS_ID, S3_ACCESS_ID, "ftp"]}]})
+    assert response.status_code == 413
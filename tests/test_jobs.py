@@ -0,0 +1,22 @@
+from conftest import incoming
+from fuse.utils import jobs
+
+CSV = b"id,a,b\nr1,1,2\nr2,3,4\n"
+
+
+def test_a_job_for_a_removed_object_does_nothing(uploads, blob_store, monkeypatch):
+    monkeypatch.setattr(jobs, "_uploads", uploads)
+    path, _ = incoming(blob_store, CSV)
+    assert jobs.process_upload("gone", path, "drs:///gone") is None
+    # no 'failed' status written to a document that is gone
+    assert uploads.collection.count_documents({}) == 0
+
+
+def test_a_job_records_the_profile(uploads, blob_store, monkeypatch):
+    monkeypatch.setattr(jobs, "_uploads", uploads)
+    monkeypatch.setattr(jobs, "_blob_store", blob_store)
+    path, _ = incoming(blob_store, CSV)
+    uploads.collection.insert_one({"object_id": "o1", "blob": None, "data_type": None, "status": "started"})
+    jobs.process_upload("o1", path, "drs:///o1")
+    entry = uploads.collection.find_one({"object_id": "o1"})
+    assert entry["status"] == "finished" and entry["mime_type"] == "text/csv" and entry["dimension"] == "3x2"
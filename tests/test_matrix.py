@@ -0,0 +1,90 @@
+import io
+import os
+
+import numpy as np
+import pytest
+
+from fuse.utils import matrix
+from fuse.utils.matrix import Matrix, build_matrix, iter_slice_csv, slice_to_json
+
+EXPRESSION = "gene,S1,S2,S3\ng1,1.5,2,\ng2,3,4,5\nchr1:100-200,6,7,8\n\"a,b\",9,10,11\n"
+HEADERLESS = "g1,1,2\ng2,3,4\ng3,5,6\n"
+PHENOTYPES = "sample,age,sex\nS1,31,F\nS2,,M\nS3,45,F\n"
+
+
+def _build(tmp_path, text: str, name: str = "sidecar"):
+    out_dir = str(tmp_path / name)
+    return build_matrix(lambda: io.StringIO(text), out_dir), Matrix(out_dir)
+
+
+def test_numeric_matrix_with_a_header(tmp_path):
+    built, m = _build(tmp_path, EXPRESSION)
+    assert built == {"rows": 4, "cols": 3, "dtype": "float64"}
+    assert m.row_labels.tolist() == ["g1", "g2", "chr1:100-200", "a,b"] and m.col_labels.tolist() == ["S1", "S2", "S3"]
+    assert m.values.dtype == np.float64 and np.isnan(m.values[0, 2]) and m.values[3, 2] == 11
+    assert sorted(os.listdir(tmp_path)) == ["sidecar"]
+
+
+def test_matrix_without_a_header_is_labelled_by_position(tmp_path):
+    built, m = _build(tmp_path, HEADERLESS)
+    assert built == {"rows": 3, "cols": 2, "dtype": "float64"}
+    assert m.col_labels.tolist() == ["0", "1"] and m.values.tolist() == [[1, 2], [3, 4], [5, 6]]
+
+
+def test_mixed_matrix_is_stored_as_text(tmp_path):
+    built, m = _build(tmp_path, PHENOTYPES)
+    assert built == {"rows": 3, "cols": 2, "dtype": "str"}
+    assert m.values.dtype.kind == "U" and m.values.tolist() == [["31.0", "F"], ["", "M"], ["45.0", "F"]]
+
+
+def test_read_in_chunks(tmp_path, monkeypatch):
+    monkeypatch.setattr(matrix.g_profile_config, "CHUNK_CELLS", 3)
+    text = "gene,S1,S2\n" + "".join(f"g{i},{i},{i * 2}\n" for i in range(50))
+    built, m = _build(tmp_path, text)
+    assert built["rows"] == 50 and m.values[49].tolist() == [49, 98]
+
+
+def test_no_value_columns(tmp_path):
+    with pytest.raises(ValueError):
+        _build(tmp_path, "g1\ng2\n")
+    assert os.listdir(tmp_path) == []
+
+
+@pytest.fixture
+def expression(tmp_path):
+    return _build(tmp_path, EXPRESSION)[1]
+
+
+@pytest.mark.parametrize("rows, expected", [
+    (None, ["g1", "g2", "chr1:100-200", "a,b"]),
+    ("g2,g1", ["g2", "g1"]),
+    ("1:3", ["g2", "chr1:100-200"]),
+    (":2, -1:", ["g1", "g2", "a,b"]),
+    ("::", None),
+    # labels that look like, but aren't, ranges
+    ("chr1:100-200", ["chr1:100-200"]),
+    ('"a,b",g1', ["a,b", "g1"]),
+])
+def test_select_rows(expression, rows, expected):
+    if expected is None:
+        with pytest.raises(KeyError):
+            expression.slice(rows=rows)
+        return
+    row_labels, col_labels, values = expression.slice(rows=rows)
+    assert row_labels.tolist() == expected and values.shape == (len(expected), 3)
+
+
+def test_slice(expression):
+    row_labels, col_labels, values = expression.slice(rows='g2,"a,b"', cols="S3,0:1")
+    assert col_labels.tolist() == ["S3", "S1"]
+    assert values.tolist() == [[5, 3], [11, 9]]
+    with pytest.raises(KeyError):
+        expression.slice(rows="nope")
+    with pytest.raises(ValueError):
+        expression.slice(max_cells=11)
+
+
+def test_slice_output(expression):
+    row_labels, col_labels, values = expression.slice(rows="g1", cols="1:")
+    assert slice_to_json(row_labels, col_labels, values) == {"rows": ["g1"], "cols": ["S2", "S3"], "values": [[2.0, None]]}
+    assert "".join(iter_slice_csv(row_labels, col_labels, values)) == ",S2,S3\ng1,2.0,\n"
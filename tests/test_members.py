@@ -0,0 +1,49 @@
+import io
+import zipfile
+
+import pytest
+
+from fuse.utils import jobs, members
+
+
+@pytest.fixture
+def archive(tmp_path):
+    path = tmp_path / "archive.zip"
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as z:
+        for i in range(6):
+            z.writestr(f"d/part{i}.csv", "id,a,b\n" + "".join(f"r{j},{j},{i}\n" for j in range(2000 * (i + 1))))
+        z.writestr("d/phenoDataMatrix.csv", "sample,age\nS1,1\nS2,2\n")
+        z.writestr("d/notes.txt", "no newline at the end")
+    return str(path)
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    monkeypatch.setattr(members.g_zip_index_config, "WORKERS", 2)
+    monkeypatch.setattr(members.g_zip_index_config, "INLINE_BYTES", 0)
+    yield
+    members.close_pool()
+
+
+def test_pool_and_inline_agree(archive, pool):
+    inline = members.index_members(archive, [(info.filename, info.filename.endswith("phenoDataMatrix.csv"))
+                                             for info in zipfile.ZipFile(archive).infolist()])
+    indexed = members.index_zip(archive, row_labels_for=("phenoDataMatrix.csv",))
+    assert members._pool is not None
+    assert indexed == inline
+    by_name = {m["full_path"]: m for m in indexed}
+    assert by_name["d/part0.csv"]["dimension"] == "2001x2"
+    assert by_name["d/phenoDataMatrix.csv"]["_row_labels"] == ["sample", "S1", "S2"]
+    assert by_name["d/notes.txt"]["dimension"] == "1x0"
+
+
+def test_rq_jobs_shut_the_pool_down(archive, pool):
+    assert len(jobs.run_job(members.index_zip, archive)) == 8
+    assert members._pool is None
+
+
+def test_batches_balance_by_size():
+    sizes = {"a": 10, "b": 1, "c": 1, "d": 8, "e": 2}
+    batches = members._batches(list(sizes), list(sizes.values()), 2)
+    assert sorted(sum(sizes[r] for r in batch) for batch in batches) == [11, 11]
+    assert members._batches(["a"], [1], 4) == [["a"]]
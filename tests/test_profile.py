@@ -0,0 +1,60 @@
+import gzip
+
+import pytest
+
+from fuse.utils import profile
+from fuse.utils.compression import GZIP, IDENTITY
+from fuse.utils.profile import profile_csv
+
+# 2 value columns of gene ids and expression, with gaps, and a text column; 40 samples
+MATRIX = "sample,gene,expression,tissue\n" + "".join(
+    f"S{i},{'' if i % 10 == 3 else 1000 + i},{'' if i == 25 else i / 4 - 2},{'liver' if i % 2 else 'lung'}\n" for i in range(40))
+
+
+def _columns(result):
+    return {c["name"]: c for c in result["columns"]}
+
+
+@pytest.fixture(params=[IDENTITY, GZIP])
+def matrix_file(tmp_path, request):
+    path = tmp_path / "matrix.csv"
+    path.write_bytes(gzip.compress(MATRIX.encode()) if request.param == GZIP else MATRIX.encode())
+    return str(path), request.param
+
+
+@pytest.mark.parametrize("chunk_cells", [4, 1000000])
+def test_profile(matrix_file, monkeypatch, chunk_cells):
+    # 1 row per chunk, or the whole file in one
+    monkeypatch.setattr(profile.g_profile_config, "CHUNK_CELLS", chunk_cells)
+    result = profile_csv(*matrix_file)
+    assert result["dimension"] == "41x3"
+    columns = _columns(result)
+    assert list(columns) == ["sample", "gene", "expression", "tissue"]
+    # gaps turn a chunk of ids into floats; the column's dtype is merged across chunks
+    assert columns["gene"] == {"name": "gene", "dtype": "float64", "null_count": 4, "min": 1000.0, "max": 1039.0, "entrez_like": True}
+    assert columns["expression"] == {"name": "expression", "dtype": "float64", "null_count": 1, "min": -2.0, "max": 7.75, "entrez_like": False}
+    assert columns["tissue"]["min"] is None and columns["tissue"]["max"] is None and columns["tissue"]["null_count"] == 0
+    assert columns["sample"]["entrez_like"] is False
+
+
+def test_profile_without_a_header(tmp_path):
+    path = tmp_path / "matrix.csv"
+    path.write_text("g1,1,2\ng2,3,4\ng3,5,6")
+    result = profile_csv(str(path))
+    assert result["dimension"] == "3x2"
+    assert [(c["name"], c["min"], c["max"]) for c in result["columns"]] == [("0", None, None), ("1", 1, 5), ("2", 2, 6)]
+    assert [c["dtype"] for c in result["columns"][1:]] == ["int64", "int64"]
+
+
+def test_profile_keeps_at_most_max_columns(tmp_path, monkeypatch):
+    monkeypatch.setattr(profile.g_profile_config, "MAX_COLUMNS", 2)
+    path = tmp_path / "matrix.csv"
+    path.write_text(MATRIX)
+    result = profile_csv(str(path))
+    assert result["dimension"] == "41x3" and [c["name"] for c in result["columns"]] == ["sample", "gene"]
+
+
+def test_unparseable_file_gets_only_a_dimension(tmp_path):
+    path = tmp_path / "notes.txt"
+    path.write_text("a,b\n\"unterminated\n1,2,3,4,5\n")
+    assert profile_csv(str(path)) == {"dimension": "3x1", "columns": None}
@@ -0,0 +1,85 @@
+import asyncio
+
+import pytest
+
+from fuse.utils.ranges import FileRangeResponse, RangeNotSatisfiable, etag_for, etag_matches, parse_range
+
+
+@pytest.mark.parametrize("header", [None, "", "items=0-1", "bytes=a-b", "bytes=5-2", "bytes=0-1,x", "bytes=" + ",".join(["0-0"] * 17)])
+def test_unusable_range_is_ignored(header):
+    assert parse_range(header, 100) is None
+
+
+@pytest.mark.parametrize("header, ranges", [
+    ("bytes=0-9", [(0, 9)]),
+    ("bytes=90-", [(90, 99)]),
+    ("bytes=90-200", [(90, 99)]),
+    ("bytes=99-99", [(99, 99)]),
+    # suffix ranges: the last N bytes, all of them if N is more than the size
+    ("bytes=-10", [(90, 99)]),
+    ("bytes=-1000", [(0, 99)]),
+    # ranges past the end are dropped as long as one is left
+    ("bytes=0-1, 200-300", [(0, 1)]),
+    ("bytes=-0,0-1", [(0, 1)]),
+    # overlapping ranges are served as asked, in order
+    ("bytes=0-50,25-75,10-20", [(0, 50), (25, 75), (10, 20)]),
+])
+def test_parse_range(header, ranges):
+    assert parse_range(header, 100) == ranges
+
+
+@pytest.mark.parametrize("header, size", [("bytes=100-", 100), ("bytes=100-200,300-", 100), ("bytes=-0", 100), ("bytes=0-", 0), ("bytes=-5", 0)])
+def test_unsatisfiable_range(header, size):
+    with pytest.raises(RangeNotSatisfiable):
+        parse_range(header, size)
+
+
+def test_etag():
+    etag = etag_for([{"type": "md5", "checksum": "m"}, {"type": "sha-256", "checksum": "s"}])
+    assert etag == '"s"'
+    assert etag_for([{"type": "md5", "checksum": "m"}]) == '"m"'
+    assert etag_for(None) is None
+    assert etag_matches('"x", W/"s"', etag)
+    assert etag_matches("*", etag)
+    assert not etag_matches('"x"', etag)
+    assert not etag_matches(None, etag)
+
+
+def _serve(response):
+    messages = []
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(response(None, None, send))
+    headers = {k.decode(): v.decode() for k, v in messages[0]["headers"]}
+    return messages[0]["status"], headers, b"".join(m.get("body", b"") for m in messages[1:])
+
+
+@pytest.fixture
+def data_file(tmp_path):
+    path = tmp_path / "data"
+    path.write_bytes(bytes(range(100)))
+    return str(path)
+
+
+def test_whole_file(data_file):
+    status, headers, body = _serve(FileRangeResponse(data_file, 100, media_type="text/csv"))
+    assert status == 200 and body == bytes(range(100)) and headers["content-length"] == "100"
+
+
+def test_single_range(data_file):
+    status, headers, body = _serve(FileRangeResponse(data_file, 100, parse_range("bytes=-10", 100), media_type="text/csv"))
+    assert status == 206 and body == bytes(range(90, 100))
+    assert headers["content-range"] == "bytes 90-99/100" and headers["content-length"] == "10"
+
+
+def test_multiple_ranges(data_file):
+    response = FileRangeResponse(data_file, 100, parse_range("bytes=0-1,50-52,1-2", 100), media_type="text/csv")
+    status, headers, body = _serve(response)
+    assert status == 206 and headers["content-type"] == f"multipart/byteranges; boundary={response.boundary}"
+    assert int(headers["content-length"]) == len(body)
+    parts = body.split(f"--{response.boundary}".encode())
+    assert parts[-1] == b"--\r\n" and len(parts) == 5
+    assert parts[2] == b"\r\nContent-Type: text/csv\r\nContent-Range: bytes 50-52/100\r\n\r\n" + bytes([50, 51, 52]) + b"\r\n"
+    assert parts[3].endswith(b"Content-Range: bytes 1-2/100\r\n\r\n" + bytes([1, 2]) + b"\r\n")
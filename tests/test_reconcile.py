@@ -0,0 +1,164 @@
+import datetime
+import os
+import time
+
+import pytest
+
+from conftest import incoming, run
+from fuse.models.Config import ReconcileConfig
+from fuse.utils.reconcile import Reconciler
+
+DATA = b"a,b\n1,2\n"
+OLD = datetime.datetime.utcnow() - datetime.timedelta(days=30)
+
+
+def _config(**settings):
+    return ReconcileConfig(**{"OPS_PER_SECOND": 0, "GRACE_SECONDS": 60, **settings})
+
+
+@pytest.fixture
+def reconciler(uploads, blob_store):
+    return Reconciler(uploads, blob_store, _config())
+
+
+def _object(uploads, object_id, blob=None, status="finished", created_time=None, **fields):
+    document = {"object_id": object_id, "status": status, "blob": blob, "blob_encoding": "identity" if blob else None,
+                "created_time": created_time or datetime.datetime.utcnow(), **fields}
+    uploads.collection.insert_one(document)
+    return document
+
+
+def _age(path, seconds):
+    then = time.time() - seconds
+    os.utime(path, (then, then))
+
+
+def test_shared_blob_survives_one_delete_and_is_reclaimed_after_the_last(uploads, blob_store, reconciler):
+    sha256, _ = run(blob_store.commit(*incoming(blob_store, DATA)))
+    run(blob_store.commit(*incoming(blob_store, DATA)))
+    first, second = _object(uploads, "o1", sha256), _object(uploads, "o2", sha256)
+    path = blob_store.stored_path(sha256)
+
+    assert run(reconciler.remove(first, "deleted")).deleted_count == 1
+    # gone for clients at once, bytes still there until the reconciler runs
+    assert uploads.collection.find_one({"object_id": "o1"}) is None
+    assert blob_store.blobs.collection.find_one({"_id": sha256})["refcount"] == 2
+    assert run(reconciler.reclaim()) == 1
+    assert blob_store.blobs.collection.find_one({"_id": sha256})["refcount"] == 1
+    assert os.path.exists(path)
+
+    run(reconciler.remove(second, "deleted"))
+    assert run(reconciler.reclaim()) == 1
+    assert blob_store.blobs.collection.find_one({"_id": sha256}) is None
+    assert not os.path.exists(path)
+    assert reconciler.tombstones.collection.count_documents({}) == 0
+
+
+def test_removing_twice_is_a_no_op(uploads, reconciler):
+    entry = _object(uploads, "o1")
+    assert run(reconciler.remove(entry, "deleted")) is not None
+    assert run(reconciler.remove(entry, "deleted")) is None
+
+
+def test_reclaim_retried_after_a_crash_releases_once(uploads, blob_store, reconciler):
+    sha256, _ = run(blob_store.commit(*incoming(blob_store, DATA)))
+    run(blob_store.commit(*incoming(blob_store, DATA)))
+    first = _object(uploads, "o1", sha256)
+    _object(uploads, "o2", sha256)
+    run(reconciler.remove(first, "deleted"))
+    # a reclaim that released the reference, then died before removing the tombstone
+    tombstone = reconciler.tombstones.collection.find_one({})
+    run(blob_store.release(sha256, str(tombstone["_id"])))
+    assert run(reconciler.reclaim()) == 1
+    assert blob_store.blobs.collection.find_one({"_id": sha256})["refcount"] == 1
+    assert os.path.exists(blob_store.stored_path(sha256))
+    assert blob_store.blobs.collection.find_one({"_id": sha256})["released_by"] == []
+
+
+def test_legacy_object_directory_is_reclaimed(uploads, blob_store, reconciler):
+    entry = _object(uploads, "legacy")
+    os.makedirs(blob_store.legacy_dir("legacy"))
+    run(reconciler.remove(entry, "deleted"))
+    run(reconciler.reclaim())
+    assert not os.path.exists(blob_store.legacy_dir("legacy"))
+
+
+def test_orphans_are_only_removed_after_the_grace_period(uploads, blob_store, reconciler):
+    referenced, _ = run(blob_store.commit(*incoming(blob_store, DATA)))
+    _object(uploads, "kept", referenced)
+    orphan_blob = os.path.join(blob_store.config.BLOB_DIR, "ab", "ab" + "0" * 62)
+    os.makedirs(os.path.dirname(orphan_blob))
+    open(orphan_blob, "wb").write(b"x")
+    os.makedirs(blob_store.legacy_dir("orphan"))
+    os.makedirs(blob_store.legacy_dir("kept"))
+    staged = blob_store.incoming_path()
+    open(staged, "wb").write(b"x")
+    paths = [orphan_blob, blob_store.legacy_dir("orphan"), staged]
+
+    # younger than RECONCILE_GRACE_SECONDS: may belong to an upload in progress
+    assert run(reconciler.scan_volume()) == 0
+    assert all(os.path.exists(path) for path in paths)
+
+    for path in paths + [blob_store.stored_path(referenced), blob_store.legacy_dir("kept")]:
+        _age(path, 120)
+    assert run(reconciler.scan_volume()) == 3
+    assert not any(os.path.exists(path) for path in paths)
+    # referenced bytes are never orphans, however old
+    assert os.path.exists(blob_store.stored_path(referenced)) and os.path.exists(blob_store.legacy_dir("kept"))
+
+
+def test_lease_is_taken_over_only_once_expired(uploads, blob_store):
+    first = Reconciler(uploads, blob_store, _config(LEASE_SECONDS=60))
+    second = Reconciler(uploads, blob_store, _config(LEASE_SECONDS=60))
+    assert run(first.lead()) and run(first.lead())
+    assert not run(second.lead())
+    first.leases.collection.update_one({"_id": "reconciler"}, {"$set": {"expires": OLD}})
+    assert run(second.lead())
+    assert not run(first.lead())
+
+
+def test_recount(uploads, blob_store, reconciler):
+    sha256, _ = run(blob_store.commit(*incoming(blob_store, DATA)))
+    _object(uploads, "o1", sha256)
+    blob_store.blobs.collection.update_one({"_id": sha256}, {"$set": {"refcount": 3, "touched_time": OLD}})
+    leaked, _ = run(blob_store.commit(*incoming(blob_store, b"no object")))
+    blob_store.blobs.collection.update_one({"_id": leaked}, {"$set": {"touched_time": OLD}})
+    recent, _ = run(blob_store.commit(*incoming(blob_store, b"being uploaded")))
+
+    assert run(reconciler.recount_blobs()) == 2
+    assert blob_store.blobs.collection.find_one({"_id": sha256})["refcount"] == 1
+    assert blob_store.blobs.collection.find_one({"_id": leaked}) is None
+    assert not os.path.exists(blob_store.stored_path(leaked))
+    # touched within the grace period: its object may not be recorded yet
+    assert blob_store.blobs.collection.find_one({"_id": recent})["refcount"] == 1
+
+
+def test_recount_leaves_a_blob_changed_since_it_was_counted(uploads, blob_store):
+    sha256, _ = run(blob_store.commit(*incoming(blob_store, DATA)))
+    seen = blob_store.blobs.collection.find_one({"_id": sha256})
+    run(blob_store.commit(*incoming(blob_store, DATA)))
+    assert not run(blob_store.recount(sha256, seen, 0))
+    assert blob_store.blobs.collection.find_one({"_id": sha256})["refcount"] == 2
+
+
+def test_expiry_policies(uploads, reconciler):
+    _object(uploads, "stale", status="started", created_time=OLD)
+    _object(uploads, "starting", status="started")
+    _object(uploads, "failed", status="failed", created_time=OLD)
+    _object(uploads, "finished", created_time=OLD)
+    # failed and finished objects are kept unless a retention is configured
+    assert run(reconciler.expire()) == 1
+    assert sorted(o["object_id"] for o in uploads.collection.find({})) == ["failed", "finished", "starting"]
+
+    reconciler.config = _config(FAILED_RETENTION=3600, RETENTION=3600)
+    assert run(reconciler.expire()) == 2
+    assert [o["object_id"] for o in uploads.collection.find({})] == ["starting"]
+
+
+def test_quota_removes_the_oldest_objects(uploads, reconciler):
+    for i in range(4):
+        _object(uploads, f"o{i}", submitter_id="s@example.com", size=400)
+    _object(uploads, "other", submitter_id="t@example.com", size=400)
+    reconciler.config = _config(SUBMITTER_QUOTA_BYTES=1000)
+    assert run(reconciler.expire()) == 2
+    assert sorted(o["object_id"] for o in uploads.collection.find({})) == ["o2", "o3", "other"]
@@ -0,0 +1,129 @@
+import asyncio
+import datetime
+import hashlib
+import os
+
+import pytest
+from fastapi import HTTPException
+from starlette.testclient import TestClient
+
+from conftest import run
+from fuse.utils import resumable
+
+PARAMETERS = {"service_id": "fuse-provider-upload", "submitter_id": "tester@example.com", "data_type": "class_dataset_expression",
+              "file_type": "filetype_dataset_properties", "file_name": "data.csv"}
+PARTS = [b"id,a,b\n", b"r1,1,2\n", b"r2,3,4\n"]
+
+
+@pytest.fixture
+def client(app, monkeypatch, tmp_path):
+    monkeypatch.setattr(resumable.g_resumable_config, "SESSION_DIR", str(tmp_path / "sessions"))
+    return TestClient(app.app)
+
+
+def _create(client):
+    response = client.post("/uploads", data=PARAMETERS)
+    assert response.status_code == 201 and response.json()["status"] == "open"
+    return response.json()["upload_id"]
+
+
+def _put(client, upload_id, part_number, data: bytes, checksum: str = None):
+    return client.put(f"/uploads/{upload_id}/parts/{part_number}", data=data, params={"checksum": checksum} if checksum is not None else None)
+
+
+def _session(app, upload_id):
+    return app.upload_sessions.collection.find_one({"upload_id": upload_id})
+
+
+def test_parts_in_any_order_are_assembled(app, client):
+    upload_id = _create(client)
+    for n in (3, 1, 2):
+        assert _put(client, upload_id, n, PARTS[n - 1]).status_code == 200
+    assert sorted(client.get(f"/uploads/{upload_id}").json()["parts"]) == ["1", "2", "3"]
+    response = client.post(f"/uploads/{upload_id}/complete", params={"checksum": hashlib.sha256(b"".join(PARTS)).hexdigest()})
+    assert response.status_code == 202
+    object_id = response.json()["object_id"]
+    assert client.get(f"/files/{object_id}").content == b"".join(PARTS)
+    assert client.get(f"/objects/{object_id}").json()["status"] == "finished"
+    assert _session(app, upload_id)["status"] == "completed" and _session(app, upload_id)["object_id"] == object_id
+    assert not os.path.exists(resumable.session_path(upload_id))
+
+
+def test_a_gap_fails_the_complete_and_reopens_the_session(app, client):
+    upload_id = _create(client)
+    _put(client, upload_id, 1, PARTS[0])
+    _put(client, upload_id, 3, PARTS[2])
+    response = client.post(f"/uploads/{upload_id}/complete")
+    assert response.status_code == 404 and "without gaps, received [1, 3]" in response.json()["detail"]
+    assert _session(app, upload_id)["status"] == "open"
+    assert app.mongo_uploads.collection.count_documents({}) == 0
+
+    _put(client, upload_id, 2, PARTS[1])
+    assert client.post(f"/uploads/{upload_id}/complete").status_code == 202
+
+
+def test_a_resent_part_replaces_the_previous_one(client):
+    upload_id = _create(client)
+    _put(client, upload_id, 1, PARTS[0])
+    _put(client, upload_id, 2, b"garbage\n")
+    _put(client, upload_id, 2, PARTS[1])
+    # a corrupt re-send doesn't replace what was received
+    response = _put(client, upload_id, 3, PARTS[2], checksum=hashlib.sha256(b"other").hexdigest())
+    assert response.status_code == 404
+    assert _put(client, upload_id, 3, PARTS[2], checksum=hashlib.sha256(PARTS[2]).hexdigest()).status_code == 200
+    assert client.get(f"/uploads/{upload_id}").json()["parts"]["2"]["size"] == len(PARTS[1])
+    object_id = client.post(f"/uploads/{upload_id}/complete").json()["object_id"]
+    assert client.get(f"/files/{object_id}").content == b"".join(PARTS)
+
+
+def test_a_wrong_whole_object_checksum_reopens_the_session(app, client):
+    upload_id = _create(client)
+    for n, part in enumerate(PARTS, 1):
+        _put(client, upload_id, n, part)
+    response = client.post(f"/uploads/{upload_id}/complete", params={"checksum": hashlib.sha256(b"other").hexdigest()})
+    assert response.status_code == 404
+    assert _session(app, upload_id)["status"] == "open"
+    assert app.mongo_uploads.collection.find_one()["status"] == "failed"
+
+
+def test_only_one_of_concurrent_completes_assembles(app, client):
+    upload_id = _create(client)
+    for n, part in enumerate(PARTS, 1):
+        _put(client, upload_id, n, part)
+
+    async def complete_twice():
+        return await asyncio.gather(app.complete_upload_session(upload_id, checksum=None),
+                                    app.complete_upload_session(upload_id, checksum=None), return_exceptions=True)
+
+    results = run(complete_twice())
+    refused = [r for r in results if isinstance(r, HTTPException)]
+    assert len(refused) == 1 and refused[0].status_code == 404
+    assert app.mongo_uploads.collection.count_documents({}) == 1
+    assert _session(app, upload_id)["status"] == "completed"
+
+
+def test_abort_discards_the_parts(app, client):
+    upload_id = _create(client)
+    _put(client, upload_id, 1, PARTS[0])
+    response = client.delete(f"/uploads/{upload_id}")
+    assert response.status_code == 200 and response.json()["status"] == "aborted"
+    assert not os.path.exists(resumable.session_path(upload_id))
+    assert _put(client, upload_id, 2, PARTS[1]).status_code == 404
+    assert client.post(f"/uploads/{upload_id}/complete").status_code == 404
+    assert client.delete(f"/uploads/{upload_id}").status_code == 404
+
+
+def test_reaper_expires_idle_and_stuck_sessions(app, client):
+    stale = datetime.datetime.utcnow() - datetime.timedelta(seconds=resumable.g_resumable_config.SESSION_TTL + 60)
+    sessions = {status: _create(client) for status in ("idle", "stuck", "fresh", "busy")}
+    for upload_id in sessions.values():
+        _put(client, upload_id, 1, PARTS[0])
+    app.upload_sessions.collection.update_one({"upload_id": sessions["idle"]}, {"$set": {"updated_time": stale}})
+    # left completing by a worker that died while assembling
+    app.upload_sessions.collection.update_one({"upload_id": sessions["stuck"]}, {"$set": {"status": "completing", "updated_time": stale}})
+    app.upload_sessions.collection.update_one({"upload_id": sessions["busy"]}, {"$set": {"status": "completing"}})
+
+    assert run(resumable.reap_sessions(app.upload_sessions)) == 2
+    assert {name: _session(app, upload_id)["status"] for name, upload_id in sessions.items()} == \
+           {"idle": "expired", "stuck": "expired", "fresh": "open", "busy": "completing"}
+    assert [os.path.exists(resumable.session_path(upload_id)) for upload_id in sessions.values()] == [False, False, True, True]
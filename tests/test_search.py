@@ -0,0 +1,95 @@
+import datetime
+import json
+
+import pytest
+from starlette.testclient import TestClient
+
+SUBMITTER = "tester@example.com"
+START = datetime.datetime(2026, 1, 1)
+
+
+def _object(i: int, submitter_id: str = SUBMITTER):
+    return {"object_id": f"{submitter_id}-{i}", "submitter_id": submitter_id, "name": f"{i}.csv",
+            "data_type": "class_dataset_expression" if i % 2 == 0 else "class_results_PCATable",
+            "file_type": "filetype_dataset_properties", "status": "failed" if i == 3 else "finished",
+            "created_time": START + datetime.timedelta(days=i)}
+
+
+@pytest.fixture
+def client(app):
+    app.mongo_uploads.collection.insert_many([_object(i) for i in range(7)] + [_object(i, "other@example.com") for i in range(2)])
+    return TestClient(app.app)
+
+
+def _ids(response):
+    return [d["object_id"] for d in response.json()]
+
+
+def _pages(client, path: str, method: str = "get", **params):
+    pages = []
+    token = None
+    while True:
+        response = client.request(method, path, params={**params, **({"page_token": token} if token is not None else {})})
+        assert response.status_code == 200
+        pages.append(_ids(response))
+        token = response.headers.get("Next-Page-Token")
+        if token is None:
+            return pages
+
+
+def test_pages_follow_insertion_order(client):
+    assert _pages(client, f"/search/{SUBMITTER}", limit=3) == [[f"{SUBMITTER}-{i}" for i in page] for page in ([0, 1, 2], [3, 4, 5], [6])]
+    # a page that is exactly full still says there is no more
+    assert len(_pages(client, f"/search/{SUBMITTER}", limit=7)) == 1
+
+
+def test_pages_are_stable_while_objects_are_added(app, client):
+    first = client.get(f"/search/{SUBMITTER}", params={"limit": 4})
+    app.mongo_uploads.collection.insert_one(_object(7))
+    second = client.get(f"/search/{SUBMITTER}", params={"limit": 4, "page_token": first.headers["Next-Page-Token"]})
+    assert _ids(second) == [f"{SUBMITTER}-{i}" for i in (4, 5, 6, 7)]
+
+
+def test_admin_lists_every_submitter(client):
+    assert sum(len(page) for page in _pages(client, "/admin/objects", method="post", limit=4)) == 9
+
+
+@pytest.mark.parametrize("params, expected", [
+    ({"status": "failed"}, [3]),
+    ({"data_type": "class_results_PCATable"}, [1, 3, 5]),
+    ({"data_type": "class_dataset_expression", "status": "finished"}, [0, 2, 4, 6]),
+    ({"created_after": (START + datetime.timedelta(days=2)).isoformat(), "created_before": (START + datetime.timedelta(days=4)).isoformat()}, [2, 3]),
+])
+def test_filters(client, params, expected):
+    assert _ids(client.get(f"/search/{SUBMITTER}", params=params)) == [f"{SUBMITTER}-{i}" for i in expected]
+
+
+def test_fields(client):
+    response = client.get(f"/search/{SUBMITTER}", params={"fields": "object_id, status", "limit": 1})
+    assert response.json() == [{"object_id": f"{SUBMITTER}-0", "status": "finished"}]
+    for fields in ("_id", "$where", ","):
+        response = client.get(f"/search/{SUBMITTER}", params={"fields": fields})
+        assert response.status_code == 400
+
+
+@pytest.mark.parametrize("path, method", [(f"/search/{SUBMITTER}", "get"), ("/admin/objects", "post")])
+def test_invalid_page_token(client, path, method):
+    for token in ("nope", "AAAA", "!!"):
+        response = client.request(method, path, params={"page_token": token})
+        assert response.status_code == 400 and "invalid page token" in response.json()["detail"]
+        assert "traceback" not in response.json()["detail"]
+
+
+def test_ndjson(client):
+    response = client.get(f"/search/{SUBMITTER}", params={"format": "ndjson", "fields": "object_id,created_time", "limit": 4})
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert [d["object_id"] for d in lines[:4]] == [f"{SUBMITTER}-{i}" for i in range(4)]
+    assert lines[0]["created_time"] == START.isoformat()
+    # the trailing line carries the token for the rest
+    assert list(lines[4]) == ["next_page_token"] and len(lines) == 5
+    rest = client.get(f"/search/{SUBMITTER}", params={"format": "ndjson", "page_token": lines[4]["next_page_token"]})
+    assert [json.loads(line)["object_id"] for line in rest.text.splitlines()] == [f"{SUBMITTER}-{i}" for i in range(4, 7)]
+    # without a limit, everything is streamed and there is no token
+    everything = client.get(f"/search/{SUBMITTER}", params={"format": "ndjson"}).text.splitlines()
+    assert len(everything) == 7 and all("next_page_token" not in json.loads(line) for line in everything)
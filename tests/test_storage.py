@@ -0,0 +1,124 @@
+import os
+
+import boto3
+import pytest
+import requests
+from moto import mock_s3
+from starlette.testclient import TestClient
+
+from conftest import incoming, run
+from fuse.models.Config import BlobConfig, StorageConfig
+from fuse.utils import jobs
+from fuse.utils.blobs import BlobStore
+from fuse.utils.compression import IDENTITY
+from fuse.utils.storage import S3_ACCESS_ID, S3Storage, access_methods
+
+BUCKET = "fuse-test"
+DATA = b"id,a,b\n" + b"".join(b"r%d,%d,%d\n" % (i, i, i * 2) for i in range(1000))
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "test")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "test")
+    with mock_s3():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+def _keys(s3):
+    return [o["Key"] for o in s3.list_objects_v2(Bucket=BUCKET).get("Contents", [])]
+
+
+def _s3_config(tmp_path, keep_local: bool):
+    return StorageConfig(DATA_DIR=str(tmp_path), BACKEND="s3", S3_BUCKET=BUCKET, S3_PREFIX="blobs/", S3_REGION="us-east-1",
+                         S3_ACCESS_KEY_ID="test", S3_SECRET_ACCESS_KEY="test", KEEP_LOCAL=keep_local)
+
+
+@pytest.fixture
+def s3_blob_store(s3, uploads, tmp_path):
+    return BlobStore(uploads.sibling("blobs"), BlobConfig(BLOB_DIR=str(tmp_path / "blobs")), _s3_config(tmp_path, keep_local=False))
+
+
+def test_put_fetch_delete(s3, tmp_path):
+    storage = S3Storage(_s3_config(tmp_path, keep_local=True))
+    source = tmp_path / "source"
+    source.write_bytes(DATA)
+    storage.put(str(source), "ab/abc")
+    assert _keys(s3) == ["blobs/ab/abc"] and storage.exists("ab/abc") and not storage.exists("ab/abd")
+    storage.fetch("ab/abc", str(tmp_path / "fetched"))
+    assert (tmp_path / "fetched").read_bytes() == DATA
+    storage.delete("ab/abc")
+    assert _keys(s3) == [] and not storage.exists("ab/abc")
+
+
+def test_presigned_url(s3, tmp_path):
+    storage = S3Storage(_s3_config(tmp_path, keep_local=True))
+    source = tmp_path / "source"
+    source.write_bytes(DATA)
+    storage.put(str(source), "ab/abc")
+    url = storage.presigned_url("ab/abc", "data.csv", "text/csv")
+    assert "response-content-disposition=attachment" in url and "response-content-type=text%2Fcsv" in url
+    assert "X-Amz-Expires=3600" in url
+    assert requests.get(url).content == DATA
+
+
+def test_offload_drops_the_local_copy_and_ensure_local_fetches_it_back(s3, s3_blob_store):
+    sha256, encoding = run(s3_blob_store.commit(*incoming(s3_blob_store, DATA)))
+    path = s3_blob_store.stored_path(sha256, encoding)
+    assert s3_blob_store.offload(sha256, encoding)
+    assert _keys(s3) == [f"blobs/{s3_blob_store.storage_key(sha256, encoding)}"]
+    assert not os.path.exists(path)
+    assert s3_blob_store.blobs.collection.find_one({"_id": sha256})["offloaded"]
+
+    assert s3_blob_store.ensure_local(sha256, encoding) == path
+    assert open(path, "rb").read() == DATA
+    assert requests.get(s3_blob_store.access_url(sha256, encoding, "data.csv", "text/csv")).content == DATA
+
+    # the last release removes the bucket's copy too
+    assert run(s3_blob_store.release(sha256))
+    assert _keys(s3) == [] and not os.path.exists(path)
+
+
+def test_keep_local(s3, uploads, tmp_path):
+    blob_store = BlobStore(uploads.sibling("blobs"), BlobConfig(BLOB_DIR=str(tmp_path / "blobs")), _s3_config(tmp_path, keep_local=True))
+    sha256, encoding = run(blob_store.commit(*incoming(blob_store, DATA)))
+    assert blob_store.offload(sha256, encoding)
+    assert os.path.exists(blob_store.stored_path(sha256, encoding)) and len(_keys(s3)) == 1
+
+
+def test_processing_offloads_the_committed_blob(s3, uploads, s3_blob_store, monkeypatch):
+    monkeypatch.setattr(jobs, "_uploads", uploads)
+    monkeypatch.setattr(jobs, "_blob_store", s3_blob_store)
+    sha256, encoding = run(s3_blob_store.commit(*incoming(s3_blob_store, DATA)))
+    uploads.collection.insert_one({"object_id": "o1", "blob": sha256, "blob_encoding": encoding, "data_type": None, "status": "started"})
+    jobs.process_upload("o1", s3_blob_store.stored_path(sha256, encoding), "drs:///o1", encoding)
+    entry = uploads.collection.find_one({"object_id": "o1"})
+    assert entry["status"] == "finished" and entry["dimension"] == "1001x2"
+    assert [m["access_id"] for m in entry["access_methods"]] == ["files", S3_ACCESS_ID]
+    assert len(_keys(s3)) == 1 and not os.path.exists(s3_blob_store.stored_path(sha256, encoding))
+
+
+@pytest.fixture
+def app(app, monkeypatch, s3, tmp_path):
+    blob_store = BlobStore(app.mongo_uploads.sibling("blobs"), BlobConfig(BLOB_DIR=str(tmp_path / "blobs")), _s3_config(tmp_path, keep_local=False))
+    monkeypatch.setattr(app, "blob_store", blob_store)
+    return app
+
+
+def test_access_endpoint_returns_a_presigned_url(app):
+    blob_store = app.blob_store
+    sha256, encoding = run(blob_store.commit(*incoming(blob_store, DATA)))
+    assert blob_store.offload(sha256, encoding)
+    app.mongo_uploads.collection.insert_one({"object_id": "s3-object", "name": "data.csv", "mime_type": "text/csv", "size": len(DATA),
+                                             "blob": sha256, "blob_encoding": IDENTITY, "status": "finished", "checksums": [],
+                                             "access_methods": access_methods("s3-object", True, blob_store.storage_config)})
+    client = TestClient(app.app)
+    response = client.get("/objects/s3-object/access/s3")
+    assert response.status_code == 200
+    assert requests.get(response.json()["url"]).content == DATA
+    # the local copy is gone, so /files sends the client to the bucket
+    response = client.get("/files/s3-object", allow_redirects=False)
+    assert response.status_code == 307 and requests.get(response.headers["location"]).content == DATA
+    assert client.get("/objects/s3-object/access/nope").status_code == 404
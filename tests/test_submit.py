@@ -0,0 +1,93 @@
+import json
+import os
+
+from starlette.testclient import TestClient
+
+CSV = b"id,a,b\nr1,1,2\nr2,3,4\n"
+PARAMETERS = {"service_id": "fuse-provider-upload", "submitter_id": "tester@example.com", "data_type": "class_dataset_expression",
+              "file_type": "filetype_dataset_properties", "version": "1.0"}
+
+
+def _submit(client, data: bytes = CSV, requested_object_id: str = None):
+    form = {**PARAMETERS, "requested_object_id": requested_object_id} if requested_object_id is not None else PARAMETERS
+    return client.post("/submit", data=form, files={"client_file": ("data.csv", data, "text/csv")})
+
+
+def test_requested_object_id_is_used_when_free(app):
+    client = TestClient(app.app)
+    response = _submit(client, requested_object_id="wanted")
+    assert response.status_code == 202 and response.json()["object_id"] == "wanted"
+    assert client.get("/objects/wanted").json()["status"] == "finished"
+
+
+def test_taken_object_id_is_refused(app):
+    client = TestClient(app.app)
+    assert _submit(client, requested_object_id="wanted").status_code == 202
+    response = _submit(client, data=CSV + b"r3,5,6\n", requested_object_id="wanted")
+    assert response.status_code == 409 and "wanted" in response.json()["detail"]
+    # the first object is untouched
+    assert client.get("/objects/wanted").json()["size"] == len(CSV)
+    assert app.mongo_uploads.collection.count_documents({}) == 1
+
+
+def test_object_id_is_generated_when_none_is_requested(app):
+    object_id = _submit(TestClient(app.app)).json()["object_id"]
+    assert object_id.startswith("upload_tester@example.com_")
+
+
+def _submit_batch(client, files: dict, manifest: list = None):
+    return client.post("/submit/batch", data={**PARAMETERS, **({"manifest": json.dumps(manifest)} if manifest is not None else {})},
+                       files=[("client_files", (name, data, "text/csv")) for name, data in files.items()])
+
+
+def _statuses(response):
+    return {r["file_name"]: r["status"] for r in response.json()}
+
+
+def test_batch_refuses_taken_object_ids_per_file(app):
+    client = TestClient(app.app)
+    assert _submit(client, requested_object_id="taken").status_code == 202
+    manifest = [{"file_name": "a.csv", "requested_object_id": "taken"},
+                {"file_name": "b.csv", "requested_object_id": "fresh"},
+                {"file_name": "c.csv", "requested_object_id": "fresh"}]
+    response = _submit_batch(client, {"a.csv": CSV + b"a,1,1\n", "b.csv": CSV + b"b,1,1\n", "c.csv": CSV + b"c,1,1\n"}, manifest)
+    assert response.status_code == 202
+    results = {r["file_name"]: r for r in response.json()}
+    assert _statuses(response) == {"a.csv": "failed", "b.csv": "started", "c.csv": "failed"}
+    assert "(taken) is already taken" in results["a.csv"]["stderr"] and results["a.csv"]["object"] is None
+    # requested earlier in the same batch
+    assert "(fresh) is already taken" in results["c.csv"]["stderr"]
+    assert results["b.csv"]["object_id"] == "fresh" and client.get("/objects/fresh").json()["name"] == "b.csv"
+    assert client.get("/objects/taken").json()["size"] == len(CSV)
+
+
+def test_batch_checksum_mismatch_fails_only_that_file(app):
+    client = TestClient(app.app)
+    manifest = [{"file_name": "b.csv", "checksums": [{"type": "sha-256", "checksum": "0" * 64}]}]
+    response = _submit_batch(client, {"a.csv": CSV, "b.csv": CSV + b"b,1,1\n"}, manifest)
+    assert _statuses(response) == {"a.csv": "started", "b.csv": "failed"}
+    a, b = response.json()
+    assert client.get(f"/objects/{a['object_id']}").json()["status"] == "finished"
+    failed = client.get(f"/objects/{b['object_id']}").json()
+    assert failed["status"] == "failed" and failed["blob"] is None and "checksum" in failed["stderr"]
+    assert os.listdir(os.path.join(app.blob_store.config.BLOB_DIR, ".incoming")) == []
+
+
+def test_batch_manifest_naming_unknown_files_is_refused(app):
+    client = TestClient(app.app)
+    response = _submit_batch(client, {"a.csv": CSV}, [{"file_name": "missing.csv", "version": "2.0"}])
+    assert response.status_code == 404 and "missing.csv" in response.json()["detail"]
+    assert app.mongo_uploads.collection.count_documents({}) == 0
+
+
+def test_batch_commit_failure_fails_every_stored_file(app, monkeypatch):
+    async def commit_many(stored):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(app.blob_store, "commit_many", commit_many)
+    client = TestClient(app.app)
+    response = _submit_batch(client, {"a.csv": CSV, "b.csv": CSV + b"b,1,1\n"})
+    assert response.status_code == 202 and _statuses(response) == {"a.csv": "failed", "b.csv": "failed"}
+    assert all("disk full" in r["stderr"] for r in response.json())
+    assert {d["status"] for d in app.mongo_uploads.collection.find()} == {"failed"}
+    assert os.listdir(os.path.join(app.blob_store.config.BLOB_DIR, ".incoming")) == []
@@ -11,5 +11,7 @@ export MONGO_CLIENT=mongodb://localhost:${MONGO_PORT}/test
 export REDIS_HOST=localhost
 # store data one level up so docker build context doesn't find it
 export RELATIVE_DATA_PATH=../no_container/fuse-provider-upload/data
+# restart on code changes
+export SERVER_RELOAD=${SERVER_RELOAD:-true}
 
-python main.py
+python -m fuse.utils.server main:app